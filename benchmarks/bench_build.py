@@ -0,0 +1,84 @@
+"""Measures the throughput of the bundled postgres build on the workload that trains the optimized build
+(pgbuild/workload): pgbench's tpcb-like transactions, and inserts into and nearest-neighbor searches on an
+HNSW-indexed pgvector table (skipped if pgvector is not installed).
+
+Each metric is the time per transaction (the inverse of pgbench's tps), so that results can be compared against a
+stored baseline (--baseline) as in bench_lifecycle.py. To compare builds, record a baseline with the stock build,
+rebuild with `make build-optimized`, and run again against that baseline.
+
+Usage: python benchmarks/bench_build.py [--rounds N] [--duration SECONDS] [--clients N] [--output results.json]
+                                        [--baseline baseline.json] [--save-baseline] [--tolerance 0.1]
+"""
+
+import argparse
+import re
+import subprocess
+import tempfile
+from pathlib import Path
+
+from bench_lifecycle import parse_baseline_args, report, summarize
+
+from pixeltable_pgserver import PostgresServer, get_server
+from pixeltable_pgserver.utils import POSTGRES_BIN_PATH, extension_available
+
+WORKLOAD_PATH = Path(__file__).parent.parent / 'pgbuild' / 'workload'
+
+# metric name -> pgbench script (None for the built-in tpcb-like script)
+WORKLOADS = {
+    'tpcb_like': None,
+    'vector_insert': 'vector_insert.sql',
+    'vector_search': 'vector_search.sql',
+}
+
+_TPS_RE = re.compile(r'^tps = ([\d.]+)', re.MULTILINE)
+
+
+def pgbench(server: PostgresServer, *args: str) -> str:
+    return subprocess.run(
+        [str(POSTGRES_BIN_PATH / 'pgbench'), *args, server.get_uri()], capture_output=True, text=True, check=True
+    ).stdout
+
+
+def transaction_time(server: PostgresServer, script: str | None, duration: int, clients: int) -> float:
+    """Runs a workload for `duration` seconds and returns the seconds per transaction."""
+    args = ['-c', str(clients), '-j', str(clients), '-T', str(duration)]
+    if script is not None:
+        args += ['-n', '-f', str(WORKLOAD_PATH / script)]
+    match = _TPS_RE.search(pgbench(server, *args))
+    assert match is not None
+    return 1 / float(match.group(1))
+
+
+def run(rounds: int, duration: int, clients: int) -> dict[str, list[float]]:
+    workloads = {name: script for name, script in WORKLOADS.items() if script is None or extension_available('vector')}
+    samples: dict[str, list[float]] = {name: [] for name in workloads}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = get_server(Path(tmpdir) / 'pgdata', cleanup_mode='delete')
+        try:
+            pgbench(server, '-i', '-q', '-s', '10')
+            if 'vector_insert' in workloads:
+                server.psql((WORKLOAD_PATH / 'vector_setup.sql').read_text())
+            for _ in range(rounds):
+                for name, script in workloads.items():
+                    samples[name].append(transaction_time(server, script, duration, clients))
+        finally:
+            server.cleanup()
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--duration', type=int, default=10, help='seconds per workload and round')
+    parser.add_argument('--clients', type=int, default=4)
+    args = parse_baseline_args(parser, tolerance=0.1, min_delta=0.0)
+
+    results = summarize(run(args.rounds, args.duration, args.clients), args.rounds)
+    results['meta'].update(duration=args.duration, clients=args.clients)
+    for name, result in results['results'].items():
+        print(f'{name:<18}{1 / result["median"]:>12.1f} tps')
+    report(results, args, echo=False)
+
+
+if __name__ == '__main__':
+    main()
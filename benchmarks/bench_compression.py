@@ -0,0 +1,93 @@
+"""Compares TOAST and WAL compression methods on large JSON metadata and embedding rows: insert throughput, the
+on-disk size of the table, and the WAL volume of inserting the rows and of updating them after a checkpoint (which
+writes a full-page image of every page). Methods the bundled postgres was not built with are skipped.
+
+Usage: python benchmarks/bench_compression.py [--rows N] [--dim N]
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from pixeltable_pgserver import PostgresServer, get_server
+from pixeltable_pgserver.utils import compression_available, extension_available
+
+# (default_toast_compression, wal_compression): the postgres defaults, and the faster methods
+CONFIGS = [('pglz', 'off'), ('lz4', 'lz4'), ('lz4', 'zstd')]
+
+# ~6kB of JSON per row, with repeated keys and partly repetitive values, like pixeltable's metadata
+METADATA_SQL = """
+    (select jsonb_object_agg('property_' || k, repeat(md5((g * k)::text), 1 + k % 4))
+     from generate_series(1, 40) k where g > 0)
+"""
+
+
+def _wal_bytes(server: PostgresServer, start_lsn: str) -> int:
+    return int(server.query('select pg_wal_lsn_diff(pg_current_wal_lsn(), $1::pg_lsn)', [start_lsn])[0][0])
+
+
+def run_config(server: PostgresServer, toast: str, wal: str, rows: int, dim: int) -> dict[str, float]:
+    vectors = extension_available('vector')
+    with server.connect() as conn:
+        conn.execute(f"set default_toast_compression = '{toast}'")
+        conn.execute(f"set wal_compression = '{wal}'")
+        conn.execute('drop table if exists items')
+        if vectors:
+            conn.execute('create extension if not exists vector')
+        embedding = f', embedding vector({dim})' if vectors else ''
+        conn.execute(f'create table items (id int primary key, metadata jsonb{embedding})')
+        embedding_sql = (
+            f', (select array_agg(random())::vector({dim}) from generate_series(1, {dim}) where g > 0)'
+            if vectors
+            else ''
+        )
+        start_lsn = conn.execute('select pg_current_wal_lsn()::text')[0][0]
+        start = time.perf_counter()
+        conn.execute(f'insert into items select g, {METADATA_SQL}{embedding_sql} from generate_series(1, {rows}) g')
+        insert_seconds = time.perf_counter() - start
+        insert_wal = _wal_bytes(server, start_lsn)
+
+        conn.execute('checkpoint')
+        start_lsn = conn.execute('select pg_current_wal_lsn()::text')[0][0]
+        conn.execute('update items set id = -id')
+        update_wal = _wal_bytes(server, start_lsn)
+        size = conn.execute("select pg_total_relation_size('items')")[0][0]
+    return {
+        'rows_per_second': rows / insert_seconds,
+        'table_mb': size / 2**20,
+        'insert_wal_mb': insert_wal / 2**20,
+        'update_wal_mb': update_wal / 2**20,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=512, help='dimensions of the embedding column (needs pgvector)')
+    args = parser.parse_args()
+
+    configs = [
+        (toast, wal)
+        for toast, wal in CONFIGS
+        if all(m in ('pglz', 'off') or compression_available(m) for m in (toast, wal))
+    ]
+    print(f'{"toast":<8}{"wal":<8}{"rows/s":>10}{"table MB":>10}{"insert WAL MB":>15}{"update WAL MB":>15}')
+    # no profile, so that full_page_writes is on
+    with (
+        tempfile.TemporaryDirectory() as tmpdir,
+        get_server(Path(tmpdir) / 'pgdata', cleanup_mode='delete') as server,
+    ):
+        for toast, wal in configs:
+            r = run_config(server, toast, wal, args.rows, args.dim)
+            print(
+                f'{toast:<8}{wal:<8}{r["rows_per_second"]:>10.0f}{r["table_mb"]:>10.1f}'
+                f'{r["insert_wal_mb"]:>15.1f}{r["update_wal_mb"]:>15.1f}'
+            )
+    skipped = len(CONFIGS) - len(configs)
+    if skipped:
+        print(f'({skipped} configurations skipped: postgres was built without lz4 or zstd; see pgbuild/Makefile)')
+
+
+if __name__ == '__main__':
+    main()
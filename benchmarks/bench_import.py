@@ -0,0 +1,56 @@
+"""Times importing the package, and the server module (the import cost of the first server use), in fresh
+interpreters, as reported by `python -X importtime`.
+
+Results are written as JSON (--output) and can be compared against a stored baseline (--baseline) as in
+bench_lifecycle.py; the exit status is 1 if any metric regressed beyond the tolerance.
+
+Usage: python benchmarks/bench_import.py [--rounds N] [--output results.json] [--baseline baseline.json]
+                                         [--save-baseline] [--tolerance 0.25]
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+
+from bench_lifecycle import parse_baseline_args, report, summarize
+
+# metric name -> module imported in a fresh interpreter
+MODULES = {
+    'import_package': 'pixeltable_pgserver',
+    'import_server': 'pixeltable_pgserver.postgres_server',
+}
+
+# the lines of -X importtime: 'import time: <self us> | <cumulative us> | <indented module name>'
+_IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)')
+
+
+def import_time(module: str) -> float:
+    """Returns the cumulative time (in seconds) of importing `module` and its dependencies in a fresh interpreter."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, check=True
+    )
+    package = module.split('.', maxsplit=1)[0]
+    total = 0
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        # the top-level entries of the package (and its submodules) include the dependencies they import; other
+        # top-level entries are imported by the interpreter at startup
+        if match is not None and len(match.group(3)) == 1 and match.group(4).split('.')[0] == package:
+            total += int(match.group(2))
+    return total / 1e6
+
+
+def run(rounds: int) -> dict[str, list[float]]:
+    return {name: [import_time(module) for _ in range(rounds)] for name, module in MODULES.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parse_baseline_args(parser)
+    report(summarize(run(args.rounds), args.rounds), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Times the server lifecycle: cold initdb, start from the template, warm start on an existing pgdata, re-attach from
+a second process (with get_server() and from an exported handle), first-query latency, query round trips, and
+stop/delete teardown (also in the background).
+
+Results are written as JSON (--output) and can be compared against a stored baseline (--baseline); the exit status
+is 1 if any metric regressed beyond the tolerance. Baselines are machine-specific: record one with --save-baseline
+on the machine that runs the comparison.
+
+Usage: python benchmarks/bench_lifecycle.py [--rounds N] [--output results.json] [--baseline baseline.json]
+                                            [--save-baseline] [--tolerance 0.25]
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from pixeltable_pgserver import PostgresServer, ServerHandle, attach_server, get_server
+
+# round trips per sample for the query metrics, which are too fast to time individually
+ROUND_TRIPS = 20
+
+
+def _timed(fn: Callable[[], Any]) -> tuple[float, Any]:
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def _reattach(pgdata: str, results: 'mp.Queue[float]') -> None:
+    """Runs in a fresh process: attaches to the running server, then detaches, as in test_multiprocess_shared."""
+    elapsed, server = _timed(lambda: get_server(pgdata))
+    server.cleanup()
+    results.put(elapsed)
+
+
+def _reattach_handle(handle: ServerHandle, results: 'mp.Queue[float]') -> None:
+    """Like _reattach(), from a handle exported by the parent (as pool workers would)."""
+    elapsed, server = _timed(lambda: attach_server(handle))
+    server.cleanup()
+    results.put(elapsed)
+
+
+def _time_reattach(pgdata: Path, handle: ServerHandle | None = None) -> float:
+    ctx = mp.get_context('spawn')  # a fresh interpreter, without this process's PostgresServer instances
+    results: mp.Queue[float] = ctx.Queue()
+    if handle is None:
+        child = ctx.Process(target=_reattach, args=(str(pgdata), results))
+    else:
+        child = ctx.Process(target=_reattach_handle, args=(handle, results))
+    child.start()
+    elapsed = results.get(timeout=60)
+    child.join()
+    return elapsed
+
+
+def _first_query(server: PostgresServer) -> None:
+    with server.connect() as conn:
+        conn.execute('select 1')
+
+
+def run(rounds: int) -> dict[str, list[float]]:
+    samples: dict[str, list[float]] = {}
+
+    def record(name: str, seconds: float) -> None:
+        samples.setdefault(name, []).append(seconds)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp = Path(tmpdir)
+        PostgresServer.templates_path = tmp / 'templates'
+        # creates the template, so that template_start measures the copy only
+        get_server(tmp / 'warmup', cleanup_mode='delete').cleanup()
+
+        for i in range(rounds):
+            elapsed, server = _timed(lambda: get_server(tmp / f'cold{i}', cleanup_mode='delete', use_template=False))
+            record('cold_initdb', elapsed)
+            record('teardown_delete', _timed(server.cleanup)[0])
+
+            pgdata = tmp / f'pgdata{i}'
+            elapsed, server = _timed(lambda: get_server(pgdata, cleanup_mode='stop'))
+            record('template_start', elapsed)
+            record('first_query', _timed(lambda: _first_query(server))[0])
+            record('reattach', _time_reattach(pgdata))
+            record('reattach_handle', _time_reattach(pgdata, server.export_handle()))
+            record(
+                'psql_roundtrip',
+                _timed(lambda: [server.psql('select 1;') for _ in range(ROUND_TRIPS)])[0] / ROUND_TRIPS,
+            )
+            server.query('select 1')  # opens the persistent connection
+            record(
+                'query_roundtrip',
+                _timed(lambda: [server.query('select 1') for _ in range(ROUND_TRIPS)])[0] / ROUND_TRIPS,
+            )
+            record('teardown_stop', _timed(server.cleanup)[0])
+
+            elapsed, server = _timed(lambda: get_server(pgdata, cleanup_mode='delete'))
+            record('warm_start', elapsed)
+            server.cleanup()
+
+            server = get_server(tmp / f'background{i}', cleanup_mode='delete', background_cleanup=True)
+            server.query('select 1')
+            record('teardown_background', _timed(server.cleanup)[0])
+
+    return samples
+
+
+def summarize(samples: dict[str, list[float]], rounds: int) -> dict[str, Any]:
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'rounds': rounds,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': {
+            name: {'median': statistics.median(values), 'min': min(values), 'max': max(values), 'samples': values}
+            for name, values in samples.items()
+        },
+    }
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], tolerance: float, min_delta: float) -> list[str]:
+    """Prints current vs baseline medians and returns the names of the metrics that regressed: those slower by more
+    than `tolerance` (a fraction of the baseline) and by more than `min_delta` seconds, which absorbs the noise of
+    sub-millisecond metrics.
+    """
+    regressions = []
+    print(f'{"metric":<18}{"baseline ms":>14}{"current ms":>14}{"change":>10}')
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print(f'{name:<18}{"-":>14}{result["median"] * 1000:>14.2f}')
+            continue
+        base, cur = baseline['results'][name]['median'], result['median']
+        change = (cur - base) / base
+        regressed = change > tolerance and cur - base > min_delta
+        if regressed:
+            regressions.append(name)
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{name:<18}{base * 1000:>14.2f}{cur * 1000:>14.2f}{change:>+10.1%}{flag}')
+    return regressions
+
+
+def parse_baseline_args(
+    parser: argparse.ArgumentParser, tolerance: float = 0.25, min_delta: float = 0.005
+) -> argparse.Namespace:
+    """Adds the output and baseline options shared by the benchmarks to `parser`, and parses the command line."""
+    parser.add_argument('--output', type=Path, help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument('--baseline', type=Path, help='compare the results against this JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline instead')
+    parser.add_argument('--tolerance', type=float, default=tolerance, help='allowed slowdown as a fraction of baseline')
+    parser.add_argument('--min-delta', type=float, default=min_delta, help='ignore slowdowns below this many seconds')
+    args = parser.parse_args()
+    if args.save_baseline and args.baseline is None:
+        parser.error('--save-baseline requires --baseline')
+    return args
+
+
+def report(results: dict[str, Any], args: argparse.Namespace, echo: bool = True) -> None:
+    """Writes the results to --output (or prints them if `echo`, unless there is a baseline), then saves them as the
+    baseline, or compares them against it and exits with status 1 if any metric regressed.
+    """
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+    elif echo and args.baseline is None:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline is None:
+        return
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'Saved baseline to {args.baseline}')
+    elif not args.baseline.exists():
+        print(f'No baseline at {args.baseline}; record one with --save-baseline', file=sys.stderr)
+    else:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance, args.min_delta)
+        if regressions:
+            print(f'Regressed: {", ".join(regressions)}', file=sys.stderr)
+            sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parse_baseline_args(parser)
+    report(summarize(run(args.rounds), args.rounds), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Compares server cold-start latency on a fresh pgdata with and without the cached template cluster.
+
+Usage: python benchmarks/bench_template.py [--rounds N]
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from pixeltable_pgserver import PostgresServer, get_server
+
+
+def _time_start(pgdata: Path, *, use_template: bool) -> float:
+    start = time.perf_counter()
+    server = get_server(pgdata, cleanup_mode='delete', use_template=use_template)
+    elapsed = time.perf_counter() - start
+    server.cleanup()
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp = Path(tmpdir)
+        PostgresServer.templates_path = tmp / 'templates'
+        # the first templated start also pays for creating the template
+        first = _time_start(tmp / 'warmup', use_template=True)
+        cold = [_time_start(tmp / f'initdb{i}', use_template=False) for i in range(args.rounds)]
+        templated = [_time_start(tmp / f'template{i}', use_template=True) for i in range(args.rounds)]
+
+    print(f'template creation + start: {first * 1000:8.1f} ms')
+    print(f'initdb + start:            {statistics.median(cold) * 1000:8.1f} ms (median of {args.rounds})')
+    print(f'template copy + start:     {statistics.median(templated) * 1000:8.1f} ms (median of {args.rounds})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+# Runs the bundled workload against a fresh cluster of the postgres binaries in BINDIR: pgbench's tpcb-like
+# transactions, then inserts into and nearest-neighbor searches on an HNSW-indexed pgvector table (if pgvector is
+# installed). It is the training run of the profile-guided build (`make OPTIMIZE=1`); benchmarks/bench_build.py
+# measures the same workload against the bundled install.
+#
+# Usage: workload/run.sh BINDIR [SECONDS_PER_PART]  (not as root, which initdb refuses)
+set -euo pipefail
+
+BINDIR=$1
+DURATION=${2:-20}
+HERE=$(cd "$(dirname "$0")" && pwd)
+WORK=$(mktemp -d)
+# a fast shutdown lets every process exit normally, which is when an instrumented build writes its profile
+trap '"$BINDIR/pg_ctl" -D "$WORK/data" -m fast -w stop >/dev/null 2>&1 || true; rm -rf "$WORK"' EXIT
+
+"$BINDIR/initdb" -D "$WORK/data" -U postgres --auth=trust >/dev/null
+"$BINDIR/pg_ctl" -D "$WORK/data" -o "-k $WORK -c listen_addresses=''" -l "$WORK/log" -w start >/dev/null
+export PGHOST=$WORK PGUSER=postgres PGDATABASE=postgres
+
+"$BINDIR/pgbench" -i -q -s 10
+echo "tpcb-like:"
+"$BINDIR/pgbench" -c 4 -T "$DURATION" | grep '^tps'
+
+if [ -f "$BINDIR/../share/postgresql/extension/vector.control" ]; then
+	"$BINDIR/psql" -q -v ON_ERROR_STOP=1 -f "$HERE/vector_setup.sql"
+	echo "vector insert:"
+	"$BINDIR/pgbench" -n -c 4 -T "$DURATION" -f "$HERE/vector_insert.sql" | grep '^tps'
+	echo "vector search:"
+	"$BINDIR/pgbench" -n -c 4 -T "$DURATION" -f "$HERE/vector_search.sql" | grep '^tps'
+fi
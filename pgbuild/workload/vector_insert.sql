@@ -0,0 +1 @@
+insert into bench_items (embedding) select array_agg(random())::vector(128) from generate_series(1, 128);
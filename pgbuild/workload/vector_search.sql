@@ -0,0 +1,3 @@
+select id from bench_items
+order by embedding <-> (select array_agg(random())::vector(128) from generate_series(1, 128))
+limit 10;
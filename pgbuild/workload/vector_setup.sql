@@ -0,0 +1,11 @@
+-- table and HNSW index for the pgvector part of the workload (vector_insert.sql, vector_search.sql)
+set client_min_messages = warning;
+create extension if not exists vector;
+drop table if exists bench_items;
+create table bench_items (id bigserial primary key, embedding vector(128));
+-- the correlated subquery (g > 0) draws a new vector for every row
+insert into bench_items (embedding)
+select (select array_agg(random())::vector(128) from generate_series(1, 128) where g > 0)
+from generate_series(1, 5000) g;
+create index on bench_items using hnsw (embedding vector_l2_ops);
+analyze bench_items;
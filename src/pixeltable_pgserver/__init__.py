@@ -1,3 +1,33 @@
 # ruff: noqa: F401
 
-from .postgres_server import PostgresServer, get_server
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .postgres_server import PostgresServer, ServerHandle, attach_server, get_server, get_server_async
+    from .server_pool import ServerPool
+    from .serverlog import LogTail, SlowQuery
+
+# the public names, by the module defining them; modules are imported on first access, so that importing the package
+# does not pull in psutil, platformdirs etc. for programs that never start a server. The lazy lookup (PEP 562) has to
+# be defined in the package module itself, hence the non-re-export statements here.
+_EXPORTS = {  # ruff: ignore[non-empty-init-module]
+    'PostgresServer': 'postgres_server',
+    'get_server': 'postgres_server',
+    'get_server_async': 'postgres_server',
+    'attach_server': 'postgres_server',
+    'ServerHandle': 'postgres_server',
+    'ServerPool': 'server_pool',
+    'LogTail': 'serverlog',
+    'SlowQuery': 'serverlog',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
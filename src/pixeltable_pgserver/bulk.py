@@ -0,0 +1,175 @@
+"""Encoding of rows as COPY ... FROM STDIN data, in the binary or csv format (see PostgresServer.copy_in()).
+
+Rows are encoded into chunks of a bounded size as they are consumed, so that arbitrarily many rows can be streamed
+with constant memory. In the binary format, NumPy arrays destined for a single pgvector column are encoded a chunk at
+a time with vectorized operations; NumPy is not a dependency, and is only used if the data is a NumPy array already.
+See https://www.postgresql.org/docs/current/sql-copy.html for the formats.
+"""
+
+import datetime as dt
+import json
+import struct
+import sys
+import uuid
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+from .client import encode_param
+
+COPY_FORMATS = ('binary', 'csv')
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)  # signature, flags, header extension length
+BINARY_TRAILER = struct.pack('!h', -1)
+
+_PG_EPOCH_DATE = dt.date(2000, 1, 1)
+_PG_EPOCH = dt.datetime(2000, 1, 1)
+_PG_EPOCH_TZ = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+
+
+def _micros(delta: dt.timedelta) -> int:
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _encode_vector(value: Any) -> bytes:
+    # pgvector's binary format: int16 dimensions, int16 unused, float4 values
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(value, np.ndarray):
+        return struct.pack('!hh', len(value), 0) + value.astype('>f4', copy=False).tobytes()
+    return struct.pack(f'!hh{len(value)}f', len(value), 0, *value)
+
+
+def _encode_text(value: Any) -> bytes:
+    return str(value).encode()
+
+
+def _encode_json(value: Any) -> bytes:
+    return (value if isinstance(value, str) else json.dumps(value)).encode()
+
+
+# binary encoders of non-NULL values, by type name (pg_type.typname)
+_BINARY_ENCODERS: dict[str, Callable[[Any], bytes]] = {
+    'bool': lambda v: b'\x01' if v else b'\x00',
+    'bytea': bytes,
+    'int2': lambda v: struct.pack('!h', v),
+    'int4': lambda v: struct.pack('!i', v),
+    'int8': lambda v: struct.pack('!q', v),
+    'float4': lambda v: struct.pack('!f', v),
+    'float8': lambda v: struct.pack('!d', v),
+    'text': _encode_text,
+    'varchar': _encode_text,
+    'bpchar': _encode_text,
+    'name': _encode_text,
+    'json': _encode_json,
+    'jsonb': lambda v: b'\x01' + _encode_json(v),  # format version 1
+    'uuid': lambda v: (v if isinstance(v, uuid.UUID) else uuid.UUID(str(v))).bytes,
+    'date': lambda v: struct.pack('!i', (v - _PG_EPOCH_DATE).days),
+    'timestamp': lambda v: struct.pack('!q', _micros(v - _PG_EPOCH)),
+    'timestamptz': lambda v: struct.pack('!q', _micros(v.astimezone(dt.timezone.utc) - _PG_EPOCH_TZ)),
+    'vector': _encode_vector,
+}
+
+BINARY_TYPES = tuple(_BINARY_ENCODERS)
+
+_NULL = struct.pack('!i', -1)
+
+
+def _binary_row_encoder(types: Sequence[str]) -> Callable[[Sequence[Any]], bytes]:
+    encoders = [_BINARY_ENCODERS[t] for t in types]
+    field_count = struct.pack('!h', len(types))
+
+    def encode(row: Sequence[Any]) -> bytes:
+        parts = [field_count]
+        for encoder, value in zip(encoders, row):
+            if value is None:
+                parts.append(_NULL)
+            else:
+                data = encoder(value)
+                parts.append(struct.pack('!i', len(data)))
+                parts.append(data)
+        return b''.join(parts)
+
+    return encode
+
+
+def _csv_field(value: Any) -> str:
+    if value is None:
+        return ''  # unquoted, so that it is NULL rather than an empty string
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(value, np.ndarray):
+        value = value.tolist()
+    text = value if isinstance(value, str) else encode_param(value).decode()
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _encode_csv_row(row: Sequence[Any]) -> bytes:
+    return (','.join(_csv_field(value) for value in row) + '\n').encode()
+
+
+def encode_copy_data(rows: Any, types: Sequence[str], fmt: str, chunk_size: int) -> Iterator[bytes]:
+    """Returns the COPY data of `rows` for columns of the given types, as chunks of about `chunk_size` bytes.
+    rows is an iterable of row sequences, or a 2-D NumPy array. An array for a single vector column holds one vector
+    per row; otherwise its rows are the rows of the table.
+    """
+    if fmt not in COPY_FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}; expected one of {COPY_FORMATS}')
+    if fmt == 'binary':
+        unsupported = [t for t in types if t not in _BINARY_ENCODERS]
+        if unsupported:
+            raise ValueError(f"Column types {unsupported} are not supported by format='binary'; use format='csv'")
+
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(rows, np.ndarray):
+        if rows.ndim != 2:
+            raise ValueError(f'Expected a 2-dimensional array, got {rows.ndim} dimensions')
+        if list(types) == ['vector']:
+            return _vector_array_chunks(rows, fmt, chunk_size)
+
+    if fmt == 'binary':
+        return _row_chunks(rows, _binary_row_encoder(types), BINARY_HEADER, BINARY_TRAILER, chunk_size)
+    return _row_chunks(rows, _encode_csv_row, b'', b'', chunk_size)
+
+
+def _row_chunks(
+    rows: Iterable[Sequence[Any]],
+    encode_row: Callable[[Sequence[Any]], bytes],
+    header: bytes,
+    trailer: bytes,
+    chunk_size: int,
+) -> Iterator[bytes]:
+    buf = bytearray(header)
+    for row in rows:
+        buf += encode_row(row)
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+    buf += trailer
+    if buf:
+        yield bytes(buf)
+
+
+def _vector_array_chunks(array: Any, fmt: str, chunk_size: int) -> Iterator[bytes]:
+    """Encodes the rows of a 2-D array as the values of a single vector column, a block of rows at a time."""
+    np = sys.modules['numpy']
+    n, dim = array.shape
+    if fmt == 'binary':
+        # the layout of one row: field count, field length, then the vector (see _encode_vector())
+        row_dtype = np.dtype(
+            [('fields', '>i2'), ('length', '>i4'), ('dim', '>i2'), ('unused', '>i2'), ('v', '>f4', dim)]
+        )
+        rows_per_chunk = max(1, chunk_size // row_dtype.itemsize)
+        yield BINARY_HEADER
+        for start in range(0, n, rows_per_chunk):
+            block = array[start : start + rows_per_chunk]
+            out = np.empty(len(block), row_dtype)
+            out['fields'] = 1
+            out['length'] = 4 + 4 * dim
+            out['dim'] = dim
+            out['unused'] = 0
+            out['v'] = block
+            yield out.tobytes()
+        yield BINARY_TRAILER
+    else:
+        row_format = '"[' + ','.join(['%.9g'] * dim) + ']"'
+        rows_per_chunk = max(1, chunk_size // (dim * 10 + 4))
+        for start in range(0, n, rows_per_chunk):
+            block = array[start : start + rows_per_chunk]
+            yield ('\n'.join(row_format % tuple(row) for row in block.tolist()) + '\n').encode()
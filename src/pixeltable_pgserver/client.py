@@ -0,0 +1,284 @@
+"""A minimal, dependency-free client for the embedded server, speaking the wire protocol directly.
+
+Intended for administrative and test queries issued from Python without spawning psql; applications should keep
+using a full-featured driver (eg psycopg via get_uri()). Only trust authentication is supported, which is what
+the embedded server uses. Values are returned as Python objects for common types, and as strings otherwise.
+"""
+
+import datetime as dt
+import decimal
+import json
+import logging
+import re
+import socket
+import struct
+import uuid
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+from typing_extensions import Self
+
+from . import protocol
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+
+class PostgresError(RuntimeError):
+    """An error reported by the server. `fields` holds the fields of the ErrorResponse (code, message, detail, ...)."""
+
+    def __init__(self, fields: dict[str, str]):
+        self.fields = fields
+        self.code = fields.get('code')
+        super().__init__(f'{fields.get("severity", "ERROR")}: {fields.get("message", "")} ({self.code})')
+
+
+_TIMESTAMP_RE = re.compile(r'(\d{4}-\d\d-\d\d) (\d\d:\d\d:\d\d)(?:\.(\d+))?([+-]\d\d(?::\d\d){0,2})?')
+
+
+def _parse_timestamp(value: str) -> dt.datetime | str:
+    # datetime.fromisoformat in Python 3.10 requires 3 or 6 fractional digits and a tz offset with minutes
+    match = _TIMESTAMP_RE.fullmatch(value)
+    if match is None:  # eg 'infinity' or BC dates
+        return value
+    date_part, time_part, fraction, tz = match.groups()
+    normalized = f'{date_part} {time_part}.{(fraction or "").ljust(6, "0")}'
+    if tz is not None:
+        normalized += tz if ':' in tz else f'{tz}:00'
+    return dt.datetime.fromisoformat(normalized)
+
+
+def _parse_date(value: str) -> dt.date | str:
+    try:
+        return dt.date.fromisoformat(value)
+    except ValueError:  # eg 'infinity' or BC dates
+        return value
+
+
+# text-format decoders by type oid (see pg_type.dat)
+_DECODERS: dict[int, Callable[[str], Any]] = {
+    16: lambda v: v == 't',  # bool
+    17: lambda v: bytes.fromhex(v[2:]),  # bytea (hex format)
+    20: int,  # int8
+    21: int,  # int2
+    23: int,  # int4
+    26: int,  # oid
+    114: json.loads,  # json
+    700: float,  # float4
+    701: float,  # float8
+    1082: _parse_date,  # date
+    1114: _parse_timestamp,  # timestamp
+    1184: _parse_timestamp,  # timestamptz
+    1700: decimal.Decimal,  # numeric
+    2950: uuid.UUID,  # uuid
+    3802: json.loads,  # jsonb
+}
+
+
+def encode_param(value: Any) -> bytes | None:
+    """Encodes a query parameter in text format; None is NULL."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return b't' if value else b'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b'\\x' + bytes(value).hex().encode()
+    if isinstance(value, (dict, list)):
+        # json; a list of numbers is also the text format of a pgvector vector
+        return json.dumps(value).encode()
+    if isinstance(value, (dt.date, dt.time)):
+        return value.isoformat().encode()
+    return str(value).encode()
+
+
+def quote_ident(name: str) -> str:
+    """Quotes an identifier (eg a database name) for use in sql."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+class Connection:
+    """A connection to the server at `address` (a unix socket path, or a (host, port) tuple).
+    Not thread-safe; use one connection per thread.
+    """
+
+    def __init__(self, address: Path | tuple[str, int], user: str = 'postgres', database: str | None = None):
+        if isinstance(address, Path):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(str(address))
+        else:
+            self._sock = socket.create_connection(address)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        self.parameters: dict[str, str] = {}
+        self.columns: list[str] = []  # column names of the most recent result
+        self._busy = False  # a streamed result has not been consumed entirely
+
+        params = {'user': user, 'database': database or user, 'client_encoding': 'UTF8'}
+        self._sock.sendall(protocol.startup_message(params))
+        for msg_type, payload in self._read_until_ready():
+            if msg_type == b'R' and struct.unpack('!i', payload[:4])[0] != 0:
+                self.close()
+                raise ConnectionError(f'Unsupported authentication request: {struct.unpack("!i", payload[:4])[0]}')
+
+    def execute(self, sql: str, params: Sequence[Any] | None = None) -> list[tuple]:
+        """Runs sql (with $1, $2, ... placeholders for params) and returns all result rows.
+        Without params, sql may contain several statements; the rows of all of them are returned.
+        """
+        return list(self.stream(sql, params))
+
+    def stream(self, sql: str, params: Sequence[Any] | None = None) -> Iterator[tuple]:
+        """Like execute(), but yields rows as they arrive from the server, without buffering the result.
+        A result that is abandoned before the end is discarded on the next use of the connection.
+        """
+        self._drain()
+        if params is None:
+            self._sock.sendall(protocol.message(b'Q', protocol.cstring(sql)))
+        else:
+            self._send_extended(sql, params)
+        self._busy = True
+        decoders: list[Callable[[str], Any] | None] = []
+        for msg_type, payload in self._read_until_ready():
+            if msg_type == b'T':
+                self.columns, decoders = self._parse_row_description(payload)
+            elif msg_type == b'D':
+                yield self._parse_data_row(payload, decoders)
+
+    def copy_in(self, sql: str, chunks: Iterable[bytes]) -> int:
+        """Runs a COPY ... FROM STDIN statement, sending `chunks` as its data as they are produced.
+        Returns the number of rows copied. If producing the chunks raises, the COPY is aborted and the error re-raised.
+        """
+        self._drain()
+        self._sock.sendall(protocol.message(b'Q', protocol.cstring(sql)))
+        self._busy = True
+        count = 0
+        for msg_type, payload in self._read_until_ready(copy_data=chunks):
+            if msg_type == b'C':  # CommandComplete: 'COPY <rows>'
+                count = int(payload.rstrip(b'\x00').split()[-1])
+        return count
+
+    def close(self) -> None:
+        if self._sock.fileno() != -1:
+            try:
+                self._sock.sendall(protocol.message(b'X'))
+            except OSError:
+                pass
+            self._reader.close()
+            self._sock.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._sock.fileno() == -1
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc_val: BaseException | None, exc_tb: TracebackType | None
+    ) -> None:
+        self.close()
+
+    def _send_extended(self, sql: str, params: Sequence[Any]) -> None:
+        """Sends an unnamed Parse/Bind/Describe/Execute/Sync sequence, with all parameters in text format."""
+        encoded = [encode_param(p) for p in params]
+        bind = b'\x00\x00' + struct.pack('!hh', 0, len(encoded))  # unnamed portal and statement, text formats
+        for value in encoded:
+            bind += struct.pack('!i', -1) if value is None else struct.pack('!i', len(value)) + value
+        bind += struct.pack('!h', 0)  # text result formats
+        self._sock.sendall(
+            protocol.message(b'P', b'\x00' + protocol.cstring(sql) + struct.pack('!h', 0))
+            + protocol.message(b'B', bind)
+            + protocol.message(b'D', b'P\x00')
+            + protocol.message(b'E', b'\x00' + struct.pack('!i', 0))
+            + protocol.message(b'S')
+        )
+
+    def _read_message(self) -> tuple[bytes, bytes]:
+        header = self._reader.read(5)
+        if len(header) < 5:
+            self.close()
+            raise ConnectionError('server closed the connection unexpectedly')
+        (length,) = struct.unpack('!i', header[1:])
+        return header[:1], self._reader.read(length - 4)
+
+    def _read_until_ready(self, copy_data: Iterable[bytes] | None = None) -> Iterator[tuple[bytes, bytes]]:
+        """Yields the messages of one response, up to ReadyForQuery. Errors are raised at the end of the response,
+        so the connection remains usable. `copy_data` is sent if the server requests COPY FROM STDIN data.
+        A fatal error (eg a rejected startup) is followed by the server closing the connection; it is raised then.
+        """
+        error: dict[str, str] | None = None
+        while True:
+            try:
+                msg_type, payload = self._read_message()
+            except ConnectionError:
+                if error is None:
+                    raise
+                raise PostgresError(error) from None
+            if msg_type == b'Z':
+                self._busy = False
+                break
+            if msg_type == b'E':
+                error = protocol.parse_error_fields(payload)
+            elif msg_type == b'N':
+                _logger.info(f'postgres notice: {protocol.parse_error_fields(payload).get("message")}')
+            elif msg_type == b'S':
+                name, value = payload.split(b'\x00')[:2]
+                self.parameters[name.decode()] = value.decode()
+            elif msg_type == b'G':  # CopyInResponse
+                self._send_copy_data(copy_data)
+            else:
+                yield msg_type, payload
+        if error is not None:
+            raise PostgresError(error)
+
+    def _send_copy_data(self, chunks: Iterable[bytes] | None) -> None:
+        if chunks is None:
+            self._sock.sendall(protocol.message(b'f', protocol.cstring('COPY FROM STDIN requires copy_in()')))
+            return
+        try:
+            for chunk in chunks:
+                self._sock.sendall(protocol.message(b'd', chunk))
+        except Exception as exc:
+            # the server's response to CopyFail is read by the next use of the connection
+            self._sock.sendall(protocol.message(b'f', protocol.cstring(f'aborted by the client: {exc}')))
+            raise
+        self._sock.sendall(protocol.message(b'c'))
+
+    def _drain(self) -> None:
+        if self._busy:
+            try:
+                for _ in self._read_until_ready():
+                    pass
+            except PostgresError:
+                pass  # reported by nobody, as the result was abandoned
+
+    @staticmethod
+    def _parse_row_description(payload: bytes) -> tuple[list[str], list[Callable[[str], Any] | None]]:
+        (n_fields,) = struct.unpack('!h', payload[:2])
+        pos = 2
+        names: list[str] = []
+        decoders: list[Callable[[str], Any] | None] = []
+        for _ in range(n_fields):
+            end = payload.index(b'\x00', pos)
+            names.append(payload[pos:end].decode())
+            # table oid (int32), column number (int16), type oid (int32), size (int16), modifier (int32), format
+            (type_oid,) = struct.unpack('!i', payload[end + 7 : end + 11])
+            decoders.append(_DECODERS.get(type_oid))
+            pos = end + 19
+        return names, decoders
+
+    @staticmethod
+    def _parse_data_row(payload: bytes, decoders: list[Callable[[str], Any] | None]) -> tuple:
+        (n_values,) = struct.unpack('!h', payload[:2])
+        pos = 2
+        row: list[Any] = []
+        for i in range(n_values):
+            (length,) = struct.unpack('!i', payload[pos : pos + 4])
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            value = payload[pos : pos + length].decode()
+            pos += length
+            decoder = decoders[i]
+            row.append(value if decoder is None else decoder(value))
+        return tuple(row)
@@ -0,0 +1,415 @@
+"""Transaction-level connection pooler for the embedded server.
+
+Clients connect to the pooler's unix domain socket as they would to postgres. Server connections ("backends") are
+only assigned to a client for the duration of a transaction, and returned to the pool once the server reports
+the connection idle, so many client connections share at most `max_backends` server connections. Clients that
+need a backend while all of them are busy are queued.
+
+As with other transaction poolers, session state (SET, prepared statements, advisory locks, LISTEN, temporary
+tables) does not carry over from one transaction to the next.
+
+The pooler runs as a separate process managed by PostgresServer:
+    python -m pixeltable_pgserver.pooler --listen SOCKET --upstream SOCKET --max-backends N --stats FILE
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import secrets
+import signal
+import struct
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Any
+
+import psutil
+
+from . import protocol
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+# port number in the name of the pooler's socket (.s.PGSQL.6432), as is conventional for poolers
+POOLER_PORT = 6432
+
+# messages after which the server sends ReadyForQuery: simple Query, Sync, FunctionCall
+_SYNC_MESSAGES = (b'Q', b'S', b'F')
+
+PoolKey = tuple[tuple[str, str], ...]
+
+
+async def _read_message(reader: asyncio.StreamReader) -> tuple[bytes, bytes]:
+    """Reads one message; returns its type and the raw message (including type and length)."""
+    header = await reader.readexactly(5)
+    (length,) = struct.unpack('!i', header[1:])
+    return header[:1], header + await reader.readexactly(length - 4)
+
+
+class _Backend:
+    """A server connection, authenticated for a given set of startup parameters."""
+
+    def __init__(self, key: PoolKey, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.parameters: list[bytes] = []  # raw ParameterStatus messages
+        self.pid = 0
+        self.secret = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.writer.write(protocol.message(b'X'))
+            self.writer.close()
+
+
+class Pool:
+    """Bounded set of backends shared by all clients, keyed by startup parameters."""
+
+    def __init__(self, upstream: str, max_backends: int):
+        self.upstream = upstream
+        self.max_backends = max_backends
+        self._idle: dict[PoolKey, list[_Backend]] = collections.defaultdict(list)
+        self._waiters: collections.deque[tuple[PoolKey, asyncio.Future]] = collections.deque()
+        self.parameters: dict[PoolKey, list[bytes]] = {}
+        self.total = 0  # open backends, including those being connected
+        self.busy = 0  # backends assigned to a client
+        self.peak_busy = 0
+        self.acquires = 0
+        self.waits = 0  # acquires that had to queue
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    async def acquire(self, key: PoolKey) -> _Backend:
+        start = time.monotonic()
+        waited = False
+        while True:
+            backend = self._pop_idle(key)
+            if backend is None and self.total < self.max_backends:
+                self.total += 1
+                try:
+                    backend = await self._connect(key)
+                except BaseException:
+                    self.total -= 1
+                    self._wake_next()
+                    raise
+            elif backend is None and self._close_idle_of_other_key(key):
+                continue
+            elif backend is None:
+                waited = True
+                fut = asyncio.get_running_loop().create_future()
+                self._waiters.append((key, fut))
+                try:
+                    backend = await fut
+                except asyncio.CancelledError:
+                    self._abandon(key, fut)
+                    raise
+                if backend is None:  # a slot was freed up; try again
+                    continue
+            break
+
+        elapsed = time.monotonic() - start
+        self.acquires += 1
+        if waited:
+            self.waits += 1
+            self.wait_time_total += elapsed
+            self.wait_time_max = max(self.wait_time_max, elapsed)
+        self.busy += 1
+        self.peak_busy = max(self.peak_busy, self.busy)
+        return backend
+
+    def release(self, backend: _Backend, reusable: bool = True) -> None:
+        self.busy -= 1
+        if reusable and not backend.closed:
+            while self._waiters:
+                key, fut = self._waiters.popleft()
+                if fut.done():
+                    continue
+                if key == backend.key:
+                    fut.set_result(backend)
+                    return
+                # the oldest waiter needs different parameters: make room for it
+                self._waiters.appendleft((key, fut))
+                break
+            else:
+                self._idle[backend.key].append(backend)
+                return
+
+        backend.close()
+        self.total -= 1
+        self._wake_next()
+
+    def close(self) -> None:
+        for backends in self._idle.values():
+            for backend in backends:
+                backend.close()
+        self._idle.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'max_backends': self.max_backends,
+            'backends': self.total,
+            'busy': self.busy,
+            'idle': sum(len(backends) for backends in self._idle.values()),
+            'waiting': sum(1 for _, fut in self._waiters if not fut.done()),
+            'saturation': self.busy / self.max_backends,
+            'peak_busy': self.peak_busy,
+            'acquires': self.acquires,
+            'waits': self.waits,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+            'wait_time_mean': self.wait_time_total / self.waits if self.waits > 0 else 0.0,
+        }
+
+    def _pop_idle(self, key: PoolKey) -> _Backend | None:
+        idle = self._idle.get(key)
+        while idle:
+            backend = idle.pop()
+            if not backend.closed:
+                return backend
+            self.total -= 1
+        return None
+
+    def _close_idle_of_other_key(self, key: PoolKey) -> bool:
+        for other_key, idle in self._idle.items():
+            if other_key != key and idle:
+                idle.pop().close()
+                self.total -= 1
+                return True
+        return False
+
+    def _abandon(self, key: PoolKey, fut: asyncio.Future) -> None:
+        """Called when a waiting client goes away: passes on whatever was handed to it."""
+        if not fut.done() or fut.cancelled():
+            with suppress(ValueError):
+                self._waiters.remove((key, fut))
+        elif fut.result() is not None:
+            self.busy += 1  # release() expects a busy backend
+            self.release(fut.result())
+        else:
+            self._wake_next()
+
+    def _wake_next(self) -> None:
+        """Wakes the oldest waiter without a backend, so that it can open a new one."""
+        while self._waiters:
+            _, fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    async def _connect(self, key: PoolKey) -> _Backend:
+        reader, writer = await asyncio.open_unix_connection(self.upstream)
+        backend = _Backend(key, reader, writer)
+        writer.write(protocol.startup_message(dict(key)))
+        await writer.drain()
+        while True:
+            msg_type, raw = await _read_message(reader)
+            if msg_type == b'R':
+                (auth_type,) = struct.unpack('!i', raw[5:9])
+                if auth_type != 0:
+                    writer.close()
+                    raise ConnectionError(f'Unsupported authentication request from server: {auth_type}')
+            elif msg_type == b'S':
+                backend.parameters.append(raw)
+            elif msg_type == b'K':
+                backend.pid, backend.secret = struct.unpack('!ii', raw[5:13])
+            elif msg_type == b'E':
+                writer.close()
+                raise ConnectionError(protocol.parse_error_fields(raw[5:]).get('message', 'connection failed'))
+            elif msg_type == b'Z':
+                break
+        self.parameters.setdefault(key, backend.parameters)
+        return backend
+
+
+class _Session:
+    """A client connection."""
+
+    def __init__(self, key: PoolKey, writer: asyncio.StreamWriter):
+        self.key = key
+        self.writer = writer
+        self.backend: _Backend | None = None
+        self.forwarder: asyncio.Task | None = None
+        self.pending = 0  # ReadyForQuery messages still expected from the backend
+        self.unsynced = False  # messages were sent to the backend after the last sync point
+
+
+class Pooler:
+    def __init__(self, listen: Path, upstream: Path, max_backends: int, stats_path: Path | None = None):
+        self.listen = listen
+        self.pool = Pool(str(upstream), max_backends)
+        self.stats_path = stats_path
+        self.clients = 0
+        self.transactions = 0
+        self._sessions: dict[tuple[int, int], _Session] = {}  # by the BackendKeyData handed to the client
+
+    def stats(self) -> dict[str, Any]:
+        return {'clients': self.clients, 'transactions': self.transactions, **self.pool.stats()}
+
+    async def serve(self, postmaster_pid: int | None = None, stats_interval: float = 1.0) -> None:
+        """Serves clients until cancelled, or until the postmaster with the given pid exits."""
+        server = await asyncio.start_unix_server(self._handle_client, path=str(self.listen))
+        self.listen.chmod(0o777)
+        _logger.info(f'Pooler listening on {self.listen} (max_backends={self.pool.max_backends})')
+        try:
+            while postmaster_pid is None or psutil.pid_exists(postmaster_pid):
+                self._write_stats()
+                await asyncio.sleep(stats_interval)
+            _logger.info(f'Postmaster {postmaster_pid} exited; stopping pooler')
+        finally:
+            server.close()
+            self.pool.close()
+            self.listen.unlink(missing_ok=True)
+
+    def _write_stats(self) -> None:
+        if self.stats_path is None:
+            return
+        tmp_path = self.stats_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'time': time.time(), **self.stats()}))
+        os.replace(tmp_path, self.stats_path)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.clients += 1
+        try:
+            await self._run_client(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _run_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        params = await self._read_startup(reader, writer)
+        if params is None:
+            return
+        key = tuple(sorted((k, v) for k, v in params.items() if k != 'application_name'))
+        if key not in self.pool.parameters:
+            try:
+                backend = await self.pool.acquire(key)
+            except (OSError, ConnectionError) as exc:
+                writer.write(protocol.error_response(str(exc)))
+                return
+            self.pool.release(backend)
+
+        session = _Session(key, writer)
+        client_key = (secrets.randbits(31), secrets.randbits(31))
+        self._sessions[client_key] = session
+        try:
+            writer.write(
+                protocol.message(b'R', struct.pack('!i', 0))  # AuthenticationOk
+                + b''.join(self.pool.parameters[key])
+                + protocol.message(b'K', struct.pack('!ii', *client_key))
+                + protocol.message(b'Z', b'I')
+            )
+            await writer.drain()
+            await self._serve_session(session, reader)
+        finally:
+            del self._sessions[client_key]
+            if session.forwarder is not None:
+                session.forwarder.cancel()
+            if session.backend is not None:
+                # the client went away in the middle of a transaction: the backend state is unknown
+                self.pool.release(session.backend, reusable=False)
+
+    async def _read_startup(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> dict[str, str] | None:
+        while True:
+            (length,) = struct.unpack('!i', await reader.readexactly(4))
+            payload = await reader.readexactly(length - 4)
+            (code,) = struct.unpack('!i', payload[:4])
+            if code in (protocol.SSL_REQUEST_CODE, protocol.GSSENC_REQUEST_CODE):
+                writer.write(b'N')  # not supported; the client continues unencrypted
+                await writer.drain()
+            elif code == protocol.CANCEL_REQUEST_CODE:
+                await self._forward_cancel(struct.unpack('!ii', payload[4:12]))
+                return None
+            elif code == protocol.PROTOCOL_VERSION:
+                return protocol.parse_startup_parameters(payload[4:])
+            else:
+                writer.write(protocol.error_response(f'Unsupported protocol version {code}', code='0A000'))
+                return None
+
+    async def _forward_cancel(self, client_key: tuple[int, int]) -> None:
+        session = self._sessions.get(client_key)
+        if session is None or session.backend is None:
+            return
+        _, writer = await asyncio.open_unix_connection(self.pool.upstream)
+        writer.write(protocol.cancel_request(session.backend.pid, session.backend.secret))
+        await writer.drain()
+        writer.close()
+
+    async def _serve_session(self, session: _Session, reader: asyncio.StreamReader) -> None:
+        while True:
+            msg_type, raw = await _read_message(reader)
+            if msg_type == b'X':  # Terminate
+                return
+            if session.backend is None:
+                session.backend = await self.pool.acquire(session.key)
+                session.forwarder = asyncio.create_task(self._forward(session, session.backend))
+            # no await between the check above and these updates, so the forwarder cannot release the backend
+            session.backend.writer.write(raw)
+            if msg_type in _SYNC_MESSAGES:
+                session.pending += 1
+                session.unsynced = False
+            else:
+                session.unsynced = True
+            await session.backend.writer.drain()
+
+    async def _forward(self, session: _Session, backend: _Backend) -> None:
+        """Forwards backend messages to the client, until the backend can be returned to the pool."""
+        try:
+            await self._relay(session, backend)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # either side went away; closing the client ends its session, which discards the backend
+            if backend.closed or backend.reader.at_eof():
+                session.writer.write(protocol.error_response('server closed the connection unexpectedly'))
+            session.writer.close()
+
+    async def _relay(self, session: _Session, backend: _Backend) -> None:
+        while True:
+            msg_type, raw = await _read_message(backend.reader)
+            session.writer.write(raw)
+            if msg_type == b'Z':
+                session.pending -= 1
+                if raw[5:6] == b'I' and session.pending == 0 and not session.unsynced:
+                    session.backend = None
+                    session.forwarder = None
+                    self.transactions += 1
+                    self.pool.release(backend)
+                    await session.writer.drain()
+                    return
+            await session.writer.drain()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Transaction-level connection pooler for pixeltable_pgserver')
+    parser.add_argument('--listen', type=Path, required=True, help='unix socket path to listen on')
+    parser.add_argument('--upstream', type=Path, required=True, help='unix socket path of the postgres server')
+    parser.add_argument('--max-backends', type=int, required=True)
+    parser.add_argument('--stats', type=Path, help='file to which pool statistics are written periodically')
+    parser.add_argument('--postmaster-pid', type=int, help='exit when this process exits')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    pooler = Pooler(args.listen, args.upstream, args.max_backends, args.stats)
+
+    async def _serve() -> None:
+        task = asyncio.create_task(pooler.serve(args.postmaster_pid))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            _logger.info('Pooler stopped')
+
+    asyncio.run(_serve())
+
+
+if __name__ == '__main__':
+    main()
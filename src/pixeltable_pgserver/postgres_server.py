@@ -1,26 +1,55 @@
+import asyncio
 import atexit
+import dataclasses
+import hashlib
+import json
 import logging
 import os
 import platform
 import shutil
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
 import time
-from contextlib import suppress
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
 from pathlib import Path
 from types import TracebackType
-from typing import Any, ClassVar
+from typing import IO, TYPE_CHECKING, Any, AsyncIterator, ClassVar, Iterable, Iterator, Sequence
 
-import fasteners  # type: ignore[import-untyped]
-import platformdirs
 import psutil
 from typing_extensions import Self
 
+from .bulk import encode_copy_data
+from .client import Connection, quote_ident
 from .pgexec import pgexec
-from .utils import POSTGRES_BIN_PATH, DiskList, PostmasterInfo, find_suitable_port, find_suitable_socket_dir
+from .pooler import POOLER_PORT
+from .profiles import PROFILES, configured_setting, write_tuning_conf
+from .serverlog import LogTail, log_settings, prune_log_files, read_tail
+from .snapshot import save_snapshot, snapshot_path
+from .template import ensure_template, init_from_template, initdb_args
+from .timings import Span, Timings
+from .utils import (
+    POSTGRES_BIN_PATH,
+    HandleRegistry,
+    PostmasterInfo,
+    PostmasterRecord,
+    compression_available,
+    extension_available,
+    find_suitable_port,
+    find_suitable_socket_dir,
+    wait_for_postmaster_ready,
+    wait_for_process_exit,
+)
+from .watchdog import Watchdog
+
+if TYPE_CHECKING:
+    import fasteners  # type: ignore[import-untyped]
 
 if platform.system() != 'Windows':
-    from .utils import ensure_folder_permissions, ensure_prefix_permissions, ensure_user_exists
+    from .utils import ensure_folder_permissions, ensure_owned_by, ensure_prefix_permissions, ensure_user_exists
 
 _logger = logging.getLogger('pixeltable_pgserver')
 
@@ -28,52 +57,424 @@ _logger = logging.getLogger('pixeltable_pgserver')
 CREATE_NEW_PROCESS_GROUP = 0x00000200
 CREATE_NO_WINDOW = 0x08000000
 
+# postmaster signals for the shutdown modes of `pg_ctl stop -m` (see the "Shutting Down the Server" docs)
+SHUTDOWN_SIGNALS = {'smart': 'SIGTERM', 'fast': 'SIGINT', 'immediate': 'SIGQUIT'}
+
+# sort orders of query_stats(), by the pg_stat_statements column
+QUERY_STATS_ORDER = {
+    'total_time': 'total_exec_time',
+    'mean_time': 'mean_exec_time',
+    'calls': 'calls',
+    'rows': 'rows',
+    'shared_blks_hit': 'shared_blks_hit',
+    'shared_blks_read': 'shared_blks_read',
+}
+
+# the PostgresServer locks held by the current thread or task, by pgdata (None for the global lock); propagated into
+# asyncio.to_thread() workers
+_locks_held: ContextVar[frozenset[Path | None]] = ContextVar('_locks_held', default=frozenset())
+
+# the PostgresServer class attributes resolved by _init_paths()
+SHARED_PATHS = ('runtime_path', 'lock_path', 'locks_path', 'postmasters_path', 'templates_path', 'snapshots_path')
+
+
+@dataclasses.dataclass(frozen=True)
+class ServerHandle:
+    """A compact, picklable description of a running server (see PostgresServer.export_handle()), from which worker
+    processes attach cheaply with attach_server().
+    """
+
+    pgdata: Path
+    # contents of postmaster.pid, and the identity (st_dev, st_ino) of the file; postmaster.pid is created anew by
+    # each postmaster, so an unchanged identity means the same postmaster
+    postmaster_lines: tuple[str, ...]
+    postmaster_file_id: tuple[int, int]
+    system_user: str | None
+    # the arguments of get_server(), for starting the server if it is no longer running
+    options: dict[str, Any]
+    # the shared paths of PostgresServer (see _init_paths()), so that workers use the same locks as the exporting
+    # process even if it changed them, and need not resolve them
+    shared_paths: dict[str, Path]
+
 
 class PostgresServer:
     """Provides a common interface for interacting with a server."""
 
     _instances: ClassVar[dict[Path, 'PostgresServer']] = {}
 
-    runtime_path: Path = platformdirs.user_runtime_path('python_PostgresServer')
-    if not runtime_path.exists():
-        # On some Linux systems, this directory does not necessarily exist, and there is no obvious way to create it
-        # at this time. Fall back on the temporary directory.
-        runtime_path = Path(tempfile.gettempdir())
-    lock_path = runtime_path / '.lockfile'
-    _lock = fasteners.InterProcessLock(lock_path)
+    # The paths below are resolved, and the global lock created, on first use (see _init_paths()), so that importing
+    # the package has no side effects. Paths that are set before then (eg by tests) are kept.
+    runtime_path: ClassVar[Path | None] = None
+    # the global lock, for resources shared by all servers (eg socket dirs in runtime_path); each pgdata has its own
+    # lock in locks_path, so that independent servers start and stop in parallel. When both are needed, the pgdata
+    # lock is acquired first.
+    lock_path: ClassVar[Path | None] = None
+    locks_path: ClassVar[Path | None] = None
+    # the last postmaster of each pgdata, for finding left-over servers of a deleted pgdata (see _kill_stale_servers())
+    postmasters_path: ClassVar[Path | None] = None
+    _lock: ClassVar['fasteners.InterProcessLock | None'] = None
+    # InterProcessLock is not thread-safe (file locks are held per process), so threads also serialize on this
+    _thread_lock = threading.Lock()
+    _pgdata_locks: ClassVar[dict[Path, 'tuple[threading.Lock, fasteners.InterProcessLock]']] = {}
+    _pgdata_locks_guard = threading.Lock()
+
+    # RAM-backed file system used for servers created with tmpfs_size
+    tmpfs_path: Path = Path('/dev/shm')
+
+    # pre-initialized template clusters, copied into new pgdata directories instead of running initdb
+    templates_path: ClassVar[Path | None] = None
 
-    def __init__(self, pgdata: Path, *, cleanup_mode: str | None = 'stop'):
+    # named copies of pgdata directories taken with snapshot()
+    snapshots_path: ClassVar[Path | None] = None
+
+    def __init__(
+        self,
+        pgdata: Path,
+        *,
+        cleanup_mode: str | None = 'stop',
+        use_template: bool = True,
+        start_mode: str = 'pg_ctl',
+        shutdown_mode: str = 'fast',
+        pool_size: int | None = None,
+        profile: str | None = None,
+        tmpfs_size: int | None = None,
+        from_snapshot: str | None = None,
+        watchdog_interval: float | None = None,
+        background_cleanup: bool = False,
+        structured_log: bool = False,
+        slow_query_ms: int | None = None,
+        handle: ServerHandle | None = None,
+    ):
         """Initializes the postgresql server instance.
         Constructor is intended to be called directly, use get_server() instead.
+        If `handle` is given and its server is still running, the server is attached to without being inspected or
+        initialized (see attach_server()).
         """
-        assert cleanup_mode in (None, 'stop', 'delete')
-
+        self._check_options(
+            cleanup_mode=cleanup_mode,
+            start_mode=start_mode,
+            shutdown_mode=shutdown_mode,
+            pool_size=pool_size,
+            profile=profile,
+            tmpfs_size=tmpfs_size,
+            watchdog_interval=watchdog_interval,
+            background_cleanup=background_cleanup,
+            structured_log=structured_log,
+            slow_query_ms=slow_query_ms,
+        )
+        self._init_paths()
         self.pgdata = pgdata
+        self.use_template = use_template
+        self.start_mode = start_mode
+        self.shutdown_mode = shutdown_mode
+        self.pool_size = pool_size
+        self.tmpfs_size = tmpfs_size
+        self.from_snapshot = from_snapshot
+        self.background_cleanup = background_cleanup
+        self.structured_log = structured_log
+        self.slow_query_ms = slow_query_ms
+        # data on tmpfs is not durable anyway, so default to durability-off settings
+        self.profile = 'ephemeral-test' if profile is None and tmpfs_size is not None else profile
         self.log = self.pgdata / 'log'
+        self.pooler_log = self.pgdata / 'pooler.log'
 
         # postgres user name, NB not the same as system user name
         self.system_user = None
 
         # note os.geteuid() is not available on windows, so must go after
-        if platform.system() != 'Windows' and os.geteuid() == 0:
+        if handle is not None:
+            self.system_user = handle.system_user
+        elif platform.system() != 'Windows' and os.geteuid() == 0:
             # running as root
             # need a different system user to run as
             self.system_user = 'pgserver'
             ensure_user_exists(self.system_user)
 
         self.postgres_user = 'postgres'
-        list_path = self.pgdata / '.handle_pids.json'
-        self.global_process_id_list = DiskList(list_path)
+        # the processes using this server; the last one to detach stops it (per cleanup_mode)
+        self.handles = HandleRegistry(self.pgdata / '.handles')
+        self.postmaster_record = PostmasterRecord(self.postmasters_path, self.pgdata)
         self.cleanup_mode = cleanup_mode
         self._postmaster_info: PostmasterInfo | None = None
+        # the postmaster process, if it was spawned by this handle with start_mode='direct'
+        self._postmaster_popen: subprocess.Popen | None = None
+        # the pooler process, if it was spawned by this handle
+        self._pooler_popen: subprocess.Popen | None = None
+        # seconds between launching the server and postmaster.pid reporting it ready; None if already running
+        self.readiness_latency: float | None = None
+        # time spent in each phase of starting and stopping the server (see timings.PHASES)
+        self.timings = Timings(self.pgdata)
+        # persistent connections of query(), by (pid, thread id, database)
+        self._connections: dict[tuple[int, int, str], Connection] = {}
+        self._query_stats_ready = False
         self._count = 0
+        # restarts the server if its postmaster dies; None unless watchdog_interval is set
+        self.watchdog: Watchdog | None = None
 
         atexit.register(self._cleanup)
-        with self._lock:
+        with self._locked_timed():
+            if handle is not None and not self.pgdata.exists():
+                atexit.unregister(self._cleanup)
+                raise FileNotFoundError(f'{self.pgdata} no longer exists; its server was deleted')
             self._instances[self.pgdata] = self
-            self.ensure_pgdata_inited()
-            self.ensure_postgres_running()
-            self.global_process_id_list.get_and_add(os.getpid())
+            try:
+                if handle is None or not self._attach_from_handle(handle):
+                    self.ensure_pgdata_inited()
+                    self.ensure_postgres_running()
+                    if self.pool_size is not None:
+                        self.ensure_pooler_running()
+            except BaseException:
+                # don't hand out this broken instance from get_server()
+                del self._instances[self.pgdata]
+                atexit.unregister(self._cleanup)
+                raise
+            self.handles.attach()
+        if 'multiprocessing' in sys.modules:  # not imported otherwise, as it is not needed then
+            import multiprocessing
+            from multiprocessing import util
+
+            if multiprocessing.parent_process() is not None:
+                # multiprocessing children exit with os._exit(), skipping atexit; its own exit hooks do run
+                util.Finalize(None, self._cleanup, exitpriority=0)
+        if watchdog_interval is not None:
+            self.watchdog = Watchdog(self, watchdog_interval)
+            self.watchdog.start()
+
+    @staticmethod
+    def _check_options(
+        cleanup_mode: str | None = 'stop',
+        start_mode: str = 'pg_ctl',
+        shutdown_mode: str = 'fast',
+        pool_size: int | None = None,
+        profile: str | None = None,
+        tmpfs_size: int | None = None,
+        watchdog_interval: float | None = None,
+        background_cleanup: bool = False,
+        structured_log: bool = False,
+        slow_query_ms: int | None = None,
+    ) -> None:
+        """Raises if the options of get_server() are invalid; called before anything is created on disk."""
+        assert cleanup_mode in (None, 'stop', 'delete')
+        assert start_mode in ('pg_ctl', 'direct')
+        assert shutdown_mode in SHUTDOWN_SIGNALS
+        assert pool_size is None or pool_size > 0
+        if profile is not None and profile not in PROFILES:
+            raise ValueError(f'Unknown profile {profile!r}; expected one of {PROFILES}')
+        if tmpfs_size is not None and cleanup_mode != 'delete':
+            raise ValueError("tmpfs_size requires cleanup_mode='delete', since the data does not survive a reboot")
+        if start_mode == 'direct' and platform.system() == 'Windows':
+            raise NotImplementedError("start_mode='direct' is not supported on Windows")
+        if pool_size is not None and platform.system() == 'Windows':
+            raise NotImplementedError('The connection pooler is not supported on Windows')
+        if background_cleanup and platform.system() == 'Windows':
+            raise NotImplementedError('background_cleanup is not supported on Windows')
+        if watchdog_interval is not None and watchdog_interval <= 0:
+            raise ValueError(f'watchdog_interval must be positive, got {watchdog_interval}')
+        if slow_query_ms is not None and not structured_log:
+            raise ValueError('slow_query_ms requires structured_log=True')
+
+    @classmethod
+    def _init_paths(cls) -> None:
+        """Resolves the paths shared by all servers that are not set (or were reset to None), and creates the global
+        lock.
+        """
+        paths_set = all(getattr(cls, name) is not None for name in SHARED_PATHS)
+        if cls._lock is not None and paths_set:
+            return
+        import fasteners
+
+        with cls._pgdata_locks_guard:
+            if cls._lock is None and paths_set:  # eg set by attach_server()
+                cls._lock = fasteners.InterProcessLock(cls.lock_path)
+                return
+            import platformdirs
+
+            if cls.runtime_path is None:
+                runtime_path = platformdirs.user_runtime_path('python_PostgresServer')
+                if not runtime_path.exists():
+                    # On some Linux systems, this directory does not necessarily exist, and there is no obvious way to
+                    # create it at this time. Fall back on the temporary directory.
+                    runtime_path = Path(tempfile.gettempdir())
+                cls.runtime_path = runtime_path
+            cls.lock_path = cls.lock_path or cls.runtime_path / '.lockfile'
+            cls.locks_path = cls.locks_path or cls.runtime_path / 'pgdata_locks'
+            cls.postmasters_path = cls.postmasters_path or cls.runtime_path / 'postmasters'
+            cls.templates_path = (
+                cls.templates_path or platformdirs.user_cache_path('python_PostgresServer') / 'templates'
+            )
+            cls.snapshots_path = (
+                cls.snapshots_path or platformdirs.user_data_path('python_PostgresServer') / 'snapshots'
+            )
+            if cls._lock is None:
+                cls._lock = fasteners.InterProcessLock(cls.lock_path)
+
+    @classmethod
+    def _get_locks(cls, pgdata: Path | None) -> 'tuple[threading.Lock, fasteners.InterProcessLock]':
+        """Returns the thread and inter-process locks of pgdata, or the global ones if pgdata is None."""
+        cls._init_paths()
+        if pgdata is None:
+            return cls._thread_lock, cls._lock
+        import fasteners
+
+        with cls._pgdata_locks_guard:
+            if pgdata not in cls._pgdata_locks:
+                lock = fasteners.InterProcessLock(cls._lock_file(pgdata))
+                cls._pgdata_locks[pgdata] = (threading.Lock(), lock)
+            return cls._pgdata_locks[pgdata]
+
+    @classmethod
+    def _lock_file(cls, pgdata: Path) -> Path:
+        """The file of the inter-process lock of pgdata."""
+        cls._init_paths()
+        assert cls.locks_path is not None
+        # not in pgdata itself, which cleanup_mode='delete' removes while others may wait for the lock
+        name = hashlib.sha256(str(pgdata).encode()).hexdigest()[:16]
+        return cls.locks_path / f'{name}.lock'
+
+    @classmethod
+    @contextmanager
+    def _locked(cls, pgdata: Path | None = None) -> Iterator[None]:
+        """Holds the lock of pgdata (or the global lock if pgdata is None) across threads and processes.
+        A no-op if the current context already holds it.
+        """
+        held = _locks_held.get()
+        if pgdata in held:
+            yield
+            return
+        thread_lock, process_lock = cls._get_locks(pgdata)
+        with thread_lock:
+            process_lock.acquire()
+            while cls._lock_file_deleted(process_lock):
+                process_lock.release()
+                process_lock.acquire()
+            try:
+                token = _locks_held.set(held | {pgdata})
+                try:
+                    yield
+                finally:
+                    _locks_held.reset(token)
+            finally:
+                process_lock.release()
+
+    @staticmethod
+    def _lock_file_deleted(process_lock: 'fasteners.InterProcessLock') -> bool:
+        """Returns True if the file of the acquired `process_lock` was deleted by its previous holder (see
+        _remove_lock_file()) while this process waited for it; the lock must then be acquired again, on a new file.
+        """
+        if platform.system() == 'Windows':  # open files cannot be deleted
+            return False
+        assert process_lock.lockfile is not None
+        try:
+            current = os.stat(process_lock.lockfile.name)
+        except FileNotFoundError:
+            return True
+        locked = os.fstat(process_lock.lockfile.fileno())
+        return (current.st_dev, current.st_ino) != (locked.st_dev, locked.st_ino)
+
+    def _remove_lock_file(self) -> None:
+        """Deletes the lock file of pgdata, for a pgdata that is deleted. The lock must be held; processes waiting for
+        it acquire it on a new file (see _locked()).
+        """
+        if platform.system() != 'Windows':
+            self._lock_file(self.pgdata).unlink(missing_ok=True)
+
+    @contextmanager
+    def _locked_timed(self) -> Iterator[None]:
+        """_locked(self.pgdata), recording the time spent waiting for the lock."""
+        start, perf_start = time.time(), time.perf_counter()
+        with self._locked(self.pgdata):
+            self.timings.add(Span('lock_wait', self.pgdata, start, time.perf_counter() - perf_start))
+            yield
+
+    @classmethod
+    @asynccontextmanager
+    async def _alocked(cls, pgdata: Path | None = None) -> AsyncIterator[None]:
+        """Async counterpart of _locked(). The locks are polled without blocking, so the event loop keeps running
+        while another thread or process holds them.
+        """
+        held = _locks_held.get()
+        if pgdata in held:
+            yield
+            return
+        thread_lock, process_lock = cls._get_locks(pgdata)
+        delay = 0.001
+        while not thread_lock.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        try:
+            while not process_lock.acquire(blocking=False) or cls._lock_file_deleted(process_lock):
+                if process_lock.acquired:
+                    process_lock.release()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+            try:
+                token = _locks_held.set(held | {pgdata})
+                try:
+                    yield
+                finally:
+                    _locks_held.reset(token)
+            finally:
+                process_lock.release()
+        finally:
+            thread_lock.release()
+
+    def _attach_from_handle(self, handle: ServerHandle) -> bool:
+        """Adopts the server described by `handle` if it is still running, checked with a stat of postmaster.pid and
+        a connection attempt. Returns False if it is not, in which case the caller starts it as usual.
+        """
+        try:
+            st = os.stat(self.pgdata / 'postmaster.pid')
+        except FileNotFoundError:
+            return False
+        if (st.st_dev, st.st_ino) != handle.postmaster_file_id:
+            return False
+        postmaster_info = PostmasterInfo(list(handle.postmaster_lines))
+        if not postmaster_info.accepts_connections():
+            return False
+        if self.pool_size is not None and self._read_pooler_pid() is None:
+            return False
+        self._postmaster_info = postmaster_info
+        return True
+
+    def export_handle(self) -> ServerHandle:
+        """Returns a picklable handle of this server, for worker processes to attach with attach_server() at a
+        fraction of the cost of get_server(). Pickling a PostgresServer exports and attaches a handle implicitly.
+        A forked child does not inherit the servers of its parent: it attaches with attach_server(), so that the server
+        is kept running until the child detaches, or is found deleted if the parent cleaned it up first.
+        """
+        postmaster_info = self.get_postmaster_info()
+        st = os.stat(self.pgdata / 'postmaster.pid')
+        options = {
+            'cleanup_mode': self.cleanup_mode,
+            'use_template': self.use_template,
+            'start_mode': self.start_mode,
+            'shutdown_mode': self.shutdown_mode,
+            'pool_size': self.pool_size,
+            'profile': self.profile,
+            'tmpfs_size': self.tmpfs_size,
+            'watchdog_interval': None if self.watchdog is None else self.watchdog.interval,
+            'background_cleanup': self.background_cleanup,
+            'structured_log': self.structured_log,
+            'slow_query_ms': self.slow_query_ms,
+        }
+        shared_paths = {name: getattr(self, name) for name in SHARED_PATHS}
+        return ServerHandle(
+            self.pgdata, postmaster_info.lines, (st.st_dev, st.st_ino), self.system_user, options, shared_paths
+        )
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return attach_server, (self.export_handle(),)
+
+    @classmethod
+    def _forget_inherited(cls) -> None:
+        """In a forked child, forgets the servers inherited from the parent: the child is not a holder of them (see
+        HandleRegistry._forget_inherited()), and attaches with attach_server() to use one. Watchdog threads do not
+        survive the fork.
+        """
+        for server in cls._instances.values():
+            server.watchdog = None
+            atexit.unregister(server._cleanup)
+        cls._instances.clear()
 
     def get_postmaster_info(self) -> PostmasterInfo:
         assert self._postmaster_info is not None
@@ -86,9 +487,191 @@ class PostgresServer:
         """
         return self.get_postmaster_info().pid
 
-    def get_uri(self, database: str | None = None, driver: str | None = None) -> str:
-        """Returns a connection string for the postgresql server."""
-        return self.get_postmaster_info().get_uri(database=database, driver=driver)
+    def get_uri(self, database: str | None = None, driver: str | None = None, pooled: bool = False) -> str:
+        """Returns a connection string for the postgresql server.
+        If pooled is True, the connection string is for the connection pooler in front of the server (see pool_size
+        in get_server()).
+        """
+        if not pooled:
+            return self.get_postmaster_info().get_uri(database=database, driver=driver)
+        if self._read_pooler_pid() is None:
+            raise RuntimeError(f'No connection pooler is running for {self.pgdata}; use get_server(pool_size=...)')
+        return self.get_postmaster_info().get_uri(database=database, driver=driver, port=POOLER_PORT)
+
+    def pool_stats(self) -> dict[str, Any]:
+        """Returns the connection pooler's most recent statistics (refreshed every second):
+        clients, transactions, max_backends, backends, busy, idle, waiting, saturation (busy / max_backends),
+        peak_busy, acquires, waits, wait_time_total, wait_time_max and wait_time_mean (in seconds).
+        """
+        return json.loads((self.pgdata / '.pooler_stats.json').read_text())
+
+    def connect(self, database: str | None = None) -> Connection:
+        """Opens a new in-process connection to the server (see client.Connection); the caller closes it."""
+        pinfo = self.get_postmaster_info()
+        address: Path | tuple[str, int]
+        if pinfo.socket_path is not None:
+            address = pinfo.socket_path
+        else:
+            assert pinfo.hostname is not None and pinfo.port is not None
+            address = (pinfo.hostname, pinfo.port)
+        return Connection(address, user=self.postgres_user, database=database)
+
+    def query(self, sql: str, params: Sequence[Any] | None = None, database: str | None = None) -> list[tuple]:
+        """Runs sql in-process and returns the result rows as tuples of Python values (eg int, Decimal, datetime).
+        sql may use $1, $2, ... placeholders for params. Uses a persistent connection per thread and database.
+        Raises client.PostgresError if the server reports an error.
+        """
+        return self._connection(database).execute(sql, params)
+
+    def query_iter(self, sql: str, params: Sequence[Any] | None = None, database: str | None = None) -> Iterator[tuple]:
+        """Like query(), but yields the rows as they arrive instead of buffering the whole result."""
+        return self._connection(database).stream(sql, params)
+
+    def copy_in(
+        self,
+        table: str,
+        rows: Iterable[Sequence[Any]] | Any,
+        columns: Sequence[str] | None = None,
+        format: str = 'binary',
+        database: str | None = None,
+        chunk_size: int = 1 << 20,
+    ) -> dict[str, float]:
+        """Bulk-loads rows into `table` (an sql name, eg 'schema.table') with COPY FROM STDIN, over the persistent
+        connection of query().
+        rows is an iterable of row sequences, or a 2-D NumPy array; for a single pgvector column, an array holds one
+        vector per row. columns defaults to all columns of the table. Rows are encoded and sent in chunks of about
+        chunk_size bytes as they are consumed, so memory use does not grow with the number of rows.
+        format is 'binary' (default; for the column types in bulk.BINARY_TYPES) or 'csv' (for any type).
+        Returns the throughput: rows, bytes, seconds, rows_per_second and bytes_per_second.
+        """
+        conn = self._connection(database)
+        table_columns = conn.execute(
+            'select a.attname, t.typname from pg_attribute a join pg_type t on t.oid = a.atttypid'
+            ' where a.attrelid = $1::regclass and a.attnum > 0 and not a.attisdropped order by a.attnum',
+            [table],
+        )
+        column_types = dict(table_columns)
+        if columns is None:
+            columns = list(column_types)
+        unknown = [c for c in columns if c not in column_types]
+        if unknown:
+            raise ValueError(f'Columns {unknown} do not exist in {table}')
+        chunks = encode_copy_data(rows, [column_types[c] for c in columns], format, chunk_size)
+
+        sent = 0
+
+        def counted_chunks() -> Iterator[bytes]:
+            nonlocal sent
+            for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+
+        column_list = ', '.join(quote_ident(c) for c in columns)
+        start = time.perf_counter()
+        count = conn.copy_in(f'copy {table} ({column_list}) from stdin with (format {format})', counted_chunks())
+        seconds = time.perf_counter() - start
+        _logger.info(f'Copied {count} rows ({sent} bytes) into {table} in {seconds:.3f}s')
+        return {
+            'rows': count,
+            'bytes': sent,
+            'seconds': seconds,
+            'rows_per_second': count / seconds if seconds > 0 else 0.0,
+            'bytes_per_second': sent / seconds if seconds > 0 else 0.0,
+        }
+
+    def _connection(self, database: str | None) -> Connection:
+        key = (os.getpid(), threading.get_ident(), database or self.postgres_user)
+        conn = self._connections.get(key)
+        if conn is None or conn.closed:
+            conn = self._connections[key] = self.connect(database)
+        return conn
+
+    def _close_connections(self, databases: Sequence[str] | None = None) -> None:
+        """Closes the persistent connections of query(), or only those to `databases`."""
+        for key, conn in list(self._connections.items()):
+            if databases is not None and key[2] not in databases:
+                continue
+            if key[0] == os.getpid():  # inherited connections belong to the parent process
+                conn.close()
+            del self._connections[key]
+
+    def mark_template(self, database: str, is_template: bool = True) -> None:
+        """Marks `database` as a template for clone_databases() (or unmarks it if is_template is False).
+        Install its contents first, eg extensions such as pgvector and the application schema.
+        """
+        with self._admin_connection([database]) as conn:
+            conn.execute(f'alter database {quote_ident(database)} with is_template {str(is_template).lower()}')
+
+    def clone_databases(self, template: str, names: Sequence[str]) -> None:
+        """Creates the databases `names` as copies of `template`.
+        The copies are made with STRATEGY FILE_COPY, which copies the template's files rather than WAL-logging every
+        block, and so is fast for templates of any size. Postgres refuses to copy a database that has connections,
+        so connections to the template are terminated first.
+        """
+        with self._admin_connection([template, *names]) as conn:
+            conn.execute(
+                'select pg_terminate_backend(pid) from pg_stat_activity where datname = $1 and pid <> pg_backend_pid()',
+                [template],
+            )
+            for name in names:
+                conn.execute(f'create database {quote_ident(name)} template {quote_ident(template)} strategy file_copy')
+
+    def drop_databases(self, names: Sequence[str]) -> None:
+        """Drops the databases `names` (templates included), terminating their connections first.
+        Databases that do not exist are skipped.
+        """
+        with self._admin_connection(names) as conn:
+            templates = {name for (name,) in conn.execute('select datname from pg_database where datistemplate')}
+            for name in names:
+                if name in templates:  # postgres does not drop templates
+                    conn.execute(f'alter database {quote_ident(name)} with is_template false')
+                conn.execute(f'drop database if exists {quote_ident(name)} with (force)')
+
+    def _admin_connection(self, databases: Sequence[str]) -> Connection:
+        """Opens a connection for administering `databases`, to a database other than those, after closing the
+        connections of query() to them.
+        """
+        self._close_connections(databases)
+        for database in ('postgres', 'template1'):
+            if database not in databases:
+                return self.connect(database)
+        raise ValueError('Cannot administer both the postgres and template1 databases at once')
+
+    def query_stats(self, n: int = 20, order_by: str = 'total_time') -> list[dict[str, Any]]:
+        """Returns execution statistics of the top `n` statements (across all databases) since the last
+        reset_query_stats(), as collected by pg_stat_statements.
+        order_by is one of QUERY_STATS_ORDER: total_time, mean_time, calls, rows, shared_blks_hit or shared_blks_read.
+        Each statement is a dict with keys query, database, calls, rows, total_time and mean_time (in seconds),
+        shared_blks_hit and shared_blks_read (buffer cache hits and blocks read from disk or the OS cache).
+        """
+        if order_by not in QUERY_STATS_ORDER:
+            raise ValueError(f'Unknown order_by {order_by!r}; expected one of {tuple(QUERY_STATS_ORDER)}')
+        self._ensure_query_stats()
+        rows = self.query(
+            'select s.query, d.datname, s.calls, s.rows, s.total_exec_time / 1000, s.mean_exec_time / 1000,'
+            ' s.shared_blks_hit, s.shared_blks_read'
+            ' from pg_stat_statements s left join pg_database d on d.oid = s.dbid'
+            f' order by s.{QUERY_STATS_ORDER[order_by]} desc limit $1',
+            [n],
+        )
+        keys = ('query', 'database', 'calls', 'rows', 'total_time', 'mean_time', 'shared_blks_hit', 'shared_blks_read')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def reset_query_stats(self) -> None:
+        """Discards the statistics collected so far by pg_stat_statements."""
+        self._ensure_query_stats()
+        self.query('select pg_stat_statements_reset()')
+
+    def _ensure_query_stats(self) -> None:
+        if self._query_stats_ready:
+            return
+        if not extension_available('pg_stat_statements'):
+            raise RuntimeError('pg_stat_statements is not part of this postgres build')
+        if 'pg_stat_statements' not in self.query('show shared_preload_libraries')[0][0]:
+            raise RuntimeError(f'pg_stat_statements is not loaded by the server for {self.pgdata}; restart it')
+        # the statistics cover all databases; the extension only provides the view and functions to read them
+        self.query('create extension if not exists pg_stat_statements')
+        self._query_stats_ready = True
 
     def ensure_pgdata_inited(self) -> None:
         """Initializes the pgdata directory if it is not already initialized."""
@@ -116,47 +699,200 @@ class PostgresServer:
             # It is likely the old server could also corrupt the data beyond the socket file, so it is best to kill it.
             # This must be done before initdb to ensure no race conditions with the old server.
             #
-            # Since we do not know PID information of the old server, we stop all servers with the same pgdata path.
+            # The old server is identified by the postmaster record of this pgdata path; if there is none (eg the
+            # server was not started by us), we stop all servers with the same pgdata path.
             # way to test this:
             #
             # python -c 'import pixeltable as pxt; pxt.Client()'
             # rm -rf ~/.pixeltable/
             # python -c 'import pixeltable as pxt; pxt.Client()'
             _logger.info(f'no PG_VERSION file found within {self.pgdata}. Initializing pgdata')
-            for proc in psutil.process_iter(attrs=('name', 'cmdline')):
-                if (
-                    proc.info['name'] == 'postgres'
-                    and proc.info['cmdline'] is not None
-                    and str(self.pgdata) in proc.info['cmdline']
-                ):
-                    _logger.info(
-                        f'Found a running postgres server with same `pgdata` dir: '
-                        f"{proc.as_dict(attrs=('name', 'pid', 'cmdline'))=}."
-                        'Assuming it is a leftover from a previous run on a different '
-                        'version of the same `pgdata` path; killing it.'
-                    )
-                    proc.terminate()
-                    with suppress(psutil.TimeoutExpired):
-                        proc.wait(2)
-                    if proc.is_running():
-                        proc.kill()
-                    assert not proc.is_running()
-
-            pgexec(
-                'initdb',
-                (
-                    '--auth=trust',
-                    '--auth-local=trust',
-                    '--encoding=utf8',
-                    '-U',
-                    self.postgres_user,
-                    '-D',
-                    str(self.pgdata),
-                ),
-                user=self.system_user,
-            )
+            with self.timings.span('stale_process_scan'):
+                self._kill_stale_servers()
+
+            if self.tmpfs_size is not None:
+                self._check_tmpfs_capacity()
+            args = initdb_args(self.postgres_user)
+            with self.timings.span('initdb'):
+                if self.from_snapshot is not None:
+                    self._init_from_snapshot()
+                elif not (self.use_template and self._init_from_template(args)):
+                    pgexec('initdb', (*args, '-D', str(self.pgdata)), user=self.system_user)
+            if self.tmpfs_size is not None:
+                self._move_to_tmpfs()
         else:
             _logger.info('PG_VERSION file found, skipping initdb')
+            if self.from_snapshot is not None:
+                _logger.warning(
+                    f'{self.pgdata} is already initialized; snapshot {self.from_snapshot!r} is not restored'
+                )
+            if (self.pgdata / 'base').is_symlink() and not (self.pgdata / 'base').exists():
+                raise RuntimeError(
+                    f'The tmpfs-backed data of {self.pgdata} is gone (was the host rebooted?); delete the directory'
+                )
+
+    def _kill_stale_servers(self) -> None:
+        if self.postmaster_record.exists():
+            proc = self.postmaster_record.find_process()
+            stale = [] if proc is None else [proc]
+        else:
+            stale = list(self._scan_for_servers())
+        for proc in stale:
+            _logger.info(
+                f'Found a running postgres server with same `pgdata` dir: '
+                f"{proc.as_dict(attrs=('name', 'pid', 'cmdline'))=}."
+                'Assuming it is a leftover from a previous run on a different '
+                'version of the same `pgdata` path; killing it.'
+            )
+            proc.terminate()
+            with suppress(psutil.TimeoutExpired):
+                proc.wait(2)
+            if proc.is_running():
+                proc.kill()
+            assert not proc.is_running()
+
+    def _scan_for_servers(self) -> Iterator[psutil.Process]:
+        """Yields the postgres processes on the host whose command line mentions pgdata.
+        Only the names of all processes are read; command lines are read for postgres processes only.
+        """
+        for proc in psutil.process_iter(attrs=('name',)):
+            if proc.info['name'] != 'postgres':
+                continue
+            try:
+                cmdline = proc.cmdline()
+            except psutil.Error:
+                continue
+            if str(self.pgdata) in cmdline:
+                yield proc
+
+    def _tmpfs_dir(self) -> Path:
+        # as for socket dirs, combine the path with the inode number to avoid collisions
+        string_identifier = f'{self.pgdata}-{self.pgdata.stat().st_ino}'
+        path_hash = hashlib.sha256(string_identifier.encode()).hexdigest()[:10]
+        return self.tmpfs_path / 'pixeltable_pgserver' / path_hash
+
+    def _check_tmpfs_capacity(self) -> None:
+        """Refuses to use the tmpfs if it cannot hold tmpfs_size bytes, and warns if RAM is short."""
+        assert self.tmpfs_size is not None
+        if not self.tmpfs_path.is_dir():
+            raise RuntimeError(f'tmpfs_size was given, but there is no tmpfs at {self.tmpfs_path}')
+        free = shutil.disk_usage(self.tmpfs_path).free
+        if free < self.tmpfs_size:
+            raise RuntimeError(
+                f'Not enough space on {self.tmpfs_path} for tmpfs_size={self.tmpfs_size}: {free} bytes free'
+            )
+        available = psutil.virtual_memory().available
+        if available < self.tmpfs_size:
+            _logger.warning(
+                f'tmpfs_size={self.tmpfs_size} exceeds the available memory ({available} bytes); '
+                'the server data may be swapped out'
+            )
+
+    def _move_to_tmpfs(self) -> None:
+        """Moves the data files and WAL of a new pgdata onto the tmpfs, leaving symlinks behind.
+        Temporary files (base/pgsql_tmp) thereby end up on the tmpfs as well.
+        """
+        tmpfs_dir = self._tmpfs_dir()
+        shutil.rmtree(tmpfs_dir, ignore_errors=True)  # left-over from a previous pgdata at the same path
+        tmpfs_dir.mkdir(parents=True, mode=0o700)
+        for name in ('base', 'pg_wal'):
+            shutil.move(self.pgdata / name, tmpfs_dir / name)
+            (self.pgdata / name).symlink_to(tmpfs_dir / name, target_is_directory=True)
+        if self.system_user is not None:
+            ensure_owned_by(tmpfs_dir, self.system_user)
+        _logger.info(f'Moved data files and WAL of {self.pgdata} to {tmpfs_dir}')
+
+    def _preload_settings(self) -> dict[str, str]:
+        """Settings that preload pg_stat_statements, if it is installed (see query_stats()), in addition to the
+        libraries preloaded by postgresql.conf (which the managed include file would otherwise override).
+        """
+        if not extension_available('pg_stat_statements'):
+            return {}
+        configured = configured_setting(self.pgdata, 'shared_preload_libraries') or ''
+        libraries = [library.strip() for library in configured.split(',') if library.strip()]
+        if 'pg_stat_statements' not in (library.strip('"') for library in libraries):
+            libraries.append('pg_stat_statements')
+        return {'shared_preload_libraries': ','.join(libraries), 'pg_stat_statements.track': 'top'}
+
+    @staticmethod
+    def _compression_settings() -> dict[str, str]:
+        """Settings that use lz4 for TOAST and zstd (or lz4) for WAL full-page images, if postgres was built with them.
+        Much faster than the default pglz (for TOAST) and cheaper than uncompressed full-page images (for WAL).
+        """
+        settings = {}
+        if compression_available('lz4'):
+            settings['default_toast_compression'] = 'lz4'
+        if compression_available('zstd'):
+            settings['wal_compression'] = 'zstd'
+        elif compression_available('lz4'):
+            settings['wal_compression'] = 'lz4'
+        return settings
+
+    def _tmpfs_settings(self) -> dict[str, str]:
+        """Settings that keep temporary files and WAL within tmpfs_size."""
+        if self.tmpfs_size is None:
+            return {}
+        mb = 1024 * 1024
+        max_wal_mb = max(min(self.tmpfs_size // 4 // mb, 1024), 64)
+        return {
+            'temp_file_limit': f'{self.tmpfs_size // 4 // 1024}kB',
+            'max_wal_size': f'{max_wal_mb}MB',
+            'min_wal_size': '32MB',
+        }
+
+    def _init_from_template(self, args: tuple[str, ...]) -> bool:
+        """Populates pgdata from the cached template cluster for `args`.
+        Returns False (leaving pgdata empty) if that fails for any reason, in which case the caller runs initdb.
+        """
+        try:
+            template = ensure_template(self.templates_path, args, self.system_user)
+            _logger.info(f'Initializing pgdata from template {template}')
+            init_from_template(self.pgdata, template, self.system_user)
+            return True
+        except (OSError, subprocess.SubprocessError):
+            _logger.warning('Failed to initialize pgdata from template; falling back to initdb', exc_info=True)
+            for child in self.pgdata.iterdir():
+                if child.is_dir():
+                    shutil.rmtree(child)
+                else:
+                    child.unlink()
+            return False
+
+    def _init_from_snapshot(self) -> None:
+        """Populates pgdata with a copy of the snapshot `from_snapshot` (see snapshot())."""
+        assert self.from_snapshot is not None
+        snapshot = snapshot_path(self.snapshots_path, self.from_snapshot)
+        if not (snapshot / 'PG_VERSION').exists():
+            raise FileNotFoundError(f'No snapshot {self.from_snapshot!r} in {self.snapshots_path}')
+        _logger.info(f'Initializing pgdata from snapshot {snapshot}')
+        init_from_template(self.pgdata, snapshot, self.system_user)
+
+    def snapshot(self, name: str) -> Path:
+        """Saves the current contents of pgdata as snapshot `name`, replacing an existing snapshot of that name.
+        New servers start from it with get_server(..., from_snapshot=name).
+        The server is checkpointed, then stopped while its files are copied (as copy-on-write clones where the file
+        system supports them) and restarted; connections to it are closed. It must not be in use by other processes.
+        Returns the path of the snapshot.
+        """
+        path = snapshot_path(self.snapshots_path, name)
+        with self._locked_timed():
+            if any(True for _ in self.handles.live_holders()):
+                raise RuntimeError(f'Cannot snapshot {self.pgdata} while other processes use it')
+            # so that little is left to write for the shutdown checkpoint
+            self.query('checkpoint')
+            self._close_connections()
+            self._stop_pooler()
+            if not self._stop_postmaster('fast'):
+                raise RuntimeError(f'Failed to stop the server for {self.pgdata}')
+            if self._postmaster_popen is not None:
+                self._postmaster_popen.wait()
+            try:
+                save_snapshot(self.pgdata, path)
+            finally:
+                self.ensure_postgres_running()
+                if self.pool_size is not None:
+                    self.ensure_pooler_running()
+        return path
 
     def ensure_postgres_running(self) -> None:
         """pre condition: pgdata is initialized, being run with lock.
@@ -164,21 +900,44 @@ class PostgresServer:
         """
 
         postmaster_info = PostmasterInfo.read_from_pgdata(self.pgdata)
+        if postmaster_info is not None and postmaster_info.status == 'stopping' and postmaster_info.is_alive():
+            # eg stopped in the background by another handle (see background_cleanup); start it anew once it stopped
+            _logger.info(f'Waiting for the server of {self.pgdata} to finish shutting down')
+            assert postmaster_info.process is not None
+            if not wait_for_process_exit(postmaster_info.process, 60):
+                raise TimeoutError(f'The server of {self.pgdata} did not finish shutting down')
+            postmaster_info = PostmasterInfo.read_from_pgdata(self.pgdata)
         if postmaster_info is not None and postmaster_info.is_running():
             _logger.info(f'a postgres server is already running: {postmaster_info=} {postmaster_info.process=}')
+            if self.profile is not None:
+                _logger.info(f'Server is already running; profile {self.profile!r} will not be applied')
             self._postmaster_info = postmaster_info
+            # started by other means, or the record is stale (eg left over from a server of an earlier pgdata)
+            recorded = self.postmaster_record.find_process()
+            if recorded is None or recorded.pid != postmaster_info.process.pid:
+                self.postmaster_record.write(postmaster_info.process)
         else:
             if postmaster_info is not None and not postmaster_info.is_running():
                 _logger.info(f'found a postmaster.pid file, but the server is not running: {postmaster_info=}')
+                # so that the readiness wait below only sees the file of the new postmaster
+                (self.pgdata / 'postmaster.pid').unlink(missing_ok=True)
             if postmaster_info is None:
                 _logger.info(f'no postmaster.pid file found in {self.pgdata}')
 
+            overrides = {**self._compression_settings(), **self._preload_settings(), **self._tmpfs_settings()}
+            if self.structured_log:
+                overrides.update(log_settings(self.slow_query_ms))
+                prune_log_files(self.pgdata)
+            write_tuning_conf(self.pgdata, self.profile, overrides)
+
             postgres_args: str
+            postgres_argv: tuple[str, ...] = ()
             subprocess_kwargs: dict[str, Any]
 
             if platform.system() != 'Windows':
                 # use sockets to avoid any future conflict with port numbers
-                socket_dir = find_suitable_socket_dir(self.pgdata, self.runtime_path)
+                with self.timings.span('socket_dir_selection'), self._locked():
+                    socket_dir = find_suitable_socket_dir(self.pgdata, self.runtime_path)
 
                 if self.system_user is not None and socket_dir != self.pgdata:
                     ensure_prefix_permissions(socket_dir)
@@ -187,13 +946,15 @@ class PostgresServer:
                 # no listening on any IP addresses (forwarded to postgres exec) see man postgres for -hj
                 # socket option (forwarded to postgres exec) see man postgres for -k
                 postgres_args = f'-h "" -k {socket_dir}'
+                postgres_argv = ('-h', '', '-k', str(socket_dir))
                 subprocess_kwargs = {}
 
             else:  # Windows
                 socket_dir = None
                 # socket.AF_UNIX is undefined when running on Windows, so default to a port
                 host = '127.0.0.1'
-                port = find_suitable_port(host)
+                with self._locked():  # so that servers starting concurrently pick different ports
+                    port = find_suitable_port(host)
                 postgres_args = f'-h "{host}" -p {port}'
                 subprocess_kwargs = {
                     'close_fds': True,
@@ -203,41 +964,227 @@ class PostgresServer:
                 }
 
             try:
-                pg_ctl_args = ('-w', '-o', postgres_args, '-l', str(self.log), '-D', str(self.pgdata), 'start')
-                _logger.info(f'running pg_ctl... {pg_ctl_args=}')
-                pgexec('pg_ctl', pg_ctl_args, user=self.system_user, timeout=10, **subprocess_kwargs)
-
-            except subprocess.SubprocessError:
+                self._start_and_wait(postgres_args, postgres_argv, subprocess_kwargs)
+            except (subprocess.SubprocessError, TimeoutError) as exc:
+                pg_ctl_output = getattr(exc, 'stderr', None)
                 _logger.error(
-                    f'Failed to start server.\nShowing contents of postgres server log ({self.log.absolute()}) '
-                    f'below:\n{self.log.read_text()}'
+                    'Failed to start server.\n'
+                    + (f'pg_ctl output:\n{pg_ctl_output}\n' if pg_ctl_output else '')
+                    + f'Showing the end of the postgres server log ({self.log.absolute()}) below:\n'
+                    + read_tail(self.log)
                 )
                 raise
 
-            while True:
-                # in Windows, when there is a postmaster.pid,  init_ctl seems to return
-                # but the file is not immediately updated, here we wait until the file shows
-                # a new running server. see test_stale_postmaster
-                _logger.info('Waiting for postmaster info to show a running process.')
-                pinfo = PostmasterInfo.read_from_pgdata(self.pgdata)
-                _logger.info(f'Running; checking if ready {pinfo=}')
-                if pinfo is not None and pinfo.is_running() and pinfo.status == 'ready':
-                    self._postmaster_info = pinfo
-                    break
-
-                _logger.info('Not ready yet; waiting a bit longer.')
-                time.sleep(1.0)
-
         _logger.info(f'Now asserting server is running {self._postmaster_info=}')
         assert self._postmaster_info is not None
         assert self._postmaster_info.is_running()
         assert self._postmaster_info.status == 'ready'
 
+    def _start_and_wait(
+        self, postgres_args: str, postgres_argv: tuple[str, ...], subprocess_kwargs: dict[str, Any]
+    ) -> None:
+        """Starts the postmaster (per start_mode) and waits for it to be ready, setting self._postmaster_info."""
+        launched = time.monotonic()
+        pg_ctl = None
+        # pg_ctl's output, for a failure to start; a file, as pipes could hang (see pgexec)
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as pg_ctl_output:
+            with self.timings.span('start'):
+                if self.start_mode == 'direct':
+                    self._start_postmaster(postgres_argv)
+                else:
+                    pg_ctl = self._launch_pg_ctl(postgres_args, subprocess_kwargs, pg_ctl_output)
+
+            _logger.info('Waiting for postmaster info to show a running process.')
+            try:
+                with self.timings.span('readiness_wait'):
+                    self._postmaster_info, self.readiness_latency = wait_for_postmaster_ready(
+                        self.pgdata, process=self._postmaster_popen, launcher=pg_ctl, start=launched
+                    )
+            except subprocess.CalledProcessError as exc:
+                if pg_ctl is not None and exc.cmd == pg_ctl.args:
+                    pg_ctl_output.seek(0)
+                    exc.stderr = pg_ctl_output.read()
+                raise
+        _logger.info(f'Server ready after {self.readiness_latency * 1000:.1f}ms: {self._postmaster_info=}')
+        self.postmaster_record.write(self._postmaster_info.process)
+
+    def ensure_pooler_running(self) -> None:
+        """Starts the connection pooler in front of the server, unless one is running already.
+        pre condition: postgres is running, being run with lock.
+        """
+        if self._read_pooler_pid() is not None:
+            _logger.info(f'a connection pooler is already running for {self.pgdata}')
+            return
+
+        postmaster_info = self.get_postmaster_info()
+        assert postmaster_info.socket_dir is not None and postmaster_info.socket_path is not None
+        pooler_socket = postmaster_info.socket_dir / f'.s.PGSQL.{POOLER_PORT}'
+        cmdline = (
+            sys.executable,
+            '-m',
+            'pixeltable_pgserver.pooler',
+            '--listen',
+            str(pooler_socket),
+            '--upstream',
+            str(postmaster_info.socket_path),
+            '--max-backends',
+            str(self.pool_size),
+            '--stats',
+            str(self.pgdata / '.pooler_stats.json'),
+            '--postmaster-pid',
+            str(postmaster_info.pid),
+        )
+        _logger.info(f'Spawning connection pooler: {cmdline=}')
+        with open(self.pooler_log, 'a', encoding='utf-8') as log:
+            self._pooler_popen = subprocess.Popen(
+                cmdline, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+        (self.pgdata / '.pooler.pid').write_text(str(self._pooler_popen.pid))
+
+        deadline = time.monotonic() + 10.0
+        delay = 0.001
+        while not (pooler_socket.exists() and (self.pgdata / '.pooler_stats.json').exists()):
+            if self._pooler_popen.poll() is not None or time.monotonic() > deadline:
+                _logger.error(
+                    f'Failed to start connection pooler; log ({self.pooler_log}):\n{read_tail(self.pooler_log)}'
+                )
+                raise subprocess.CalledProcessError(self._pooler_popen.returncode or -1, cmdline)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+    def _read_pooler_pid(self) -> int | None:
+        """Returns the pid of the running connection pooler for this pgdata, if any."""
+        pid_file = self.pgdata / '.pooler.pid'
+        if not pid_file.exists():
+            return None
+        pid = int(pid_file.read_text())
+        try:
+            if 'pixeltable_pgserver.pooler' in psutil.Process(pid).cmdline():
+                return pid
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            pass
+        return None
+
+    def _stop_pooler(self) -> None:
+        pid = self._read_pooler_pid()
+        if pid is not None:
+            _logger.info(f'Stopping connection pooler {pid}')
+            with suppress(psutil.NoSuchProcess):
+                proc = psutil.Process(pid)
+                proc.terminate()
+                try:
+                    proc.wait(5)
+                except psutil.TimeoutExpired:
+                    proc.kill()
+        if self._pooler_popen is not None:
+            self._pooler_popen.wait()  # reap it (a no-op if psutil already did)
+        (self.pgdata / '.pooler.pid').unlink(missing_ok=True)
+
+    def _launch_pg_ctl(
+        self, postgres_args: str, subprocess_kwargs: dict[str, Any], output: IO[str]
+    ) -> subprocess.Popen:
+        """Launches `pg_ctl start` without waiting for it, writing its output to `output`. pg_ctl polls for readiness
+        only every 100ms, so the caller notices readiness first (see wait_for_postmaster_ready()); pg_ctl still
+        reports a failure to start. It is reaped in the background once it has noticed readiness as well.
+        """
+        executable = 'pg_ctl.exe' if platform.system() == 'Windows' else 'pg_ctl'
+        cmdline = (
+            str(POSTGRES_BIN_PATH / executable),
+            *('-w', '-o', postgres_args, '-l', str(self.log), '-D', str(self.pgdata), 'start'),
+        )
+        _logger.info(f'Launching pg_ctl: {cmdline=}')
+        popen = subprocess.Popen(
+            cmdline,
+            stdin=subprocess.DEVNULL,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            user=self.system_user,
+            **subprocess_kwargs,
+        )
+        threading.Thread(target=popen.wait, name='pgserver-pg_ctl-reaper', daemon=True).start()
+        return popen
+
+    def _start_postmaster(self, postgres_args: tuple[str, ...]) -> None:
+        """Spawns the postmaster directly rather than through pg_ctl, and keeps its Popen handle.
+        The postmaster gets its own session, so that terminal signals (eg Ctrl-C) are not forwarded to it.
+        """
+        cmdline = (str(POSTGRES_BIN_PATH / 'postgres'), '-D', str(self.pgdata), *postgres_args)
+        _logger.info(f'Spawning postmaster: {cmdline=}')
+        with open(self.log, 'a', encoding='utf-8') as log:
+            self._postmaster_popen = subprocess.Popen(
+                cmdline,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                user=self.system_user,
+                start_new_session=True,
+            )
+
+    def _stop_postmaster(self, shutdown_mode: str | None = None) -> bool:
+        """Stops the running postmaster using `shutdown_mode` (default: self.shutdown_mode).
+        Returns False if it could not be stopped cleanly.
+        """
+        shutdown_mode = shutdown_mode or self.shutdown_mode
+        assert self._postmaster_info is not None
+        assert self._postmaster_info.process is not None
+        if self.start_mode == 'pg_ctl':
+            try:
+                pgexec(
+                    'pg_ctl',
+                    ('-w', '-D', str(self.pgdata), '-m', shutdown_mode, 'stop'),
+                    user=self.system_user,
+                )
+                return True
+            except subprocess.CalledProcessError:
+                return False  # somehow the server is already stopped.
+
+        # same signals and time-out that pg_ctl uses, without spawning it
+        sig = getattr(signal, SHUTDOWN_SIGNALS[shutdown_mode])
+        try:
+            self._postmaster_info.process.send_signal(sig)
+            self._postmaster_info.process.wait(60)
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return False
+        return True
+
+    def _postmaster_alive(self) -> bool:
+        return self._postmaster_info is not None and self._postmaster_info.is_alive()
+
+    def _recover(self) -> bool:
+        """Restarts the server after its postmaster died, or adopts the server another process restarted already.
+        Returns False if there was nothing to do: the server is alive, or the watchdog was stopped.
+        """
+        with self._locked_timed():
+            if self.watchdog is None or self.watchdog.stopped or self._postmaster_alive():
+                return False
+            with self.timings.span('recovery'):
+                # connections to the dead server are broken
+                self._close_connections()
+                if self._postmaster_popen is not None:
+                    self._postmaster_popen.wait()  # reap it
+                    self._postmaster_popen = None
+                postmaster_info = PostmasterInfo.read_from_pgdata(self.pgdata)
+                if postmaster_info is None or not postmaster_info.is_alive():
+                    _logger.warning(f'The postmaster of {self.pgdata} died; restarting the server')
+                    self._stop_pooler()
+                    # postgres refuses to start while the pid in postmaster.pid exists, as it does for a zombie
+                    (self.pgdata / 'postmaster.pid').unlink(missing_ok=True)
+                self.ensure_postgres_running()
+                if self.pool_size is not None:
+                    self.ensure_pooler_running()
+            return True
+
     def _cleanup(self) -> None:
-        with self._lock:
-            pids = self.global_process_id_list.get_and_remove(os.getpid())
-            _logger.info(f'Exiting {os.getpid()} remaining {pids=}')
-            if pids != [os.getpid()]:  # includes case where already cleaned up
+        if self.watchdog is not None:
+            # before taking the lock, which the watchdog takes to restart the server
+            self.watchdog.stop()
+        with self._locked_timed():
+            self._close_connections()
+            last = self.handles.detach()
+            _logger.info(f'Detached {os.getpid()} from {self.pgdata}; last handle: {last}')
+            if not last:  # includes case where already cleaned up
                 return
 
             _logger.info(f'Cleaning last handle for server: {self.pgdata}')
@@ -247,37 +1194,118 @@ class PostgresServer:
                 return
 
             assert self.cleanup_mode in ('stop', 'delete')
-            if self._postmaster_info is not None:
-                assert self._postmaster_info.process is not None
-                if self._postmaster_info.process.is_running():
-                    try:
-                        pgexec('pg_ctl', ('-w', '-D', str(self.pgdata), 'stop'), user=self.system_user)
-                        stopped = True
-                    except subprocess.CalledProcessError:
-                        stopped = False
-                        pass  # somehow the server is already stopped.
-
-                    if not stopped:
-                        _logger.warning('Failed to stop server; killing it instead.')
-                        self._postmaster_info.process.terminate()
-                        try:
-                            self._postmaster_info.process.wait(2)
-                        except psutil.TimeoutExpired:
-                            pass
-                        if self._postmaster_info.process.is_running():
-                            self._postmaster_info.process.kill()
+            if self.background_cleanup:
+                self._cleanup_in_background()
+                atexit.unregister(self._cleanup)
+                return
+            with self.timings.span('shutdown'):
+                # before the server, whose smart shutdown would otherwise wait for the pooler's connections
+                self._stop_pooler()
+                if self._postmaster_info is not None:
+                    assert self._postmaster_info.process is not None
+                    if self._postmaster_info.process.is_running():
+                        stopped = self._stop_postmaster()
+                        if not stopped:
+                            _logger.warning('Failed to stop server; killing it instead.')
+                            self._postmaster_info.process.terminate()
+                            try:
+                                self._postmaster_info.process.wait(2)
+                            except psutil.TimeoutExpired:
+                                pass
+                            if self._postmaster_info.process.is_running():
+                                self._postmaster_info.process.kill()
+
+                        if self._postmaster_popen is not None:
+                            self._postmaster_popen.wait()  # reap it (a no-op if psutil already did)
 
             if self.cleanup_mode == 'stop':
                 return
 
             assert self.cleanup_mode == 'delete'
-            shutil.rmtree(str(self.pgdata))
+            with self.timings.span('delete'):
+                for name in ('base', 'pg_wal'):
+                    if (self.pgdata / name).is_symlink():  # on tmpfs
+                        shutil.rmtree((self.pgdata / name).resolve().parent, ignore_errors=True)
+                shutil.rmtree(str(self.pgdata))
+                self.postmaster_record.remove()
+                self._remove_lock_file()
             atexit.unregister(self._cleanup)
 
+    def _cleanup_in_background(self) -> None:
+        """Signals the server to shut down (per shutdown_mode) without waiting for it, renames pgdata out of the way if
+        it is to be deleted, and leaves waiting for the shutdown and deleting the data to a detached reaper process.
+        pre condition: being run with lock, by the last handle.
+        """
+        process = None
+        with self.timings.span('shutdown'):
+            pooler_pid = self._read_pooler_pid()
+            if pooler_pid is not None:
+                with suppress(psutil.NoSuchProcess):
+                    psutil.Process(pooler_pid).terminate()
+            (self.pgdata / '.pooler.pid').unlink(missing_ok=True)
+            if self._postmaster_info is not None and self._postmaster_info.is_alive():
+                process = self._postmaster_info.process
+                assert process is not None
+                with suppress(psutil.NoSuchProcess):
+                    process.send_signal(getattr(signal, SHUTDOWN_SIGNALS[self.shutdown_mode]))
+
+        paths: list[Path] = []
+        if self.cleanup_mode == 'delete':
+            with self.timings.span('delete'):
+                for name in ('base', 'pg_wal'):
+                    if (self.pgdata / name).is_symlink():  # on tmpfs
+                        paths.append((self.pgdata / name).resolve().parent)
+                # the postmaster runs in pgdata, using relative paths, so it shuts down normally after the rename;
+                # the name is free for a new server right away
+                tombstone = self.pgdata.with_name(f'.{self.pgdata.name}.deleted-{os.getpid()}-{time.time_ns()}')
+                self.pgdata.rename(tombstone)
+                paths = [*dict.fromkeys(paths), tombstone]
+                self.postmaster_record.remove()
+                self._remove_lock_file()
+
+        if process is None and not paths:
+            return
+        cmdline = [sys.executable, '-m', 'pixeltable_pgserver.reaper']
+        if process is not None:
+            with suppress(psutil.NoSuchProcess):
+                cmdline += ['--pid', str(process.pid), '--create-time', str(process.create_time())]
+        for path in paths:
+            cmdline += ['--delete', str(path)]
+        _logger.info(f'Spawning reaper: {cmdline=}')
+        subprocess.Popen(
+            cmdline,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def log_tail(self, from_start: bool = False) -> LogTail:
+        """Returns a LogTail reading the entries of the server's jsonlog files (see serverlog), starting at the end of
+        the current file, or at the beginning of the oldest one with from_start=True. Requires structured_log=True.
+        """
+        if not self.structured_log:
+            raise ValueError('log_tail() requires a server started with structured_log=True')
+        return LogTail(self.pgdata, from_start=from_start)
+
     def psql(self, command: str) -> str:
-        """Runs a psql command on this server. The command is passed to psql via stdin."""
-        executable = POSTGRES_BIN_PATH / 'psql'
-        stdout = subprocess.check_output(f'{executable} {self.get_uri()}', input=command.encode(), shell=True)
+        """Runs a psql command on this server. The command is passed to psql via stdin.
+        Returns psql's formatted output; for repeated queries or typed results, use query() instead.
+        """
+        stdout = subprocess.check_output([str(POSTGRES_BIN_PATH / 'psql'), self.get_uri()], input=command.encode())
+        return stdout.decode('utf-8')
+
+    async def psql_async(self, command: str) -> str:
+        """Async counterpart of psql(), running psql without blocking the event loop."""
+        proc = await asyncio.create_subprocess_exec(
+            str(POSTGRES_BIN_PATH / 'psql'),
+            self.get_uri(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate(command.encode())
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, ('psql', self.get_uri()), output=stdout)
         return stdout.decode('utf-8')
 
     def __enter__(self) -> Self:
@@ -291,12 +1319,44 @@ class PostgresServer:
         if self._count <= 0:
             self._cleanup()
 
+    async def __aenter__(self) -> Self:
+        return self.__enter__()
+
+    async def __aexit__(
+        self, exc_type: type[BaseException] | None, exc_val: BaseException | None, exc_tb: TracebackType | None
+    ) -> None:
+        self._count -= 1
+        if self._count <= 0:
+            await self.cleanup_async()
+
     def cleanup(self) -> None:
         """Stops the postgresql server and removes the pgdata directory."""
         self._cleanup()
 
+    async def cleanup_async(self) -> None:
+        """Async counterpart of cleanup(). The lock is awaited without blocking, and the shutdown runs in a worker
+        thread.
+        """
+        async with self._alocked(self.pgdata):
+            await asyncio.to_thread(self._cleanup)
+
 
-def get_server(pgdata: Path | str, cleanup_mode: str | None = 'stop') -> PostgresServer:
+def get_server(
+    pgdata: Path | str,
+    cleanup_mode: str | None = 'stop',
+    *,
+    use_template: bool = True,
+    start_mode: str = 'pg_ctl',
+    shutdown_mode: str = 'fast',
+    pool_size: int | None = None,
+    profile: str | None = None,
+    tmpfs_size: int | None = None,
+    from_snapshot: str | None = None,
+    watchdog_interval: float | None = None,
+    background_cleanup: bool = False,
+    structured_log: bool = False,
+    slow_query_ms: int | None = None,
+) -> PostgresServer:
     """Returns handle to postgresql server instance for the given pgdata directory.
     Args:
         pgdata: pddata directory. If the pgdata directory does not exist, it will be created, but its
@@ -304,10 +1364,104 @@ def get_server(pgdata: Path | str, cleanup_mode: str | None = 'stop') -> Postgre
         cleanup_mode: If 'stop', the server will be stopped when the last handle is closed (default)
                         If 'delete', the server will be stopped and the pgdata directory will be deleted.
                         If None, the server will not be stopped or deleted.
+        use_template: If True (default), a new pgdata directory is populated by copying a cached template cluster
+                        (using copy-on-write clones where the file system supports them) instead of running initdb.
+                        Falls back on initdb if the template cannot be used.
+        start_mode: If 'pg_ctl' (default), the server is started and stopped with pg_ctl.
+                        If 'direct', the postgres binary is spawned directly and stopped by signalling it, avoiding
+                        the pg_ctl process and its polling. Not supported on Windows.
+        shutdown_mode: How the server is stopped on cleanup, as in `pg_ctl stop -m`: 'smart' (wait for clients to
+                        disconnect), 'fast' (default; roll back open transactions) or 'immediate' (abort, recovery
+                        runs on the next start).
+        pool_size: If set, a transaction-level connection pooler is run in front of the server, multiplexing client
+                        connections onto at most this many server connections; use get_uri(pooled=True) to connect
+                        to it. Session state does not persist across transactions. Not supported on Windows.
+        profile: Name of a tuning profile, applied when the server is started: 'ephemeral-test' (durability off),
+                        'bulk-load', 'analytics' or 'low-memory'. Memory and parallelism settings are sized from the
+                        cpus and memory of this machine. If None (default), postgres defaults are used.
+        tmpfs_size: If set, the data files, WAL and temporary files of a new pgdata are placed on a RAM-backed tmpfs
+                        (/dev/shm), for servers that need not survive a reboot; requires cleanup_mode='delete'.
+                        The value (in bytes) must fit on the tmpfs, and caps temporary files and WAL; it is
+                        not a hard limit on table data. Implies profile='ephemeral-test' unless a profile is given.
+        from_snapshot: Name of a snapshot (see PostgresServer.snapshot()) to populate a new pgdata directory with,
+                        instead of an empty cluster. Files are cloned where the file system supports it, so this is
+                        near-instant regardless of the size of the snapshot. Ignored if pgdata is already initialized.
+        watchdog_interval: If set, a watchdog thread checks every this many seconds that the postmaster is alive, and
+                        restarts the server (with backoff) when it died, eg killed by the OOM killer. Register
+                        callbacks with server.watchdog.add_callback() to learn about restarts, eg to drop pooled
+                        connections. See watchdog.Watchdog.
+        background_cleanup: If True, the cleanup of the last handle does not wait for the server to stop or for pgdata
+                        to be deleted: it signals the shutdown (per shutdown_mode), renames a pgdata to be deleted
+                        out of the way, and leaves the rest to a detached process (see reaper), so that eg
+                        short-lived CLI invocations and test workers exit immediately. Not supported on Windows.
+        structured_log: If True, the server writes its log as jsonlog files in pgdata/pg_log, rotated by size and age,
+                        which server.log_tail() reads incrementally as entries, logging records or slow queries (see
+                        serverlog). Otherwise, it writes plain text to the single file pgdata/log. Applied when the
+                        server starts; ignored if it is already running.
+        slow_query_ms: With structured_log, statements running for at least this many milliseconds are logged, and
+                        reported by log_tail().slow_queries(). None (the default) logs none; 0 logs all statements.
 
         To create a temporary server, use mkdtemp() to create a temporary directory and pass it as pg_data,
         and set cleanup_mode to 'delete'.
     """
+    PostgresServer._check_options(
+        cleanup_mode=cleanup_mode,
+        start_mode=start_mode,
+        shutdown_mode=shutdown_mode,
+        pool_size=pool_size,
+        profile=profile,
+        tmpfs_size=tmpfs_size,
+        watchdog_interval=watchdog_interval,
+        background_cleanup=background_cleanup,
+        structured_log=structured_log,
+        slow_query_ms=slow_query_ms,
+    )
+    pgdata = _resolve_pgdata(pgdata)
+    if pgdata in PostgresServer._instances:
+        return PostgresServer._instances[pgdata]
+
+    return PostgresServer(
+        pgdata,
+        cleanup_mode=cleanup_mode,
+        use_template=use_template,
+        start_mode=start_mode,
+        shutdown_mode=shutdown_mode,
+        pool_size=pool_size,
+        profile=profile,
+        tmpfs_size=tmpfs_size,
+        from_snapshot=from_snapshot,
+        watchdog_interval=watchdog_interval,
+        background_cleanup=background_cleanup,
+        structured_log=structured_log,
+        slow_query_ms=slow_query_ms,
+    )
+
+
+def attach_server(handle: ServerHandle) -> PostgresServer:
+    """Returns a handle to the server described by `handle` (see PostgresServer.export_handle()), for worker processes.
+    If the server is still running, attaching skips initialization and inspection of the server; otherwise it is
+    started as by get_server(). Raises FileNotFoundError if pgdata was deleted (eg by cleanup_mode='delete').
+    """
+    if handle.pgdata in PostgresServer._instances:
+        return PostgresServer._instances[handle.pgdata]
+    for name, path in handle.shared_paths.items():
+        if getattr(PostgresServer, name) is None:
+            setattr(PostgresServer, name, path)
+    return PostgresServer(handle.pgdata, **handle.options, handle=handle)
+
+
+async def get_server_async(pgdata: Path | str, cleanup_mode: str | None = 'stop', **kwargs: Any) -> PostgresServer:
+    """Async counterpart of get_server(), taking the same arguments.
+    The lock is awaited without blocking the event loop, and initialization and startup run in a worker thread,
+    so that many servers can be brought up from a single event loop.
+    """
+    # get_server() checks the arguments before creating pgdata
+    pgdata = _resolve_pgdata(pgdata, create=False)
+    async with PostgresServer._alocked(pgdata):
+        return await asyncio.to_thread(get_server, pgdata, cleanup_mode, **kwargs)
+
+
+def _resolve_pgdata(pgdata: Path | str, create: bool = True) -> Path:
     if isinstance(pgdata, str):
         pgdata = Path(pgdata)
     pgdata = pgdata.expanduser().resolve()
@@ -315,10 +1469,11 @@ def get_server(pgdata: Path | str, cleanup_mode: str | None = 'stop') -> Postgre
     if not pgdata.parent.exists():
         raise FileNotFoundError(f'Parent directory of pgdata does not exist: {pgdata.parent}')
 
-    if not pgdata.exists():
+    if create and not pgdata.exists():
         pgdata.mkdir(parents=False, exist_ok=False)
 
-    if pgdata in PostgresServer._instances:
-        return PostgresServer._instances[pgdata]
+    return pgdata
 
-    return PostgresServer(pgdata, cleanup_mode=cleanup_mode)
+
+if platform.system() != 'Windows':
+    os.register_at_fork(after_in_child=PostgresServer._forget_inherited)
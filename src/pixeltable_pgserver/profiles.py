@@ -0,0 +1,155 @@
+"""Workload-specific postgresql.conf settings, sized for the machine the server runs on.
+
+The settings of the selected profile are written to a managed include file in pgdata (TUNING_CONF), which
+postgresql.conf includes. Hand-made changes to postgresql.conf are left alone, but settings in the include file
+take precedence over them (the include directive is appended at the end).
+"""
+
+import logging
+import platform
+import re
+from pathlib import Path
+
+import psutil
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+TUNING_CONF = 'pgserver.tuning.conf'
+PROFILES = ('ephemeral-test', 'bulk-load', 'analytics', 'low-memory')
+
+_MB = 1024 * 1024
+
+
+def _mb(n_bytes: float, lo_mb: int, hi_mb: int) -> str:
+    """Formats a byte count as a postgres memory setting in MB, clamped to [lo_mb, hi_mb]."""
+    return f'{int(min(max(n_bytes / _MB, lo_mb), hi_mb))}MB'
+
+
+def profile_settings(profile: str, cpus: int | None = None, memory: int | None = None) -> dict[str, str]:
+    """Returns the settings of `profile` for a machine with the given number of cpus and bytes of memory
+    (by default, those of this machine).
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile {profile!r}; expected one of {PROFILES}')
+    if cpus is None:
+        cpus = psutil.cpu_count() or 1
+    if memory is None:
+        memory = psutil.virtual_memory().total
+
+    # without WAL archiving or replication, data loaded into tables created in the same transaction skips the WAL
+    no_replication = {'wal_level': 'minimal', 'max_wal_senders': '0', 'archive_mode': 'off'}
+    # trades durability for speed: a crash (of the host, not just postgres) can lose or corrupt data
+    no_durability = {'fsync': 'off', 'synchronous_commit': 'off', 'full_page_writes': 'off'}
+
+    settings: dict[str, str]
+    if profile == 'ephemeral-test':
+        settings = {
+            'shared_buffers': _mb(memory / 16, 32, 512),
+            'effective_cache_size': _mb(memory / 4, 128, 4096),
+            'work_mem': '8MB',
+            'maintenance_work_mem': '64MB',
+            'max_worker_processes': str(max(cpus, 8)),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': '0',
+            'max_wal_size': '1GB',
+            'checkpoint_timeout': '1h',
+            **no_replication,
+            **no_durability,
+        }
+    elif profile == 'bulk-load':
+        settings = {
+            'shared_buffers': _mb(memory / 4, 128, 8192),
+            'effective_cache_size': _mb(memory / 2, 256, 65536),
+            'work_mem': _mb(memory / (cpus * 16), 16, 256),
+            'maintenance_work_mem': _mb(memory / 16, 64, 2048),
+            'max_worker_processes': str(max(cpus, 8)),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': str(min(max(cpus // 4, 1), 4)),
+            'max_parallel_maintenance_workers': str(min(max(cpus // 2, 1), 8)),
+            'wal_buffers': '64MB',
+            'max_wal_size': _mb(memory / 4, 2048, 16384),
+            'checkpoint_timeout': '30min',
+            'checkpoint_completion_target': '0.9',
+            'synchronous_commit': 'off',
+            **no_replication,
+        }
+    elif profile == 'analytics':
+        settings = {
+            'shared_buffers': _mb(memory / 4, 128, 16384),
+            'effective_cache_size': _mb(memory * 3 / 4, 256, 131072),
+            'work_mem': _mb(memory / (cpus * 8), 16, 1024),
+            'maintenance_work_mem': _mb(memory / 16, 64, 2048),
+            'max_worker_processes': str(max(cpus, 8)),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': str(min(max(cpus // 2, 2), 8)),
+            'max_parallel_maintenance_workers': str(min(max(cpus // 2, 1), 8)),
+            'max_wal_size': '4GB',
+            'checkpoint_completion_target': '0.9',
+            'random_page_cost': '1.1',
+        }
+        if platform.system() == 'Linux':
+            # must be 0 on platforms without posix_fadvise (eg macOS)
+            settings['effective_io_concurrency'] = '200'
+    else:  # low-memory
+        settings = {
+            'shared_buffers': '16MB',
+            'effective_cache_size': _mb(memory / 8, 64, 1024),
+            'work_mem': '1MB',
+            'maintenance_work_mem': '16MB',
+            'max_connections': '20',
+            'max_worker_processes': '2',
+            'max_parallel_workers': '0',
+            'max_parallel_workers_per_gather': '0',
+            'max_parallel_maintenance_workers': '0',
+            'autovacuum_max_workers': '1',
+            'wal_buffers': '1MB',
+            'max_wal_size': '256MB',
+        }
+
+    return settings
+
+
+def write_tuning_conf(pgdata: Path, profile: str | None, overrides: dict[str, str] | None = None) -> None:
+    """Writes the settings of `profile` plus `overrides` to the managed include file in pgdata, or removes the file
+    if there are none. Takes effect at the next server start.
+    """
+    conf_path = pgdata / TUNING_CONF
+    settings = {} if profile is None else profile_settings(profile)
+    settings.update(overrides or {})
+    if len(settings) == 0:
+        conf_path.unlink(missing_ok=True)
+        return
+
+    _logger.info(f'Applying profile {profile!r}: {settings}')
+    lines = [f'# Managed by pixeltable_pgserver (profile {profile!r}); changes will be overwritten', '']
+    lines += [f"{name} = '{value}'" for name, value in settings.items()]
+    conf_path.write_text('\n'.join(lines) + '\n')
+    ensure_included(pgdata, TUNING_CONF)
+
+
+def configured_setting(pgdata: Path, name: str) -> str | None:
+    """Returns the value of setting `name` in postgresql.conf or postgresql.auto.conf (ALTER SYSTEM) of pgdata, or
+    None if neither sets it. Files included by postgresql.conf (such as TUNING_CONF) are not read.
+    """
+    pattern = re.compile(rf"\s*{re.escape(name)}(?![\w.])\s*=?\s*('(?:[^']|'')*'|[^\s#]+)", re.IGNORECASE)
+    value = None
+    for conf_name in ('postgresql.conf', 'postgresql.auto.conf'):  # in the order postgres reads them
+        conf_path = pgdata / conf_name
+        if not conf_path.exists():
+            continue
+        for line in conf_path.read_text().splitlines():
+            match = pattern.match(line)
+            if match is not None:  # the last one wins
+                value = match[1]
+    if value is not None and value.startswith("'"):
+        value = value[1:-1].replace("''", "'")
+    return value
+
+
+def ensure_included(pgdata: Path, conf_name: str) -> None:
+    """Ensures postgresql.conf includes the (optional) file conf_name in pgdata."""
+    postgresql_conf = pgdata / 'postgresql.conf'
+    directive = f"include_if_exists = '{conf_name}'"
+    if directive not in postgresql_conf.read_text().splitlines():
+        with open(postgresql_conf, 'a', encoding='utf-8') as f:
+            f.write(f'\n{directive}\n')
@@ -0,0 +1,67 @@
+"""Helpers for the PostgreSQL frontend/backend wire protocol (version 3.0).
+See https://www.postgresql.org/docs/current/protocol-message-formats.html
+"""
+
+import struct
+
+PROTOCOL_VERSION = 196608  # 3.0
+SSL_REQUEST_CODE = 80877103
+GSSENC_REQUEST_CODE = 80877104
+CANCEL_REQUEST_CODE = 80877102
+
+# ErrorResponse/NoticeResponse field codes
+ERROR_FIELDS = {
+    b'S': 'severity',
+    b'V': 'severity_nonlocalized',
+    b'C': 'code',
+    b'M': 'message',
+    b'D': 'detail',
+    b'H': 'hint',
+    b'P': 'position',
+    b'W': 'where',
+}
+
+
+def message(msg_type: bytes, payload: bytes = b'') -> bytes:
+    """Frames a message: type byte, then the int32 length of the payload plus the length field itself."""
+    return msg_type + struct.pack('!i', len(payload) + 4) + payload
+
+
+def cstring(value: str) -> bytes:
+    return value.encode() + b'\x00'
+
+
+def startup_message(params: dict[str, str]) -> bytes:
+    payload = struct.pack('!i', PROTOCOL_VERSION)
+    payload += b''.join(cstring(k) + cstring(v) for k, v in params.items()) + b'\x00'
+    return struct.pack('!i', len(payload) + 4) + payload
+
+
+def parse_startup_parameters(payload: bytes) -> dict[str, str]:
+    """Parses the key/value pairs of a StartupMessage payload (after the protocol version)."""
+    parts = payload.split(b'\x00')
+    params: dict[str, str] = {}
+    for key, value in zip(parts[0::2], parts[1::2]):
+        if not key:
+            break
+        params[key.decode()] = value.decode()
+    return params
+
+
+def cancel_request(pid: int, secret: int) -> bytes:
+    return struct.pack('!iiii', 16, CANCEL_REQUEST_CODE, pid, secret)
+
+
+def parse_error_fields(payload: bytes) -> dict[str, str]:
+    """Parses the payload of an ErrorResponse or NoticeResponse message."""
+    fields: dict[str, str] = {}
+    for field in payload.split(b'\x00'):
+        if field:
+            fields[ERROR_FIELDS.get(field[:1], field[:1].decode())] = field[1:].decode(errors='replace')
+    return fields
+
+
+def error_response(message_text: str, code: str = '08006', severity: str = 'FATAL') -> bytes:
+    payload = b'S' + cstring(severity) + b'V' + cstring(severity) + b'C' + cstring(code)
+    payload += b'M' + cstring(message_text) + b'\x00'
+    return message(b'E', payload)
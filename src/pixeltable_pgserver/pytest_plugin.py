@@ -0,0 +1,51 @@
+"""pytest fixtures handing out isolated servers from a ServerPool.
+
+The plugin is registered through the `pytest11` entry point, so the fixtures are available once pixeltable-pgserver
+is installed:
+
+    def test_something(pgserver):
+        pgserver.query('create table t (i int)')
+
+Each test gets a server of its own, reset after the test. The pool is per pytest process, so that every pytest-xdist
+worker has its own; its size is set with --pgserver-pool-size.
+"""
+
+from typing import TYPE_CHECKING, Iterator
+
+import pytest
+
+if TYPE_CHECKING:
+    # imported when the fixtures are used, not whenever pytest loads the plugin
+    from .postgres_server import PostgresServer
+    from .server_pool import ServerPool
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    group = parser.getgroup('pixeltable-pgserver')
+    group.addoption(
+        '--pgserver-pool-size',
+        type=int,
+        default=2,
+        help='number of servers kept running by the pgserver fixture (per pytest process)',
+    )
+
+
+@pytest.fixture(scope='session')
+def pgserver_pool(request: pytest.FixtureRequest, tmp_path_factory: pytest.TempPathFactory) -> Iterator['ServerPool']:
+    """The ServerPool of this pytest process."""
+    from .server_pool import ServerPool
+
+    with ServerPool(
+        request.config.getoption('pgserver_pool_size'), root=tmp_path_factory.mktemp('pgserver_pool')
+    ) as pool:
+        yield pool
+
+
+@pytest.fixture
+def pgserver(pgserver_pool: 'ServerPool') -> Iterator['PostgresServer']:
+    """A running server for the exclusive use of the test."""
+    server = pgserver_pool.acquire()
+    try:
+        yield server
+    finally:
+        pgserver_pool.release(server)
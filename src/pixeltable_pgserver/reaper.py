@@ -0,0 +1,62 @@
+"""Finishes stopping a server, and deleting its data, in a detached process, so that the process cleaning up the
+server need not wait for either (see get_server(..., background_cleanup=True)).
+
+PostgresServer signals the postmaster to shut down, renames a pgdata to be deleted out of the way, and spawns:
+    python -m pixeltable_pgserver.reaper [--pid PID --create-time T] [--delete PATH ...]
+which waits for the postmaster to exit, escalating to an immediate shutdown and then SIGKILL if it does not exit in
+time, and then deletes the given paths.
+"""
+
+import argparse
+import logging
+import shutil
+import signal
+from contextlib import suppress
+from pathlib import Path
+
+import psutil
+
+from .utils import wait_for_process_exit
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+
+def reap(pid: int | None, create_time: float | None, paths: list[Path], timeout: float = 60.0) -> None:
+    """Waits for the postmaster `pid` to exit (if it is the process created at `create_time`), then deletes `paths`."""
+    process: psutil.Process | None = None
+    if pid is not None:
+        with suppress(psutil.NoSuchProcess):
+            process = psutil.Process(pid)
+            if create_time is not None and process.create_time() != create_time:
+                process = None  # the postmaster is gone, and its pid reused
+
+    if process is not None and not wait_for_process_exit(process, timeout):
+        _logger.warning(f'Postmaster {pid} did not stop within {timeout}s; shutting it down immediately')
+        # an immediate shutdown (as `pg_ctl stop -m immediate`), then SIGKILL
+        for sig in (signal.SIGQUIT, signal.SIGKILL):
+            try:
+                process.send_signal(sig)
+            except psutil.NoSuchProcess:
+                break
+            if wait_for_process_exit(process, 5.0):
+                break
+
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+        _logger.info(f'Deleted {path}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Finishes the shutdown and deletion of a pixeltable_pgserver server')
+    parser.add_argument('--pid', type=int, help='pid of the postmaster, which was signalled to stop')
+    parser.add_argument('--create-time', type=float, help='creation time of the postmaster (psutil.create_time())')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait before escalating')
+    parser.add_argument('--delete', type=Path, action='append', default=[], help='path to delete once it stopped')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    reap(args.pid, args.create_time, args.delete, args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""A pool of pre-started ephemeral servers, for test suites and worker fleets that need many isolated servers.
+
+Servers are started in the background, so that acquire() usually returns a running server without waiting for its
+initialization. On release(), a server is reset to a pristine state and handed out again, or replaced by a new one if
+the reset is not possible, so that the pool never runs more than its size. See pytest_plugin for fixtures built on
+top of it.
+"""
+
+import logging
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import TracebackType
+from typing import Any
+
+from typing_extensions import Self
+
+from .client import quote_ident
+from .postgres_server import PostgresServer, get_server
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+
+class ServerPool:
+    """Keeps `size` servers running, each on its own temporary pgdata (under `root`, if given).
+    acquire() waits for a server to be released if all of them are in use.
+    `server_kwargs` are passed to get_server(); the servers always use cleanup_mode='delete', and default to
+    profile='ephemeral-test'.
+
+    If `recycle` is True, released servers are always discarded and replaced, instead of being reset. A reset drops
+    and recreates every database except template0 and template1, and drops the roles created since the server
+    started, but does not undo server-wide changes such as ALTER SYSTEM settings or changes to template1.
+    """
+
+    def __init__(self, size: int = 2, *, root: Path | str | None = None, recycle: bool = False, **server_kwargs: Any):
+        assert size > 0
+        if 'cleanup_mode' in server_kwargs:
+            raise ValueError('ServerPool servers always use cleanup_mode="delete"')
+        self.size = size
+        self.root = Path(root) if root is not None else None
+        self.recycle = recycle
+        self.server_kwargs = {'profile': 'ephemeral-test', **server_kwargs}
+        # servers ready to be handed out, or the exception raised while starting one
+        self._idle: queue.Queue[PostgresServer | BaseException] = queue.Queue()
+        self._in_use: set[PostgresServer] = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        # servers start in parallel, as each pgdata has its own lock
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix='pgserver-pool')
+        for _ in range(size):
+            self._executor.submit(self._start_server)
+
+    def acquire(self, timeout: float | None = None) -> PostgresServer:
+        """Returns a running server for exclusive use until release(), waiting for one to be ready (or released) if
+        needed. Raises TimeoutError after `timeout` seconds.
+        """
+        if self._closed:
+            raise RuntimeError('ServerPool is closed')
+        try:
+            item = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f'No server became available within {timeout}s') from None
+        if isinstance(item, BaseException):
+            self._executor.submit(self._start_server)  # in place of the server that failed to start
+            raise item
+        with self._lock:
+            self._in_use.add(item)
+        return item
+
+    def release(self, server: PostgresServer) -> None:
+        """Returns a server obtained from acquire(). It is reset (or replaced) in the background."""
+        with self._lock:
+            self._in_use.remove(server)
+        if self._closed:
+            server.cleanup()
+            return
+        self._executor.submit(self._recycle_server, server)
+
+    def close(self) -> None:
+        """Stops and deletes all servers of the pool, including those that have not been released."""
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            servers = list(self._in_use)
+            self._in_use.clear()
+        while not self._idle.empty():
+            item = self._idle.get_nowait()
+            if isinstance(item, PostgresServer):
+                servers.append(item)
+        for server in servers:
+            try:
+                server.cleanup()
+            except Exception:
+                _logger.warning(f'Failed to clean up pooled server {server.pgdata}', exc_info=True)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self, exc_type: type[BaseException] | None, exc_val: BaseException | None, exc_tb: TracebackType | None
+    ) -> None:
+        self.close()
+
+    def _start_server(self) -> None:
+        if self._closed:
+            return
+        try:
+            pgdata = Path(tempfile.mkdtemp(prefix='pgserver-pool-', dir=self.root))
+            server = get_server(pgdata, cleanup_mode='delete', **self.server_kwargs)
+        except Exception as exc:
+            _logger.warning('Failed to start a pooled server', exc_info=True)
+            self._idle.put(exc)
+            return
+        self._idle.put(server)
+
+    def _recycle_server(self, server: PostgresServer) -> None:
+        if not self.recycle:
+            try:
+                reset_server(server)
+                self._idle.put(server)
+                return
+            except Exception:
+                _logger.warning(f'Failed to reset pooled server {server.pgdata}; replacing it', exc_info=True)
+        try:
+            server.cleanup()
+        except Exception:
+            _logger.warning(f'Failed to clean up pooled server {server.pgdata}', exc_info=True)
+        self._start_server()
+
+
+def reset_server(server: PostgresServer) -> None:
+    """Drops every database except template0 and template1 and every role except the superuser, then recreates the
+    'postgres' database. Open connections are terminated.
+    """
+    if not server.get_postmaster_info().is_running():
+        raise RuntimeError(f'Server for {server.pgdata} is not running')
+    server._close_connections()
+    databases = server.query("select datname from pg_database where datname not in ('template0', 'template1')")
+    server.drop_databases([name for (name,) in databases])
+    with server.connect('template1') as conn:
+        roles = conn.execute(
+            "select rolname from pg_roles where rolname !~ '^pg_' and rolname <> $1", [server.postgres_user]
+        )
+        for (name,) in roles:
+            conn.execute(f'drop role {quote_ident(name)}')
+        conn.execute('create database postgres')
@@ -0,0 +1,240 @@
+"""Structured server logs: the logging collector writing jsonlog files, rotated by size and age, and a tail that
+parses them incrementally into Python logging records and slow-query events.
+
+Enabled with get_server(..., structured_log=True); statements running for at least slow_query_ms are logged as well.
+The files are written to LOG_DIR in pgdata, one JSON object per line, named after the time they were started, so that
+their names sort chronologically. Postgres does not delete old files: the oldest beyond MAX_LOG_FILES are deleted when
+the server starts and whenever a LogTail follows a rotation.
+
+    tail = server.log_tail()
+    ...
+    for query in tail.slow_queries():
+        print(query.duration_ms, query.statement)
+
+See https://www.postgresql.org/docs/current/runtime-config-logging.html for the format.
+"""
+
+import dataclasses
+import datetime as dt
+import json
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import Any, Iterator
+
+_logger = logging.getLogger('pixeltable_pgserver')
+# the logger that LogTail.emit() logs server entries to
+server_logger = logging.getLogger('pixeltable_pgserver.postgres')
+
+LOG_DIR = 'pg_log'
+ROTATION_SIZE = '10MB'
+ROTATION_AGE = '1d'
+MAX_LOG_FILES = 10
+# how much of the end of a log is shown when the server fails to start
+TAIL_BYTES = 64 * 1024
+
+# python logging levels of the error_severity values of postgres
+_LEVELS = {
+    'DEBUG1': logging.DEBUG,
+    'DEBUG2': logging.DEBUG,
+    'DEBUG3': logging.DEBUG,
+    'DEBUG4': logging.DEBUG,
+    'DEBUG5': logging.DEBUG,
+    'LOG': logging.INFO,
+    'INFO': logging.INFO,
+    'NOTICE': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'FATAL': logging.CRITICAL,
+    'PANIC': logging.CRITICAL,
+}
+
+# as logged by log_min_duration_statement, for the simple ('statement') and extended query protocols
+_DURATION_RE = re.compile(
+    r'duration: (?P<ms>[\d.]+) ms  (?P<phase>statement|parse|bind|execute)[^:]*: (?P<sql>.*)', re.DOTALL
+)
+
+
+def log_settings(slow_query_ms: int | None) -> dict[str, str]:
+    """Settings that make the server write jsonlog files to LOG_DIR, and log statements taking slow_query_ms or more."""
+    settings = {
+        'logging_collector': 'on',
+        'log_destination': 'jsonlog',
+        'log_directory': LOG_DIR,
+        'log_filename': 'postgresql-%Y%m%d-%H%M%S.log',  # jsonlog files get the extension .json instead
+        'log_rotation_size': ROTATION_SIZE,
+        'log_rotation_age': ROTATION_AGE,
+        'log_timezone': 'UTC',  # so that timestamps parse without a timezone database
+    }
+    if slow_query_ms is not None:
+        settings['log_min_duration_statement'] = str(slow_query_ms)
+    return settings
+
+
+def log_files(pgdata: Path) -> list[Path]:
+    """The jsonlog files of the server of pgdata, oldest first."""
+    return sorted((pgdata / LOG_DIR).glob('*.json'))
+
+
+def prune_log_files(pgdata: Path, keep: int = MAX_LOG_FILES) -> None:
+    """Deletes the oldest jsonlog files of pgdata beyond the newest `keep`."""
+    for path in log_files(pgdata)[:-keep]:
+        path.unlink(missing_ok=True)
+        _logger.info(f'Deleted old server log {path}')
+
+
+def read_tail(path: Path, max_bytes: int = TAIL_BYTES) -> str:
+    """Returns the last max_bytes of the file at path (all of it, if shorter), without reading the rest."""
+    try:
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            f.seek(max(size - max_bytes, 0))
+            data = f.read()
+    except FileNotFoundError:
+        return ''
+    prefix = f'[... {size - max_bytes} bytes omitted ...]\n' if size > max_bytes else ''
+    return prefix + data.decode('utf-8', errors='replace')
+
+
+@dataclasses.dataclass(frozen=True)
+class SlowQuery:
+    """A statement that ran for at least slow_query_ms, as logged by the server."""
+
+    timestamp: dt.datetime
+    pid: int | None
+    dbname: str | None
+    user: str | None
+    duration_ms: float
+    # 'statement' (simple query protocol), or the 'parse', 'bind' or 'execute' step (extended query protocol)
+    phase: str
+    statement: str
+
+
+def parse_timestamp(value: str) -> dt.datetime:
+    """Parses a jsonlog timestamp, eg '2024-05-01 12:00:00.123 UTC' (see log_settings())."""
+    text, _, zone = value.rpartition(' ')
+    if zone != 'UTC':
+        raise ValueError(f'Expected a UTC timestamp, got {value!r}')
+    return dt.datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f').replace(tzinfo=dt.timezone.utc)
+
+
+def parse_slow_query(entry: dict[str, Any]) -> SlowQuery | None:
+    """Returns the slow query logged by a jsonlog entry, or None if the entry is not one."""
+    match = _DURATION_RE.fullmatch(entry.get('message', ''))
+    if match is None:
+        return None
+    return SlowQuery(
+        timestamp=parse_timestamp(entry['timestamp']),
+        pid=entry.get('pid'),
+        dbname=entry.get('dbname'),
+        user=entry.get('user'),
+        duration_ms=float(match['ms']),
+        phase=match['phase'],
+        statement=match['sql'],
+    )
+
+
+def to_record(entry: dict[str, Any], logger: logging.Logger = server_logger) -> logging.LogRecord:
+    """Converts a jsonlog entry into a logging record of `logger`, at the level of its severity.
+    The entry is available as record.pg, and its slow query (if it is one) as record.slow_query.
+    """
+    level = _LEVELS.get(entry.get('error_severity', ''), logging.INFO)
+    message = entry.get('message', '')
+    if 'detail' in entry:
+        message += f'\nDETAIL: {entry["detail"]}'
+    if 'statement' in entry:
+        message += f'\nSTATEMENT: {entry["statement"]}'
+    record = logger.makeRecord(
+        logger.name,
+        level,
+        entry.get('file_name', '(postgres)'),
+        entry.get('file_line_num', 0),
+        message,
+        (),
+        None,
+        func=entry.get('func_name'),
+        extra={'pg': entry, 'slow_query': parse_slow_query(entry)},
+    )
+    if 'timestamp' in entry:
+        record.created = parse_timestamp(entry['timestamp']).timestamp()
+        record.msecs = (record.created % 1) * 1000
+    return record
+
+
+class LogTail:
+    """Reads the entries appended to the jsonlog files of the server of `pgdata`, following rotations.
+    Each call of read() (and of the methods built on it) returns the entries written since the previous call; an
+    entry still being written is returned once it is complete. Starts at the end of the current file, or at the
+    beginning of the oldest one with from_start=True.
+    """
+
+    def __init__(self, pgdata: Path, from_start: bool = False, keep: int = MAX_LOG_FILES):
+        self.pgdata = pgdata
+        self.keep = keep
+        files = log_files(pgdata)
+        self._path: Path | None = None
+        self._offset = 0
+        if from_start and files:
+            self._path = files[0]
+        elif files:
+            self._path = files[-1]
+            self._offset = self._path.stat().st_size
+
+    def read(self) -> list[dict[str, Any]]:
+        """Returns the complete entries written since the previous call."""
+        files = log_files(self.pgdata)
+        if self._path is None:
+            if not files:
+                return []
+            self._path = files[0]
+        entries = self._read_from(self._path)
+        later = [path for path in files if path.name > self._path.name]
+        for path in later:  # rotated: the rest of the previous file is read above, the newer ones from the start
+            self._path, self._offset = path, 0
+            entries += self._read_from(path)
+        if later:
+            prune_log_files(self.pgdata, self.keep)
+        return entries
+
+    def _read_from(self, path: Path) -> list[dict[str, Any]]:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:  # pruned
+            return []
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        entries = []
+        for line in data[:end].splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                _logger.debug(f'Skipping malformed line in {path}: {line[:200]!r}')
+        return entries
+
+    def records(self, logger: logging.Logger = server_logger) -> list[logging.LogRecord]:
+        """Like read(), as logging records (see to_record())."""
+        return [to_record(entry, logger) for entry in self.read()]
+
+    def slow_queries(self) -> list[SlowQuery]:
+        """Like read(), keeping only the slow queries."""
+        return [query for query in map(parse_slow_query, self.read()) if query is not None]
+
+    def emit(self, logger: logging.Logger = server_logger) -> int:
+        """Passes the new entries to the handlers of `logger` (subject to its level). Returns their number."""
+        records = self.records(logger)
+        for record in records:
+            if logger.isEnabledFor(record.levelno):
+                logger.handle(record)
+        return len(records)
+
+    def follow(self, interval: float = 0.5, stop: threading.Event | None = None) -> Iterator[dict[str, Any]]:
+        """Yields entries as they are written, checking every `interval` seconds, until `stop` is set."""
+        stop = stop or threading.Event()
+        while True:
+            yield from self.read()
+            if stop.is_set():
+                return
+            stop.wait(interval)
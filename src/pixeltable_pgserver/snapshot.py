@@ -0,0 +1,47 @@
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+from .serverlog import LOG_DIR
+from .utils import copy_tree_cow
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+# runtime state and logs of a server, which do not belong in a snapshot
+SNAPSHOT_IGNORE = shutil.ignore_patterns(
+    'postmaster.pid', 'postmaster.opts', '.handles', 'log', LOG_DIR, 'pooler.log', '.pooler*'
+)
+
+
+def snapshot_path(snapshots_path: Path, name: str) -> Path:
+    if not name or name.startswith('.') or Path(name).name != name:
+        raise ValueError(f'Invalid snapshot name: {name!r}')
+    return snapshots_path / name
+
+
+def save_snapshot(pgdata: Path, snapshot: Path) -> None:
+    """Copies the pgdata of a stopped server to `snapshot`, replacing an existing snapshot of that name.
+    Files are cloned where the file system supports it. Hard links are not an option, as postgres modifies files in
+    place. The copy is made in a scratch directory and renamed into place, so a snapshot that exists is complete.
+    """
+    snapshot.parent.mkdir(parents=True, exist_ok=True)
+    scratch = Path(tempfile.mkdtemp(prefix=f'.{snapshot.name}-', dir=snapshot.parent))
+    try:
+        copy_tree_cow(pgdata, scratch, ignore=SNAPSHOT_IGNORE)
+        _move_into_place(scratch, snapshot)
+    except BaseException:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    _logger.info(f'Saved snapshot of {pgdata} to {snapshot}')
+
+
+def _move_into_place(scratch: Path, snapshot: Path) -> None:
+    """Renames the completed copy `scratch` to `snapshot`, replacing an existing snapshot of that name."""
+    if not snapshot.exists():
+        scratch.rename(snapshot)
+        return
+    old = Path(tempfile.mkdtemp(prefix=f'.{snapshot.name}-old-', dir=snapshot.parent))
+    snapshot.rename(old / snapshot.name)
+    scratch.rename(snapshot)
+    shutil.rmtree(old)
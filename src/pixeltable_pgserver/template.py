@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Sequence
+
+from .pgexec import pgexec
+from .utils import POSTGRES_BIN_PATH, copy_tree_cow
+
+if platform.system() != 'Windows':
+    from .utils import ensure_owned_by, ensure_prefix_permissions
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+# bump when the layout or contents of the templates change in an incompatible way
+TEMPLATE_FORMAT_VERSION = 1
+
+# the locale categories initdb takes from the environment
+_LOCALE_CATEGORIES = ('LC_COLLATE', 'LC_CTYPE', 'LC_MESSAGES', 'LC_MONETARY', 'LC_NUMERIC', 'LC_TIME')
+
+
+def initdb_args(postgres_user: str) -> tuple[str, ...]:
+    """Returns the initdb arguments used for every new pgdata (excluding the -D target directory)."""
+    return ('--auth=trust', '--auth-local=trust', '--encoding=utf8', '-U', postgres_user)
+
+
+def template_key(args: Sequence[str], system_user: str | None) -> str:
+    """Returns a key identifying a template cluster.
+    The key covers the postgres binaries (a different build or version yields a different key),
+    the initdb settings (encoding, auth, superuser), the locale initdb picks up from the environment, and the system
+    user owning the files.
+    """
+    postgres_bin = POSTGRES_BIN_PATH / ('postgres.exe' if platform.system() == 'Windows' else 'postgres')
+    st = postgres_bin.stat()
+    identity = [
+        TEMPLATE_FORMAT_VERSION,
+        str(POSTGRES_BIN_PATH),
+        st.st_size,
+        st.st_mtime_ns,
+        list(args),
+        _initdb_locale(),
+        system_user,
+    ]
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()[:16]
+
+
+def _initdb_locale() -> dict[str, str]:
+    """Returns the locale of each category as initdb sees it: LC_ALL overrides LC_<category>, which overrides LANG."""
+    env = os.environ
+    return {
+        category: env.get('LC_ALL') or env.get(category) or env.get('LANG') or 'C' for category in _LOCALE_CATEGORIES
+    }
+
+
+def ensure_template(templates_path: Path, args: Sequence[str], system_user: str | None = None) -> Path:
+    """Returns the path of an initialized template cluster for the given initdb args, creating it if needed.
+    The template is built in a scratch directory and renamed into place, so a template that exists is complete.
+    """
+    templates_path.mkdir(parents=True, exist_ok=True)
+    key = template_key(args, system_user)
+    template = templates_path / key
+    if (template / 'PG_VERSION').exists():
+        return template
+
+    import fasteners  # type: ignore[import-untyped]
+
+    with fasteners.InterProcessLock(templates_path / f'.{key}.lock'):
+        if (template / 'PG_VERSION').exists():  # created by another process while we waited
+            return template
+
+        _logger.info(f'Creating template cluster {template}')
+        scratch = Path(tempfile.mkdtemp(prefix=f'.{key}-', dir=templates_path))
+        try:
+            if system_user is not None:
+                ensure_prefix_permissions(scratch)
+                ensure_owned_by(scratch, system_user)
+            pgexec('initdb', (*args, '-D', str(scratch)), user=system_user)
+            scratch.rename(template)
+        except BaseException:
+            shutil.rmtree(scratch, ignore_errors=True)
+            raise
+
+    return template
+
+
+def init_from_template(pgdata: Path, template: Path, system_user: str | None = None) -> None:
+    """Populates the (empty) pgdata directory with a copy of the template cluster."""
+    copy_tree_cow(template, pgdata)
+    if system_user is not None:
+        ensure_owned_by(pgdata, system_user)
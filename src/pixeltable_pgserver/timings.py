@@ -0,0 +1,89 @@
+"""Timed spans of the phases of a server's lifecycle, for diagnosing slow startups and shutdowns.
+
+Each PostgresServer records its spans in `server.timings`. Callbacks registered with add_callback() receive every
+span as it completes, across all servers, eg to forward them to a metrics system.
+"""
+
+import dataclasses
+import logging
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+# in the order they occur; a phase that does not apply (eg initdb for an existing pgdata) is not recorded
+PHASES = (
+    'lock_wait',  # acquiring the inter-process lock
+    'stale_process_scan',  # looking for left-over servers on a new pgdata
+    'initdb',  # initdb, or copying the template cluster
+    'socket_dir_selection',
+    'start',  # pg_ctl start, or spawning the postmaster with start_mode='direct'
+    'readiness_wait',  # waiting for postmaster.pid to report the server ready
+    'recovery',  # restarting the server after its postmaster died (see watchdog)
+    'shutdown',  # stopping the pooler and the server
+    'delete',  # removing pgdata with cleanup_mode='delete'
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class Span:
+    phase: str
+    pgdata: Path
+    start: float  # wall-clock time (time.time())
+    duration: float  # seconds
+
+
+SpanCallback = Callable[[Span], None]
+_callbacks: list[SpanCallback] = []
+
+
+def add_callback(callback: SpanCallback) -> None:
+    """Registers a callback invoked with every completed span. Exceptions raised by callbacks are logged and ignored."""
+    _callbacks.append(callback)
+
+
+def remove_callback(callback: SpanCallback) -> None:
+    _callbacks.remove(callback)
+
+
+class Timings:
+    """The spans recorded for one server, in the order they completed."""
+
+    def __init__(self, pgdata: Path) -> None:
+        self.pgdata = pgdata
+        self.spans: list[Span] = []
+
+    @contextmanager
+    def span(self, phase: str) -> Iterator[None]:
+        """Records the time spent in the body as a span of `phase`, also if the body raises."""
+        assert phase in PHASES, phase
+        start, perf_start = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(Span(phase, self.pgdata, start, time.perf_counter() - perf_start))
+
+    def add(self, span: Span) -> None:
+        self.spans.append(span)
+        for callback in list(_callbacks):
+            try:
+                callback(span)
+            except Exception:
+                _logger.exception(f'Timing callback {callback!r} failed')
+
+    def __getitem__(self, phase: str) -> float:
+        """Returns the total seconds spent in `phase` (0.0 if it was not recorded)."""
+        return sum(span.duration for span in self.spans if span.phase == phase)
+
+    def as_dict(self) -> dict[str, float]:
+        """Returns the total seconds per recorded phase."""
+        totals: dict[str, float] = {}
+        for span in self.spans:
+            totals[span.phase] = totals.get(span.phase, 0.0) + span.duration
+        return totals
+
+    def __repr__(self) -> str:
+        phases = ', '.join(f'{phase}={seconds * 1000:.1f}ms' for phase, seconds in self.as_dict().items())
+        return f'Timings({phases})'
@@ -1,13 +1,18 @@
 import hashlib
 import json
 import logging
+import os
 import platform
+import shutil
 import socket
 import stat
 import subprocess
+import sys
+import time
+from contextlib import suppress
 from datetime import datetime
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable, ClassVar, Iterable, Iterator
 
 import psutil
 
@@ -44,11 +49,13 @@ class PostmasterInfo:
     port: int | None
     shmem_info: str
     status: str
-    process: psutil.Process | None
+
+    LINE_VARS = ('pid', 'pgdata', 'start_time', 'port', 'socket_dir', 'hostname', 'shared_memory_info', 'status')
 
     def __init__(self, lines: list[str]) -> None:
-        line_vars = ('pid', 'pgdata', 'start_time', 'port', 'socket_dir', 'hostname', 'shared_memory_info', 'status')
+        line_vars = self.LINE_VARS
         assert len(lines) == len(line_vars), f'line_vars: {line_vars=}\nlines: {lines=}'
+        self.lines = tuple(lines)
         clean_lines = (line.strip() for line in lines)
 
         raw: dict[str, str] = dict(zip(line_vars, clean_lines))
@@ -76,22 +83,31 @@ class PostmasterInfo:
         self.shmem_info = raw['shared_memory_info']
         self.status = raw['status']
 
-        self.process = None  # will be not None if process is running
-        self._init_process_meta()
+        self._process: psutil.Process | None = None
+        self._process_resolved = False
 
-    def _init_process_meta(self) -> None:
-        if self.pid is None:
-            return
-        try:
-            self.process = psutil.Process(self.pid)
-        except psutil.NoSuchProcess:
-            pass
-        # exact_create_time = datetime.datetime.fromtimestamp(process.create_time())
-        # if abs(self.start_time - exact_create_time) <= datetime.timedelta(seconds=1):
+    @property
+    def process(self) -> psutil.Process | None:
+        """The postmaster process; None if it was not running when first accessed. Resolved on first access, which
+        costs a few system calls that attaching from a ServerHandle avoids.
+        """
+        if not self._process_resolved:
+            self._process_resolved = True
+            try:
+                self._process = psutil.Process(self.pid)
+            except psutil.NoSuchProcess:
+                pass
+            # exact_create_time = datetime.datetime.fromtimestamp(process.create_time())
+            # if abs(self.start_time - exact_create_time) <= datetime.timedelta(seconds=1):
+        return self._process
 
     def is_running(self) -> bool:
         return self.process is not None and self.process.is_running()
 
+    def is_alive(self) -> bool:
+        """Like is_running(), but False for a postmaster that exited and was not reaped yet (a zombie)."""
+        return self.process is not None and process_is_alive(self.process)
+
     @classmethod
     def read_from_pgdata(cls, pgdata: Path) -> 'PostmasterInfo | None':
         postmaster_file = pgdata / 'postmaster.pid'
@@ -101,8 +117,12 @@ class PostmasterInfo:
         lines = postmaster_file.read_text().splitlines()
         return cls(lines)
 
-    def get_uri(self, user: str = 'postgres', database: str | None = None, driver: str | None = None) -> str:
-        """Returns a connection uri string for the postgresql server using the information in postmaster.pid"""
+    def get_uri(
+        self, user: str = 'postgres', database: str | None = None, driver: str | None = None, port: int | None = None
+    ) -> str:
+        """Returns a connection uri string for the postgresql server using the information in postmaster.pid.
+        If `port` is given, it replaces the server's port (eg to connect to a pooler in the same socket dir).
+        """
         if database is None:
             database = user
         if driver is None:
@@ -111,10 +131,11 @@ class PostmasterInfo:
             driver_suffix = f'+{driver}'
 
         if self.socket_dir is not None:
-            return f'postgresql{driver_suffix}://{user}:@/{database}?host={self.socket_dir}'
+            port_suffix = '' if port is None else f'&port={port}'
+            return f'postgresql{driver_suffix}://{user}:@/{database}?host={self.socket_dir}{port_suffix}'
         elif self.port is not None:
             assert self.hostname is not None
-            return f'postgresql{driver_suffix}://{user}:@{self.hostname}:{self.port}/{database}'
+            return f'postgresql{driver_suffix}://{user}:@{self.hostname}:{port or self.port}/{database}'
         else:
             raise RuntimeError('postmaster.pid does not contain port or socket information')
 
@@ -135,6 +156,21 @@ class PostmasterInfo:
             return self.socket_dir / f'.s.PGSQL.{self.port}'
         return None
 
+    def accepts_connections(self) -> bool:
+        """Returns True if something accepts connections on the server's socket (or port), without talking to it."""
+        if self.socket_path is not None:
+            family, address = socket.AF_UNIX, str(self.socket_path)
+        else:
+            assert self.hostname is not None and self.port is not None
+            family, address = socket.AF_INET, (self.hostname, self.port)
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            try:
+                sock.connect(address)
+            except OSError:
+                return False
+        return True
+
     def __repr__(self) -> str:
         return (
             f'PostmasterInfo(pid={self.pid}, pgdata={self.pgdata}, start_time={self.start_time}, '
@@ -146,11 +182,129 @@ class PostmasterInfo:
         return self.__repr__()
 
 
+def wait_for_postmaster_ready(
+    pgdata: Path,
+    timeout: float = 60.0,
+    process: subprocess.Popen | None = None,
+    launcher: subprocess.Popen | None = None,
+    start: float | None = None,
+) -> tuple[PostmasterInfo, float]:
+    """Waits until pgdata/postmaster.pid shows a running server that is ready to accept connections.
+    The file is polled with an adaptive backoff (1ms, doubling up to 10ms), so readiness is noticed within ~10ms
+    without busy-waiting. The file is only parsed once it is complete and reports 'ready'.
+    If `process` is the postmaster itself, the file must belong to it, and its exit raises CalledProcessError; so does
+    the failure of `launcher`, a process starting the postmaster (eg `pg_ctl start`).
+    Returns the postmaster info and the wait in seconds since `start` (a time.monotonic() value, default: now), eg
+    the launch of the server; raises TimeoutError after `timeout` seconds.
+    """
+    postmaster_file = pgdata / 'postmaster.pid'
+    if start is None:
+        start = time.monotonic()
+    delay = 0.001
+    while True:
+        try:
+            lines = postmaster_file.read_text().splitlines()
+        except FileNotFoundError:
+            lines = []
+        if len(lines) == len(PostmasterInfo.LINE_VARS) and lines[-1].strip() == 'ready':
+            pinfo = PostmasterInfo(lines)
+            if pinfo.is_running() and (process is None or pinfo.pid == process.pid):
+                return pinfo, time.monotonic() - start
+        if process is not None and process.poll() is not None:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        if launcher is not None and launcher.poll():
+            raise subprocess.CalledProcessError(launcher.returncode, launcher.args)
+
+        elapsed = time.monotonic() - start
+        if elapsed > timeout:
+            raise TimeoutError(f'postgres server in {pgdata} not ready after {elapsed:.1f}s')
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+
+
+def extension_available(name: str) -> bool:
+    """Returns True if the postgres extension (or contrib module) `name` is part of the bundled install."""
+    return (POSTGRES_BIN_PATH.parent / 'share' / 'postgresql' / 'extension' / f'{name}.control').exists()
+
+
+def compression_available(method: str) -> bool:
+    """Returns True if the bundled postgres was built with support for the compression method `method` ('lz4' or
+    'zstd'), for TOAST and WAL compression.
+    """
+    pg_config_h = POSTGRES_BIN_PATH.parent / 'include' / 'postgresql' / 'server' / 'pg_config.h'
+    try:
+        return f'#define USE_{method.upper()} 1' in pg_config_h.read_text()
+    except FileNotFoundError:
+        return False
+
+
+def process_is_alive(process: psutil.Process) -> bool:
+    """Like process.is_running(), but False for a process that exited and was not reaped yet (a zombie)."""
+    try:
+        return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def wait_for_process_exit(process: psutil.Process, timeout: float) -> bool:
+    """Waits up to `timeout` seconds for `process` (which need not be a child) to exit. Returns True if it did."""
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while process_is_alive(process):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return True
+
+
 def process_is_running(pid: int) -> bool:
     assert pid is not None
     return psutil.pid_exists(pid)
 
 
+class PostmasterRecord:
+    """The pid and creation time of the last postmaster started on a pgdata, as a file in `records_path`.
+
+    The record lives outside of pgdata, since it is needed precisely when pgdata was deleted while its server kept
+    running: it then identifies the left-over server without scanning every process on the host. The creation time
+    guards against the pid having been reused by an unrelated process.
+    """
+
+    def __init__(self, records_path: Path, pgdata: Path):
+        self.pgdata = pgdata
+        name = hashlib.sha256(str(pgdata).encode()).hexdigest()[:16]
+        self.path = records_path / f'{name}.json'
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def write(self, process: psutil.Process) -> None:
+        """Records `process` as the postmaster of pgdata."""
+        record = {'pgdata': str(self.pgdata), 'pid': process.pid, 'create_time': process.create_time()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # write and rename, so that a reader never sees a partial record
+        tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(record))
+        os.replace(tmp, self.path)
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+    def find_process(self) -> psutil.Process | None:
+        """Returns the recorded postmaster if it is still running, else None (also if there is no valid record)."""
+        try:
+            record = json.loads(self.path.read_text())
+            if record['pgdata'] != str(self.pgdata):  # hash collision
+                return None
+            process = psutil.Process(record['pid'])
+            if process.create_time() != record['create_time']:  # the pid was reused
+                return None
+        except (OSError, ValueError, KeyError, psutil.Error):
+            return None
+        return process
+
+
 if platform.system() != 'Windows':
 
     def ensure_user_exists(username: str) -> 'pwd.struct_passwd | None':
@@ -206,36 +360,105 @@ if platform.system() != 'Windows':
 
         _helper(path)
 
+    def ensure_owned_by(path: Path, username: str) -> None:
+        """Recursively changes the owner of path (and everything under it) to system user `username`."""
+        import pwd
+
+        entry = pwd.getpwnam(username)
+        os.chown(path, entry.pw_uid, entry.pw_gid)
+        for root, dirs, files in os.walk(path):
+            for name in (*dirs, *files):
+                os.chown(os.path.join(root, name), entry.pw_uid, entry.pw_gid, follow_symlinks=False)
 
-class DiskList:
-    """A list of integers stored in a file on disk."""
+
+class HandleRegistry:
+    """Tracks the processes holding a handle on a server, as one lock file per process in `path`.
+
+    A process attaches by creating its file and holding a lock on it until it detaches or exits, so attach and detach
+    touch a single file, and the lock of a process that crashed is released by the OS. Files whose lock can be
+    acquired therefore belong to dead holders, and are removed when encountered.
+    """
+
+    # open lock files of this process, by registry path
+    _held: ClassVar[dict[Path, int]] = {}
 
     def __init__(self, path: Path):
         self.path = path
 
-    def get_and_add(self, value: int) -> list[int]:
-        old_values = self.get()
-        values = old_values.copy()
-        if value not in values:
-            values.append(value)
-            self.put(values)
-        return old_values
+    def attach(self) -> None:
+        """Registers the current process as a holder (a no-op if it is one already)."""
+        if self.path in self._held:
+            return
+        self.path.mkdir(exist_ok=True)
+        fd = os.open(self.path / str(os.getpid()), os.O_RDWR | os.O_CREAT, 0o644)
+        if not _try_lock(fd):  # our pid, so the holder was a dead process whose lock is not released yet
+            os.close(fd)
+            raise RuntimeError(f'Handle file {self.path / str(os.getpid())} is locked by another process')
+        self._held[self.path] = fd
+
+    def detach(self) -> bool:
+        """Unregisters the current process. Returns True if it was the last live holder, False if other live holders
+        remain or the current process was not a holder.
+        """
+        fd = self._held.pop(self.path, None)
+        if fd is None:
+            return False
+        os.close(fd)  # first, as Windows cannot delete open files
+        (self.path / str(os.getpid())).unlink(missing_ok=True)
+        return not any(True for _ in self.live_holders())
+
+    def live_holders(self) -> Iterator[int]:
+        """Yields the pids of the live holders other than the current process, removing the files of dead ones."""
+        if not self.path.is_dir():
+            return
+        for entry in os.scandir(self.path):
+            if not entry.name.isdigit() or int(entry.name) == os.getpid():
+                continue
+            try:
+                fd = os.open(entry.path, os.O_RDWR)
+            except FileNotFoundError:  # detached concurrently
+                continue
+            try:
+                if _try_lock(fd):  # the holder is gone
+                    Path(entry.path).unlink(missing_ok=True)
+                    continue
+            finally:
+                os.close(fd)
+            yield int(entry.name)
+
+    @classmethod
+    def _forget_inherited(cls) -> None:
+        """In a forked child, closes the lock files inherited from the parent: their locks belong to the parent, and
+        the child must not keep them alive after the parent exits.
+        """
+        for fd in cls._held.values():
+            with suppress(OSError):
+                os.close(fd)
+        cls._held.clear()
+
 
-    def get_and_remove(self, value: int) -> list[int]:
-        old_values = self.get()
-        values = old_values.copy()
-        if value in values:
-            values.remove(value)
-            self.put(values)
-        return old_values
+# sys.platform rather than platform.system(), so that mypy checks the branch of the current platform only
+if sys.platform == 'win32':
+    import msvcrt
 
-    def get(self) -> list[int]:
-        if not self.path.exists():
-            return []
-        return json.loads(self.path.read_text())
+    def _try_lock(fd: int) -> bool:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+else:
+    import fcntl
+
+    def _try_lock(fd: int) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
 
-    def put(self, values: list[int]) -> None:
-        self.path.write_text(json.dumps(values))
+    os.register_at_fork(after_in_child=HandleRegistry._forget_inherited)
 
 
 def socket_name_length_ok(socket_name: Path) -> bool:
@@ -295,6 +518,52 @@ def find_suitable_socket_dir(pgdata: Path, runtime_path: Path) -> Path:
     return ok_path
 
 
+# ioctl request number for FICLONE on Linux (_IOW(0x94, 9, int)), supported by btrfs, xfs, bcachefs, ...
+_FICLONE = 0x40049409
+
+
+def _clone_file(src: str, dst: str) -> bool:
+    """Attempts a copy-on-write clone of src to dst. Returns False if the file system does not support it."""
+    system = platform.system()
+    if system == 'Linux':
+        import fcntl
+
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    if system == 'Darwin':
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        # clonefile(2) preserves metadata, and fails if dst exists
+        return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+    return False
+
+
+def copy_file_cow(src: str, dst: str) -> str:
+    """Copies a single file, using a copy-on-write clone (reflink) where the file system allows it.
+    Hard links are deliberately not used: postgres modifies relation files in place, so a hard link
+    would propagate writes back into the source.
+    Signature matches `shutil.copy2`, so it can be used as `copy_function` in `shutil.copytree`.
+    """
+    if not _clone_file(src, dst):
+        shutil.copy2(src, dst)
+    return dst
+
+
+def copy_tree_cow(src: Path, dst: Path, ignore: Callable[[str, list[str]], Iterable[str]] | None = None) -> None:
+    """Recursively copies the directory src into dst (which may already exist), cloning files where possible.
+    Symlinked directories are copied as directories. `ignore` is as in `shutil.copytree`.
+    """
+    shutil.copytree(src, dst, ignore=ignore, copy_function=copy_file_cow, dirs_exist_ok=True)
+
+
 def find_suitable_port(address: str | None = None) -> int:
     """Find an available TCP port."""
     if address is None:
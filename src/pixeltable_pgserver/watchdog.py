@@ -0,0 +1,90 @@
+"""A thread that restarts the server of a PostgresServer handle when its postmaster dies (eg killed by the OOM killer),
+so that the handle's URI works again within seconds instead of failing until someone restarts the server by hand.
+
+Enabled with get_server(..., watchdog_interval=...). The check is cheap: whether the postmaster process still exists
+(and is not a zombie). When it is dead, the server is restarted under the pgdata lock, with exponential backoff
+between failed attempts; if several processes watch the same pgdata, the first one restarts the server and the others
+adopt it. Callbacks registered with add_callback() are called on each transition, eg to drop pooled connections.
+"""
+
+import logging
+import threading
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from .postgres_server import PostgresServer
+
+_logger = logging.getLogger('pixeltable_pgserver')
+
+# 'down': the postmaster was found dead; 'restarted': the server is running again (its URI may have changed);
+# 'restart_failed': an attempt to restart it failed, and is retried after a backoff
+WATCHDOG_EVENTS = ('down', 'restarted', 'restart_failed')
+
+WatchdogCallback = Callable[['PostgresServer', str], None]
+
+
+class Watchdog:
+    """Checks the postmaster of `server` every `interval` seconds, and restarts the server when it died.
+    Failed restarts are retried after a backoff that doubles up to `max_backoff` seconds.
+    """
+
+    def __init__(self, server: 'PostgresServer', interval: float = 1.0, max_backoff: float = 30.0):
+        assert interval > 0
+        self.server = server
+        self.interval = interval
+        self.max_backoff = max_backoff
+        # number of times the server was restarted (or adopted after another process restarted it)
+        self.restarts = 0
+        self._callbacks: list[WatchdogCallback] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'pgserver-watchdog-{server.pgdata.name}', daemon=True)
+
+    def add_callback(self, callback: WatchdogCallback) -> None:
+        """Registers callback(server, event) to be called, from the watchdog thread, on each of WATCHDOG_EVENTS."""
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback: WatchdogCallback) -> None:
+        self._callbacks.remove(callback)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops watching. A restart in progress completes; none is started afterwards."""
+        self._stop.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self.server._postmaster_alive():
+                continue
+            # confirmed under the lock, which is held while the server is stopped on purpose (eg by snapshot())
+            with self.server._locked(self.server.pgdata):
+                down = not self.stopped and not self.server._postmaster_alive()
+            if not down:
+                continue
+            self._fire('down')
+            backoff = self.interval
+            while not self._stop.is_set():
+                try:
+                    restarted = self.server._recover()
+                except Exception:
+                    _logger.warning(f'Failed to restart the server of {self.server.pgdata}', exc_info=True)
+                    self._fire('restart_failed')
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                if restarted:
+                    self.restarts += 1
+                    self._fire('restarted')
+                break
+
+    def _fire(self, event: str) -> None:
+        for callback in list(self._callbacks):
+            try:
+                callback(self.server, event)
+            except Exception:
+                _logger.warning(f'Watchdog callback {callback!r} failed on {event!r}', exc_info=True)
@@ -1,23 +1,51 @@
+import asyncio
+import datetime as dt
+import decimal
+import json
 import logging
 import multiprocessing as mp
 import os
+import pickle
 import platform
 import shutil
 import socket
 import subprocess
+import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import queues
 from pathlib import Path
-from typing import Iterator
+from typing import Any, Callable, Iterator
 
 import psutil
 import pytest
 import sqlalchemy as sa
 from sqlalchemy_utils import create_database, database_exists
 
-from pixeltable_pgserver import PostgresServer, get_server
+from pixeltable_pgserver import (
+    PostgresServer,
+    ServerHandle,
+    ServerPool,
+    attach_server,
+    get_server,
+    get_server_async,
+    serverlog,
+    timings,
+)
+from pixeltable_pgserver.client import PostgresError
 from pixeltable_pgserver.pgexec import pgexec
-from pixeltable_pgserver.utils import PostmasterInfo, find_suitable_port, process_is_running
+from pixeltable_pgserver.profiles import PROFILES, configured_setting, profile_settings
+from pixeltable_pgserver.server_pool import reset_server
+from pixeltable_pgserver.template import initdb_args, template_key
+from pixeltable_pgserver.utils import (
+    PostmasterInfo,
+    compression_available,
+    extension_available,
+    find_suitable_port,
+    process_is_alive,
+    process_is_running,
+)
 
 
 def _check_sqlalchemy_works(srv: PostgresServer, driver: str | None = None) -> None:
@@ -290,6 +318,18 @@ def test_pgvector(tmp_postgres: PostgresServer) -> None:
     assert ret.strip() == 'CREATE EXTENSION'
 
 
+def test_compression_defaults(tmp_postgres: PostgresServer) -> None:
+    toast = tmp_postgres.psql('show default_toast_compression;').splitlines()[2].strip()
+    assert toast == ('lz4' if compression_available('lz4') else 'pglz')
+    wal = tmp_postgres.psql('show wal_compression;').splitlines()[2].strip()
+    if compression_available('zstd'):
+        assert wal == 'zstd'
+    elif compression_available('lz4'):
+        assert wal == 'lz4'
+    else:
+        assert wal == 'off'
+
+
 def test_start_failure_log(caplog: pytest.LogCaptureFixture) -> None:
     """Test server log contents are shown in python log when failures"""
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -300,10 +340,13 @@ def test_start_failure_log(caplog: pytest.LogCaptureFixture) -> None:
         for f in Path(tmpdir).glob('**/postgresql.conf'):
             f.unlink()
 
-        with pytest.raises(subprocess.CalledProcessError):
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
             _ = get_server(tmpdir)
 
         assert 'postgres: could not access the server configuration file' in caplog.text
+        # and the output of pg_ctl itself
+        assert 'could not start server' in exc_info.value.stderr
+        assert 'could not start server' in caplog.text
 
 
 def test_no_conflict() -> None:
@@ -435,3 +478,775 @@ def test_multiprocess_shared() -> None:
             assert not process_is_running(server_pid_parent)
     finally:
         _kill_server(pid)
+
+
+def test_template_init(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """New pgdata directories are populated from a cached template cluster, and fall back on initdb"""
+    monkeypatch.setattr(PostgresServer, 'templates_path', tmp_path / 'templates')
+    for i in range(2):
+        with get_server(tmp_path / f'pgdata{i}', cleanup_mode='delete') as pg:
+            _check_server(pg)
+        templates = [p for p in (tmp_path / 'templates').iterdir() if not p.name.startswith('.')]
+        assert len(templates) == 1
+        assert (templates[0] / 'PG_VERSION').exists()
+
+    def _fail(*args: object) -> None:
+        raise OSError('simulated template failure')
+
+    monkeypatch.setattr('pixeltable_pgserver.postgres_server.init_from_template', _fail)
+    with get_server(tmp_path / 'pgdata_fallback', cleanup_mode='delete') as pg:
+        _check_server(pg)
+
+
+def test_readiness_latency(tmp_path: Path) -> None:
+    with get_server(tmp_path, cleanup_mode='delete') as pg:
+        assert pg.readiness_latency is not None
+        # from the launch of the server, well under the 100ms poll interval of `pg_ctl start -w`
+        assert pg.readiness_latency < 0.08
+        _check_server(pg)
+
+
+@pytest.mark.parametrize('shutdown_mode', ['smart', 'fast', 'immediate'])
+def test_direct_start_mode(tmp_path: Path, shutdown_mode: str) -> None:
+    """The postmaster can be spawned and signalled directly, bypassing pg_ctl"""
+    if platform.system() == 'Windows':
+        pytest.skip('start_mode="direct" is not supported on Windows.')
+
+    pid = None
+    try:
+        with get_server(tmp_path, start_mode='direct', shutdown_mode=shutdown_mode) as pg:
+            # no lingering client connections here, which a smart shutdown would wait for
+            pid = pg.get_pid()
+            assert 'data_directory' in pg.psql('show data_directory;')
+            assert pg._postmaster_popen is not None
+            assert pg._postmaster_popen.pid == pid
+
+        assert not process_is_running(pid)
+        assert pg._postmaster_popen.returncode is not None
+
+        # restarting on the same pgdata works after any shutdown mode
+        with get_server(tmp_path, start_mode='direct') as pg:
+            pid = _check_server(pg)
+    finally:
+        _kill_server(pid)
+
+
+def test_async_lifecycle(tmp_path: Path) -> None:
+    """Several servers can be brought up concurrently from one event loop, without stalling it"""
+
+    async def _ticker(stop: asyncio.Event) -> float:
+        # longest time the event loop was unresponsive
+        max_stall = 0.0
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            before = loop.time()
+            await asyncio.sleep(0.01)
+            max_stall = max(max_stall, loop.time() - before - 0.01)
+        return max_stall
+
+    async def _run() -> None:
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(_ticker(stop))
+        servers = await asyncio.gather(
+            *(get_server_async(tmp_path / f'pgdata{i}', cleanup_mode='delete') for i in range(3))
+        )
+        assert len({pg.pgdata for pg in servers}) == 3
+        for pg in servers:
+            async with pg:
+                ret = await pg.psql_async('show data_directory;')
+                assert Path(ret.splitlines()[2].strip()) == pg.pgdata
+            assert not pg.pgdata.exists()
+        stop.set()
+        assert await ticker < 0.5
+
+    asyncio.run(_run())
+
+
+def test_pooler(tmp_path: Path) -> None:
+    """Many client connections share a bounded number of server connections through the pooler"""
+    if platform.system() == 'Windows':
+        pytest.skip('The connection pooler is not supported on Windows.')
+
+    import psycopg
+
+    with get_server(tmp_path, cleanup_mode='delete', pool_size=2) as pg:
+        uri = pg.get_uri(pooled=True)
+        assert uri != pg.get_uri()
+        pg.psql('create table t (id int);')
+
+        def _work(i: int) -> None:
+            with psycopg.connect(uri, prepare_threshold=None) as conn:
+                for _ in range(5):
+                    with conn.transaction():
+                        conn.execute('insert into t values (%s)', (i,))
+                        conn.execute('select pg_sleep(0.01)')
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(_work, range(8)))
+
+        assert pg.psql('select count(*) from t;').splitlines()[2].strip() == '40'
+        with psycopg.connect(pg.get_uri()) as conn:
+            query = (
+                "select count(*) from pg_stat_activity where backend_type = 'client backend' "
+                'and pid <> pg_backend_pid()'
+            )
+            backends = conn.execute(query).fetchone()
+            assert backends is not None and backends[0] <= 2
+
+        time.sleep(1.5)  # stats are refreshed every second
+        stats = pg.pool_stats()
+        assert stats['max_backends'] == 2
+        assert stats['peak_busy'] <= 2
+        assert stats['transactions'] >= 40
+        assert stats['waits'] > 0
+        assert stats['wait_time_max'] > 0
+
+
+@pytest.mark.parametrize('profile', PROFILES)
+def test_profiles(tmp_path: Path, profile: str) -> None:
+    with get_server(tmp_path, cleanup_mode='stop', profile=profile) as pg:
+        settings = profile_settings(profile)
+        for name in ('shared_buffers', 'work_mem', 'max_parallel_workers_per_gather'):
+            assert pg.psql(f'show {name};').splitlines()[2].strip() == settings[name]
+        fsync = pg.psql('show fsync;').splitlines()[2].strip()
+        assert fsync == ('off' if profile == 'ephemeral-test' else 'on')
+
+    # without a profile, the defaults are restored at the next start
+    with get_server(tmp_path, cleanup_mode='delete') as pg:
+        assert pg.psql('show work_mem;').splitlines()[2].strip() == '4MB'
+
+
+def test_configured_setting(tmp_path: Path) -> None:
+    (tmp_path / 'postgresql.conf').write_text(
+        "#shared_preload_libraries = ''\n"
+        'shared_preload_libraries = \'a, "b"\'  # comment\n'
+        'shared_preload_libraries_x = c\n'
+        'work_mem 8MB\n'
+        "include_if_exists = 'pgserver.tuning.conf'\n"
+    )
+    assert configured_setting(tmp_path, 'shared_preload_libraries') == 'a, "b"'
+    assert configured_setting(tmp_path, 'WORK_MEM') == '8MB'
+    assert configured_setting(tmp_path, 'maintenance_work_mem') is None
+    # ALTER SYSTEM settings are read last
+    (tmp_path / 'postgresql.auto.conf').write_text("shared_preload_libraries = 'it''s'\n")
+    assert configured_setting(tmp_path, 'shared_preload_libraries') == "it's"
+
+
+def test_tmpfs(tmp_path: Path) -> None:
+    if not PostgresServer.tmpfs_path.is_dir():
+        pytest.skip(f'No tmpfs at {PostgresServer.tmpfs_path}.')
+
+    with pytest.raises(ValueError, match='cleanup_mode'):
+        get_server(tmp_path / 'pgdata_stop', tmpfs_size=2**28)
+    assert not (tmp_path / 'pgdata_stop').exists()
+    with pytest.raises(RuntimeError, match='Not enough space'):
+        get_server(tmp_path / 'pgdata_huge', cleanup_mode='delete', tmpfs_size=2**60)
+    assert (tmp_path / 'pgdata_huge').resolve() not in PostgresServer._instances
+
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete', tmpfs_size=2**28) as pg:
+        tmpfs_dir = (pg.pgdata / 'base').resolve().parent
+        assert tmpfs_dir.is_relative_to(PostgresServer.tmpfs_path)
+        assert (pg.pgdata / 'pg_wal').resolve().parent == tmpfs_dir
+        _check_server(pg)
+        assert pg.psql('show fsync;').splitlines()[2].strip() == 'off'
+        assert pg.psql('show temp_file_limit;').splitlines()[2].strip() == '64MB'
+
+    assert not pg.pgdata.exists()
+    assert not tmpfs_dir.exists()
+
+
+def test_query(tmp_path: Path) -> None:
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        row = pg.query(
+            "select 1, 2.5::float8, true, 1.25::numeric, 'abc', null, '{\"a\": [1]}'::jsonb,"
+            " '2024-01-02 03:04:05.5'::timestamp, '\\x0102'::bytea, '2024-01-02'::date"
+        )[0]
+        assert row == (
+            1,
+            2.5,
+            True,
+            decimal.Decimal('1.25'),
+            'abc',
+            None,
+            {'a': [1]},
+            dt.datetime(2024, 1, 2, 3, 4, 5, 500000),
+            b'\x01\x02',
+            dt.date(2024, 1, 2),
+        )
+        tz_value = pg.query("select '2024-01-02 03:04:05+02'::timestamptz at time zone 'UTC'")[0][0]
+        assert tz_value == dt.datetime(2024, 1, 2, 1, 4, 5)
+        assert pg.query('select $1::int + $2::int, $3::text is null', [1, 2, None]) == [(3, True)]
+
+        # errors leave the (persistent) connection usable
+        conn = pg._connection(None)
+        with pytest.raises(PostgresError, match='division by zero') as exc_info:
+            pg.query('select 1 / 0')
+        assert exc_info.value.code == '22012'
+        assert pg.query('select 1') == [(1,)]
+        assert pg._connection(None) is conn
+
+        # streamed results are not buffered, and an abandoned stream is discarded by the next query
+        pg.query('create table t (i int); insert into t select generate_series(1, 10000)')
+        rows = pg.query_iter('select i from t order by i')
+        assert next(rows) == (1,)
+        assert next(rows) == (2,)
+        del rows
+        assert pg.query('select count(*) from t') == [(10000,)]
+        assert sum(i for (i,) in pg.query_iter('select i from t')) == 10000 * 10001 // 2
+
+        with pg.connect() as other:
+            assert other.execute('select current_database()') == [('postgres',)]
+        assert other.closed
+
+        # the server's reason for rejecting a connection is raised, not the closed connection
+        with pytest.raises(PostgresError, match='database "nope" does not exist') as exc_info:
+            pg.query('select 1', database='nope')
+        assert exc_info.value.code == '3D000'
+
+
+def test_timings(tmp_path: Path) -> None:
+    spans: list[timings.Span] = []
+    timings.add_callback(spans.append)
+    try:
+        pg = get_server(tmp_path / 'pgdata', cleanup_mode='delete')
+        started = [span.phase for span in spans]
+        assert started == [
+            'lock_wait',
+            'stale_process_scan',
+            'initdb',
+            'socket_dir_selection',
+            'start',
+            'readiness_wait',
+        ]
+        assert all(span.pgdata == pg.pgdata and span.duration >= 0 for span in spans)
+        assert pg.timings['initdb'] > 0
+        assert 'shutdown' not in pg.timings.as_dict()
+        pg.cleanup()
+    finally:
+        timings.remove_callback(spans.append)
+
+    assert [span.phase for span in spans[len(started) :]] == ['lock_wait', 'shutdown', 'delete']
+    assert pg.timings.spans == spans
+    # every phase but the watchdog's recovery
+    assert set(pg.timings.as_dict()) == set(timings.PHASES) - {'recovery'}
+
+
+def test_query_stats(tmp_path: Path) -> None:
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        if not extension_available('pg_stat_statements'):
+            with pytest.raises(RuntimeError, match='pg_stat_statements'):
+                pg.query_stats()
+            pytest.skip('pg_stat_statements is not part of this postgres build.')
+
+        with pytest.raises(ValueError, match='order_by'):
+            pg.query_stats(order_by='bogus')
+        pg.reset_query_stats()
+        pg.query('create table t (i int)')
+        for i in range(10):
+            pg.query('insert into t values ($1)', [i])
+        pg.query('select pg_sleep(0.05)')
+
+        by_calls = pg.query_stats(n=1, order_by='calls')
+        assert len(by_calls) == 1
+        assert by_calls[0]['query'] == 'insert into t values ($1)'
+        assert by_calls[0]['calls'] == 10
+        assert by_calls[0]['rows'] == 10
+        assert by_calls[0]['database'] == 'postgres'
+        assert pg.query_stats(n=1, order_by='mean_time')[0]['query'] == 'select pg_sleep($1)'
+        assert pg.query_stats(n=1)[0]['total_time'] >= 0.05
+
+        if extension_available('pg_buffercache'):
+            pg.query('create extension pg_buffercache')
+            assert pg.query('select count(*) > 0 from pg_buffercache')[0][0]
+
+        pg.reset_query_stats()
+        assert all(stats['query'] != 'insert into t values ($1)' for stats in pg.query_stats())
+
+    # libraries preloaded by postgresql.conf are kept
+    pgdata = tmp_path / 'pgdata_preload'
+    with get_server(pgdata, cleanup_mode='stop'), open(pgdata / 'postgresql.conf', 'a', encoding='utf-8') as f:
+        f.write("shared_preload_libraries = 'plpgsql'\n")
+    with get_server(pgdata, cleanup_mode='delete') as pg:
+        assert pg.query('show shared_preload_libraries') == [('plpgsql,pg_stat_statements',)]
+
+
+def test_dead_handle_holder(tmp_path: Path) -> None:
+    pgdata = tmp_path / 'pgdata'
+    # a process that attaches and then dies without detaching
+    code = f'import os, pixeltable_pgserver; pixeltable_pgserver.get_server({str(pgdata)!r}); os._exit(0)'
+    subprocess.run([sys.executable, '-c', code], check=True)
+    assert len(list((pgdata / '.handles').iterdir())) == 1
+
+    with get_server(pgdata) as pg:
+        pid = pg.get_pid()
+        assert list(pg.handles.live_holders()) == []  # and the dead holder's file is removed
+        assert [path.name for path in (pgdata / '.handles').iterdir()] == [str(os.getpid())]
+
+    # the last live handle stopped the server
+    assert pid is not None and not process_is_running(pid)
+    assert list((pgdata / '.handles').iterdir()) == []
+
+
+def test_per_pgdata_locks(tmp_path: Path) -> None:
+    pgdatas = [tmp_path / f'pgdata{i}' for i in range(4)]
+    for pgdata in pgdatas:
+        pgdata.mkdir()
+
+    # another server starts while the lock of pgdata0 is held
+    with PostgresServer._locked(pgdatas[0]), ThreadPoolExecutor(1) as executor:
+        executor.submit(lambda: get_server(pgdatas[1], cleanup_mode='delete').cleanup()).result(timeout=60)
+
+    def start_and_stop(pgdata: Path) -> None:
+        get_server(pgdata, cleanup_mode='delete').cleanup()
+        pgdata.mkdir()
+
+    start = time.perf_counter()
+    for pgdata in pgdatas:
+        start_and_stop(pgdata)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(pgdatas)) as executor:
+        list(executor.map(start_and_stop, pgdatas))
+    concurrent = time.perf_counter() - start
+
+    logging.info(f'{len(pgdatas)} servers: {sequential=:.3f}s {concurrent=:.3f}s')
+    if (os.cpu_count() or 1) >= len(pgdatas):
+        assert concurrent < sequential * 0.75
+
+    # deleting a pgdata deletes its lock file
+    lock_files = [PostgresServer._lock_file(pgdata.resolve()) for pgdata in pgdatas]
+    assert not any(path.exists() for path in lock_files)
+    if platform.system() == 'Windows':
+        return
+
+    # a process waiting for the lock while its file is deleted acquires the lock on a new file
+    pgdata = pgdatas[0].resolve()
+    code = (
+        'from pathlib import Path\n'
+        'from pixeltable_pgserver import PostgresServer\n'
+        f'pgdata = Path({str(pgdata)!r})\n'
+        "print('waiting', flush=True)\n"
+        'with PostgresServer._locked(pgdata):\n'
+        '    print(PostgresServer._lock_file(pgdata).exists())\n'
+    )
+    with PostgresServer._locked(pgdata):
+        child = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+        assert child.stdout is not None and child.stdout.readline() == 'waiting\n'
+        time.sleep(0.5)  # until it waits for the lock
+        lock_files[0].unlink()
+    assert child.communicate(timeout=60)[0] == 'True\n'
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason='a running server prevents deleting its pgdata')
+def test_stale_server_record(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    pgdata = tmp_path / 'pgdata'
+    scans = 0
+    process_iter = psutil.process_iter
+
+    def _counting_process_iter(*args: object, **kwargs: object) -> Iterator[psutil.Process]:
+        nonlocal scans
+        scans += 1
+        return process_iter(*args, **kwargs)  # type: ignore[arg-type]
+
+    monkeypatch.setattr(psutil, 'process_iter', _counting_process_iter)
+    pid = None
+    try:
+        # a new pgdata without a record falls back on scanning all processes
+        pg = get_server(pgdata, cleanup_mode=None)
+        assert scans == 1
+        pid = pg.get_postmaster_info().pid
+        assert pg.postmaster_record.find_process().pid == pid
+        pg.cleanup()
+
+        # a record of a process that is gone is replaced when the running server is adopted
+        other = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+        pg.postmaster_record.write(psutil.Process(other.pid))
+        other.kill()
+        other.wait()
+        assert pg.postmaster_record.find_process() is None
+        pg = get_server(pgdata, cleanup_mode=None)
+        assert pg.get_postmaster_info().pid == pid
+        assert pg.postmaster_record.find_process().pid == pid
+        pg.cleanup()
+
+        # pgdata is deleted while its server keeps running; the record identifies the left-over server
+        shutil.rmtree(pgdata)
+        pgdata.mkdir()
+        with get_server(pgdata, cleanup_mode='delete') as pg:
+            assert scans == 1
+            assert pg.get_postmaster_info().pid != pid
+            assert not process_is_running(pid)
+        assert not pg.postmaster_record.exists()
+    finally:
+        _kill_server(pid)
+
+
+def test_server_pool(tmp_path: Path) -> None:
+    with ServerPool(2, root=tmp_path) as pool:
+        pg1 = pool.acquire(timeout=60)
+        pg2 = pool.acquire(timeout=60)
+        assert pg1.pgdata != pg2.pgdata
+        assert pg1.pgdata.parent == tmp_path
+        assert pg1.query('show fsync') == [('off',)]  # profile='ephemeral-test'
+
+        pg1.query('create table t (i int)')
+        pg1.query('create database other')
+        pg1.query('create role someone')
+        reset_server(pg1)
+        assert pg1.query("select to_regclass('t') is null") == [(True,)]
+        assert pg1.query("select count(*) from pg_database where datname = 'other'") == [(0,)]
+        assert pg1.query("select count(*) from pg_roles where rolname = 'someone'") == [(0,)]
+
+        with pytest.raises(TimeoutError):
+            pool.acquire(timeout=0.1)  # both are in use
+
+        # released servers are handed out again; the pool never runs more than `size` servers
+        for _ in range(4):
+            pool.release(pg1)
+            pool.release(pg2)
+            pg1, pg2 = pool.acquire(timeout=60), pool.acquire(timeout=60)
+            assert len(list(tmp_path.iterdir())) <= 2
+    # close() also stops the servers that were not released
+    assert not pg1.pgdata.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pgserver_fixture(pgserver: PostgresServer) -> None:
+    assert pgserver.query('select 1') == [(1,)]
+
+
+def test_template_key_locale(monkeypatch: pytest.MonkeyPatch) -> None:
+    args = initdb_args('postgres')
+    for name in ('LC_ALL', 'LC_COLLATE', 'LC_CTYPE', 'LANG'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('LANG', 'C.UTF-8')
+    key = template_key(args, None)
+    assert template_key(args, None) == key
+
+    # initdb takes its locale from the environment, so a template built under another locale is not reused
+    monkeypatch.setenv('LC_COLLATE', 'en_US.UTF-8')
+    assert template_key(args, None) != key
+    monkeypatch.setenv('LC_ALL', 'C.UTF-8')
+    assert template_key(args, None) == key
+
+
+def test_template_databases(tmp_path: Path) -> None:
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        pg.query('create database tmpl')
+        pg.query('create table t (i int)', database='tmpl')
+        pg.query('insert into t values (1), (2)', database='tmpl')
+        pg.mark_template('tmpl')
+        assert pg.query("select datistemplate from pg_database where datname = 'tmpl'") == [(True,)]
+
+        names = [f'tenant_{i}' for i in range(3)]
+        pg.query('select 1', database='tmpl')  # a connection to the template does not prevent cloning
+        pg.clone_databases('tmpl', names)
+        for name in names:
+            assert pg.query('select count(*) from t', database=name) == [(2,)]
+        pg.query('insert into t values (3)', database=names[0])
+        assert pg.query('select count(*) from t', database=names[1]) == [(2,)]
+
+        with pg.connect(names[1]):  # a lingering connection does not prevent dropping
+            pg.drop_databases([*names, 'tmpl', 'missing'])
+        databases = {name for (name,) in pg.query('select datname from pg_database')}
+        assert databases == {'postgres', 'template0', 'template1'}
+
+
+def test_snapshot(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(PostgresServer, 'snapshots_path', tmp_path / 'snapshots')
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        pg.query('create table t (i int)')
+        pg.query('insert into t values (1), (2)')
+        path = pg.snapshot('populated')
+        assert (path / 'PG_VERSION').exists()
+        assert not (path / 'postmaster.pid').exists()
+        # the server is running again, and changes after the snapshot do not affect it
+        pg.query('insert into t values (3)')
+        with pytest.raises(ValueError, match='snapshot name'):
+            pg.snapshot('../elsewhere')
+
+        with get_server(tmp_path / 'restored', cleanup_mode='delete', from_snapshot='populated') as restored:
+            assert restored.query('select count(*) from t') == [(2,)]
+            restored.query('insert into t values (4)')
+        assert pg.query('select count(*) from t') == [(3,)]
+
+    with get_server(tmp_path / 'restored', cleanup_mode='delete', from_snapshot='populated') as restored:
+        assert restored.query('select count(*) from t') == [(2,)]
+
+    with pytest.raises(FileNotFoundError, match='missing'):
+        get_server(tmp_path / 'other', cleanup_mode='delete', from_snapshot='missing')
+
+    # the structured logs are not part of a snapshot
+    with get_server(tmp_path / 'logged', cleanup_mode='delete', structured_log=True) as pg:
+        assert serverlog.log_files(pg.pgdata)
+        path = pg.snapshot('logged')
+        assert not (path / serverlog.LOG_DIR).exists()
+        assert serverlog.log_files(pg.pgdata)
+    with get_server(tmp_path / 'restored', cleanup_mode='delete', from_snapshot='logged', structured_log=True) as pg:
+        assert serverlog.log_files(pg.pgdata)
+
+
+@pytest.mark.parametrize('fmt', ['binary', 'csv'])
+def test_copy_in(tmp_path: Path, fmt: str) -> None:
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        pg.query(
+            'create table t (i int4, b int8, f float8, s text, ok bool, d date, ts timestamptz, j jsonb, u uuid,'
+            ' x bytea)'
+        )
+        ts = dt.datetime(2024, 5, 6, 7, 8, 9, 123456, tzinfo=dt.timezone.utc)
+        rows = (
+            (i, i * 10**10, i / 2, f'row "{i}",\n', i % 2 == 0, dt.date(2024, 1, 1), ts, {'i': i}, None, b'\x00\xff')
+            for i in range(1000)
+        )
+        stats = pg.copy_in('t', rows, format=fmt, chunk_size=4096)
+        assert stats['rows'] == 1000
+        assert stats['bytes'] > 0 and stats['rows_per_second'] > 0
+        assert pg.query('select * from t where i = 3') == [
+            (3, 3 * 10**10, 1.5, 'row "3",\n', False, dt.date(2024, 1, 1), ts, {'i': 3}, None, b'\x00\xff')
+        ]
+
+        # a subset of the columns; the rest are NULL
+        pg.copy_in('t', [(1000, '')], columns=['i', 's'], format=fmt)
+        assert pg.query('select s, b from t where i = 1000') == [('', None)]
+
+        def failing_rows() -> Iterator[tuple]:
+            yield (2000,)
+            raise RuntimeError('source failed')
+
+        with pytest.raises(RuntimeError, match='source failed'):
+            pg.copy_in('t', failing_rows(), columns=['i'], format=fmt)
+        assert pg.query('select count(*) from t') == [(1001,)]  # aborted as a whole; the connection still works
+
+        with pytest.raises(ValueError, match='missing'):
+            pg.copy_in('t', [], columns=['missing'], format=fmt)
+        pg.query('create table n (v numeric)')
+        if fmt == 'binary':
+            with pytest.raises(ValueError, match='numeric'):
+                pg.copy_in('n', [(1,)], format=fmt)
+
+
+@pytest.mark.parametrize('fmt', ['binary', 'csv'])
+def test_copy_in_vectors(tmp_path: Path, fmt: str) -> None:
+    np = pytest.importorskip('numpy')
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        pg.query('create extension vector')
+        pg.query('create table items (id int, embedding vector(3))')
+        pg.copy_in('items', [(1, [0.5, 1, 2]), (2, np.array([3, 4, 5]))], format=fmt)
+
+        vectors = np.arange(3000, dtype=np.float32).reshape(1000, 3) / 4
+        stats = pg.copy_in('items', vectors, columns=['embedding'], format=fmt, chunk_size=1024)
+        assert stats['rows'] == 1000
+        assert pg.query('select embedding::text from items where id is not null order by id') == [
+            ('[0.5,1,2]',),
+            ('[3,4,5]',),
+        ]
+        rows = pg.query('select embedding::text from items where id is null')
+        loaded = np.array([json.loads(v) for (v,) in rows], dtype=np.float32)
+        assert np.array_equal(loaded, vectors)
+
+
+def test_lazy_import() -> None:
+    # importing the package, or the server module, has no side effects and skips the heavier dependencies
+    code = (
+        'import sys, pixeltable_pgserver\n'
+        "assert not {'psutil', 'fasteners', 'platformdirs', 'asyncio'} & set(sys.modules), sys.modules.keys()\n"
+        'from pixeltable_pgserver import PostgresServer\n'
+        "assert not {'fasteners', 'platformdirs'} & set(sys.modules)\n"
+        'assert PostgresServer.runtime_path is None and PostgresServer._lock is None\n'
+    )
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason='the postmaster is killed with SIGKILL')
+@pytest.mark.parametrize('start_mode', ['pg_ctl', 'direct'])
+def test_watchdog(tmp_path: Path, start_mode: str) -> None:
+    events: list[str] = []
+    with get_server(tmp_path, cleanup_mode='delete', start_mode=start_mode, watchdog_interval=0.05) as pg:
+        assert pg.watchdog is not None
+        pg.watchdog.add_callback(lambda server, event: events.append(event))
+        pg.query('create table t (i int)')
+        old_pid = pg.get_pid()
+        psutil.Process(old_pid).kill()  # as the OOM killer would
+
+        deadline = time.monotonic() + 30
+        while 'restarted' not in events and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert events[0] == 'down' and events[-1] == 'restarted', events
+        assert pg.watchdog.restarts == 1
+        assert pg.get_pid() != old_pid
+        # the persistent connection of query() was replaced, and the data survived crash recovery
+        assert pg.query('select count(*) from t') == [(0,)]
+        assert any(span.phase == 'recovery' for span in pg.timings.spans)
+
+    # stopping the server on cleanup is not mistaken for a crash
+    assert pg.watchdog.stopped
+    time.sleep(0.2)
+    assert events.count('restarted') == 1
+
+
+def _attached_worker(server: PostgresServer) -> tuple[int | None, list[str], bool]:
+    """Runs in a worker process, receiving the server pickled as a handle."""
+    assert server.query('select 1') == [(1,)]
+    holders = [path.name for path in (server.pgdata / '.handles').iterdir()]
+    return server.get_pid(), [span.phase for span in server.timings.spans], str(os.getpid()) in holders
+
+
+def test_attach_handle(tmp_path: Path) -> None:
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        # spawned workers attach from the pickled handle, without inspecting or initializing the server
+        with mp.get_context('spawn').Pool(2) as pool:
+            results = pool.map(_attached_worker, [pg] * 4)
+        for pid, phases, attached in results:
+            assert pid == pg.get_pid()
+            assert phases == ['lock_wait']
+            assert attached
+
+        if platform.system() != 'Windows':
+            # forked workers attach from the pickled handle as well
+            with mp.get_context('fork').Pool(1) as pool:
+                pid, _, attached = pool.apply(_attached_worker, (pg,))
+            assert pid == pg.get_pid() and attached
+
+        handle = pg.export_handle()
+        assert pickle.loads(pickle.dumps(handle)) == handle
+        # in this process, the existing instance is returned
+        assert attach_server(handle) is pg
+    assert not pg.pgdata.exists()
+
+    # a handle of a server that is no longer running starts it as get_server() would
+    (tmp_path / 'pgdata').mkdir()
+    with attach_server(handle) as pg2:
+        assert pg2.get_pid() != int(handle.postmaster_lines[0])
+        assert pg2.cleanup_mode == 'delete'
+        _check_server(pg2)
+
+
+def _outliving_child(handle: ServerHandle, attached: Any, parent_done: Any, results: 'mp.Queue[Any]') -> None:
+    server = attach_server(handle)
+    attached.set()
+    parent_done.wait(30)
+    results.put(server.query('select 1'))
+
+
+def _late_child(handle: ServerHandle, parent_done: Any, results: 'mp.Queue[Any]') -> None:
+    parent_done.wait(30)
+    try:
+        attach_server(handle)
+        results.put('attached')
+    except FileNotFoundError:
+        results.put('deleted')
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason='fork is not available on Windows')
+def test_forked_child_attach(tmp_path: Path) -> None:
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+
+    # a child that attached keeps the server running after the parent's handle is gone, and cleans it up on exit
+    attached, parent_done = ctx.Event(), ctx.Event()
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete') as pg:
+        postmaster = psutil.Process(pg.get_pid())
+        child = ctx.Process(target=_outliving_child, args=(pg.export_handle(), attached, parent_done, results))
+        child.start()
+        assert attached.wait(30)
+    assert pg.pgdata.exists() and process_is_alive(postmaster)
+    parent_done.set()
+    assert results.get(timeout=30) == [(1,)]
+    child.join(30)
+    assert child.exitcode == 0
+    assert not pg.pgdata.exists()
+    assert _wait_until(lambda: not process_is_alive(postmaster))
+
+    # a child attaching after the parent deleted the server finds it gone, rather than using it
+    parent_done = ctx.Event()
+    with get_server(tmp_path / 'pgdata2', cleanup_mode='delete') as pg:
+        child = ctx.Process(target=_late_child, args=(pg.export_handle(), parent_done, results))
+        child.start()
+    parent_done.set()
+    assert results.get(timeout=30) == 'deleted'
+    child.join(30)
+    assert not pg.pgdata.exists()
+
+
+def _wait_until(condition: Callable[[], bool], timeout: float = 30.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.mark.skipif(platform.system() == 'Windows', reason='background_cleanup is not supported on Windows')
+def test_background_cleanup(tmp_path: Path) -> None:
+    pgdata = tmp_path / 'pgdata'
+    with get_server(pgdata, cleanup_mode='delete', background_cleanup=True) as pg:
+        pg.query('create table t (i int)')
+        process = psutil.Process(pg.get_pid())
+    # pgdata is out of the way at once; the shutdown and deletion complete in the background
+    assert not pgdata.exists()
+    assert {span.phase for span in pg.timings.spans} >= {'shutdown', 'delete'}
+    assert _wait_until(lambda: not process_is_alive(process))
+    assert _wait_until(lambda: list(tmp_path.iterdir()) == [])
+
+    # a server started again right away waits for the previous one to finish stopping
+    pgdata.mkdir()
+    with get_server(pgdata, cleanup_mode='stop', background_cleanup=True) as pg:
+        pg.query('create table t (i int)')
+        pid = pg.get_pid()
+    with get_server(pgdata, cleanup_mode='delete') as pg2:
+        assert pg2.get_pid() != pid
+        assert pg2.query('select count(*) from t') == [(0,)]
+
+
+def test_structured_log(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    # invalid options are rejected before pgdata is created
+    with pytest.raises(ValueError, match='slow_query_ms requires structured_log'):
+        get_server(tmp_path / 'pgdata', cleanup_mode='delete', slow_query_ms=0)
+    with pytest.raises(ValueError, match='slow_query_ms requires structured_log'):
+        asyncio.run(get_server_async(tmp_path / 'pgdata', cleanup_mode='delete', slow_query_ms=0))
+    assert not (tmp_path / 'pgdata').exists()
+
+    with get_server(tmp_path / 'pgdata', cleanup_mode='delete', structured_log=True, slow_query_ms=0) as pg:
+        assert any('ready to accept connections' in e['message'] for e in pg.log_tail(from_start=True).read())
+        tail = pg.log_tail()
+        pg.query('select pg_sleep(0.05)')
+        assert _wait_until(lambda: any('pg_sleep' in q.statement for q in tail.slow_queries()))
+
+        # entries are followed across rotations, and become logging records at the level of their severity
+        time.sleep(1)  # file names have a resolution of seconds; a rotation within the same second appends
+        pg.query('select pg_rotate_logfile()')
+        with pytest.raises(PostgresError):
+            pg.query('select * from no_such_table')
+        records: list[logging.LogRecord] = []
+
+        def error_logged() -> bool:
+            records.extend(tail.records())
+            return any(r.levelno == logging.ERROR for r in records)
+
+        assert _wait_until(error_logged)
+        error = next(r for r in records if r.levelno == logging.ERROR)
+        assert 'no_such_table' in error.getMessage()
+        assert error.pg['state_code'] == '42P01'  # type: ignore[attr-defined]
+        slow = [r.slow_query for r in records if r.slow_query is not None]  # type: ignore[attr-defined]
+        assert any(q.duration_ms >= 0 and 'pg_rotate_logfile' in q.statement for q in slow)
+        assert len(serverlog.log_files(pg.pgdata)) == 2
+
+        with caplog.at_level(logging.INFO, logger='pixeltable_pgserver.postgres'):
+            pg.query('select 1')
+            assert _wait_until(lambda: tail.emit() > 0)
+        assert any(r.name == 'pixeltable_pgserver.postgres' for r in caplog.records)
+
+    with get_server(tmp_path / 'plain', cleanup_mode='delete') as pg, pytest.raises(ValueError):
+        pg.log_tail()
+    with pytest.raises(ValueError):
+        get_server(tmp_path / 'plain', slow_query_ms=100)
+
+
+def test_read_tail(tmp_path: Path) -> None:
+    path = tmp_path / 'log'
+    path.write_text('x' * 100 + 'end\n')
+    assert serverlog.read_tail(path, max_bytes=4) == '[... 100 bytes omitted ...]\nend\n'
+    assert serverlog.read_tail(path) == path.read_text()
+    assert serverlog.read_tail(tmp_path / 'missing') == ''